@@ -86,6 +86,8 @@ INSTALLED_APPS = (
     'django.contrib.sessions',
     'django.contrib.sites',
     'vcboard',
+    'vcboard.archive',
     'vcboard.private_messaging',
-    'vcboard.ranks'
+    'vcboard.ranks',
+    'vcboard.search',
 )
@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.utils.translation import ugettext_lazy as _
 from models import Setting, Forum, Thread, Post
+from tree import forum_tree
 
 class SettingAdmin(admin.ModelAdmin):
     list_display = ('site', 'section', 'key', 'primitive_type', 'short_value',)
@@ -32,6 +33,16 @@ class ForumAdmin(admin.ModelAdmin):
         })
     )
 
+    # the sites of a forum are saved after the forum itself, so the forum tree
+    # has to be refreshed once more before it will show up on the site
+    def response_add(self, request, obj, *args, **kwargs):
+        forum_tree.invalidate()
+        return super(ForumAdmin, self).response_add(request, obj, *args, **kwargs)
+
+    def response_change(self, request, obj, *args, **kwargs):
+        forum_tree.invalidate()
+        return super(ForumAdmin, self).response_change(request, obj, *args, **kwargs)
+
 class ThreadAdmin(admin.ModelAdmin):
     list_display = ('forum', 'subject', 'author', 'is_draft', 'is_sticky', 
                     'is_closed', 'date_created')
@@ -1,7 +1,6 @@
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User, Permission
 from django.contrib.sites.models import Site
-from django.core.cache import cache
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext_lazy as _
@@ -68,24 +67,14 @@ def permission_matrix(request, obj_type=None, id=None, template='admin/permissio
                 if not forum and not default_perms:
                     params[str(obj_type)] = obj
 
+                # saving a permission throws away any cached permissions for 
+                # its forum (see vcboard.listeners)
                 perm, c = matrix_type.objects.get_or_create(**params)
                 value = form.cleaned_data[field_name]
                 if perm.has_permission != value:
                     perm.has_permission = value
                     perm.save()
 
-            # remove previously cached permissions for this forum.  This makes
-            # it so the permissions have to be refreshed
-            perms = cache.get('perms_for_forums', {})
-            cached_perm_dict = cache.get('vcboard_user_perms', {})
-            for forum_id in forums.keys():
-                if perms.has_key(forum_id):
-                    for key in perms[forum_id]:
-                        del cached_perm_dict[key]
-                perms[str(forum_id)] = []
-            cache.set('vcboard_user_perms', cached_perm_dict)
-            cache.set('perms_for_forums', perms)
-
             request.user.message_set.create(message='Permissions have been saved.')
     else:
         form = PermissionMatrixForm(permissions=permissions, forum=forum)
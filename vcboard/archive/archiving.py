@@ -0,0 +1,133 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from vcboard.archive.models import ArchivedPost, ArchivedThread
+from vcboard.counters import clear_stale, CHUNK_SIZE
+from vcboard.models import Forum, Thread, Post
+from vcboard.signals import threads_moderated
+from datetime import datetime, timedelta
+
+# how many days a thread may go without a new post before it is archived
+ARCHIVE_AFTER_DAYS = getattr(settings, 'VCBOARD_ARCHIVE_AFTER_DAYS', 365)
+
+# the fields that are copied from the live tables, as (archive, live) pairs
+POST_FIELDS = (('id', 'id'), ('parent', 'parent'), ('author', 'author'),
+               ('subject', 'subject'), ('content', 'content'),
+               ('content_html', 'content_html'), ('rating', 'rating'),
+               ('ip_address', 'ip_address'), ('date_created', 'date_created'),
+               ('date_updated', 'date_updated'))
+THREAD_FIELDS = (('archivedpost_ptr', 'post_ptr'), ('forum', 'forum'),
+                 ('reply_count', 'reply_count'), ('view_count', 'view_count'),
+                 ('is_sticky', 'is_sticky'), ('is_closed', 'is_closed'))
+
+def archivable_threads(before):
+    """
+    Retrieves the threads whose last post was written before a point in
+    time.  Drafts and deleted threads are left to their authors and to the
+    purge command.  The thread with the newest post always stays, so the
+    archived IDs are never handed out again.
+    """
+    newest, thread_id = Post.objects.newest()
+    threads = Thread.objects.valid().filter(
+                    Q(_last_post__date_created__lt=before) |
+                    Q(_last_post__isnull=True, date_created__lt=before)) \
+                    .exclude(pk=thread_id)
+    if 'vcboard.attachments' in settings.INSTALLED_APPS:
+        # attachments have nowhere to go in the archive
+        threads = threads.exclude(attachments__isnull=False) \
+                         .exclude(posts__attachments__isnull=False)
+    return threads
+
+def _copy(model, fields, queryset):
+    """
+    Copies the rows of a queryset into an archive table with a single
+    INSERT ... SELECT, so the rows never pass through Python
+    """
+    qn = connection.ops.quote_name
+    columns = [qn(model._meta.get_field(name).column) for name, source in fields]
+    sql, params = queryset.order_by() \
+                          .values_list(*[source for name, source in fields]) \
+                          .query.as_sql()
+    connection.cursor().execute('INSERT INTO %s (%s) %s' % (
+                                    qn(model._meta.db_table),
+                                    ', '.join(columns), sql), params)
+
+def archive_threads(ids):
+    """
+    Moves a batch of threads and their replies into the archive tables, in
+    one transaction.  Deleted replies and drafts are not archived, and the
+    ratings and watches of the threads go away with them.  The forums no
+    longer count the threads, but their authors still do.  Returns the
+    number of threads archived.
+    """
+    rows = list(Thread.objects.valid().filter(pk__in=list(ids)) \
+                      .values_list('pk', 'forum'))
+    if not rows:
+        return 0
+    ids = [r[0] for r in rows]
+
+    # every row is copied after the rows it points at, since not every 
+    # database defers its foreign key checks
+    _copy(ArchivedPost, POST_FIELDS, Post.objects.filter(pk__in=ids))
+    _copy(ArchivedThread, THREAD_FIELDS, Thread.objects.filter(pk__in=ids))
+    _copy(ArchivedPost, POST_FIELDS, Post.objects.valid().filter(parent__in=ids))
+
+    # the live last post may be a deleted reply, which stays behind
+    last_posts = Post.objects.last_posts(ArchivedPost.objects.filter(parent__in=ids),
+                                         'parent')
+    for thread_id, (date_created, last_post) in last_posts.items():
+        ArchivedThread.objects.filter(pk=thread_id).update(_last_post=last_post)
+
+    replies = dict(Post.objects.valid().filter(parent__in=ids) \
+                       .order_by().values_list('parent').annotate(Count('id')))
+    deltas = {}
+    for pk, forum_id in rows:
+        delta = deltas.setdefault(forum_id, [0, 0])
+        delta[0] -= 1
+        delta[1] -= 1 + replies.get(pk, 0)
+    Forum.objects.adjust_counters(deltas)
+
+    # Django deletes everything that points at a deleted row, even through
+    # nullable foreign keys, so nothing may point at the posts anymore
+    forum_ids = list(Forum.objects.filter(Q(last_post__in=ids) |
+                                          Q(last_post__parent__in=ids)) \
+                                  .values_list('pk', flat=True))
+    Forum.objects.filter(pk__in=forum_ids).update(last_post=None)
+    Thread.objects.filter(pk__in=ids).update(_last_post=None)
+
+    # the replies, ratings, watches and search tokens go with the threads.
+    # Deleting the threads flags the counters of their forums as stale, but
+    # they have already been adjusted
+    Thread.objects.filter(pk__in=ids).delete()
+    clear_stale(*['f%i' % fid for f in deltas 
+                              for fid in Forum.objects.ancestor_ids(f)])
+    Forum.objects.recalculate_last_posts(forum_ids)
+
+    threads_moderated.send(sender=Thread, action='archive', thread_ids=ids,
+                           forum_ids=deltas.keys(), values={})
+    return len(ids)
+archive_threads = transaction.commit_on_success(archive_threads)
+
+def archive_inactive(before=None, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    Archives the threads that have had no new posts since a point in time,
+    ARCHIVE_AFTER_DAYS ago unless another time is given.  Each batch of
+    threads is archived in its own transaction, which keeps the locks short.
+    Yields the number of threads in each batch.
+    """
+    if before is None:
+        before = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+
+    threads = archivable_threads(before)
+    last = 0
+    while True:
+        ids = list(threads.filter(pk__gt=last).order_by('pk') \
+                          .values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            break
+        last = ids[-1]
+
+        if dry_run:
+            yield len(ids)
+        else:
+            yield archive_threads(ids)
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from vcboard.archive.archiving import archive_inactive, ARCHIVE_AFTER_DAYS
+from vcboard.counters import CHUNK_SIZE
+from datetime import datetime, timedelta
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=ARCHIVE_AFTER_DAYS,
+            help='Only archive threads without a new post for at least this many days.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=CHUNK_SIZE,
+            help='How many threads to archive at a time.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only show how many threads would be archived, without moving them.'),
+    )
+    help = 'Moves threads that have been inactive for a long time into the archive.'
+
+    def handle(self, *args, **options):
+        before = datetime.now() - timedelta(days=options.get('days'))
+        dry_run = options.get('dry_run')
+        verbosity = int(options.get('verbosity', 1))
+
+        total = 0
+        for count in archive_inactive(before, options.get('chunk_size'), dry_run):
+            total += count
+            if verbosity > 1:
+                print 'Archived %i threads...' % total
+
+        if verbosity > 0:
+            if dry_run:
+                print '%i threads would be archived.' % total
+            else:
+                print '%i threads were archived.' % total
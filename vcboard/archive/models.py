@@ -0,0 +1,60 @@
+from django.contrib.auth.models import User
+from django.db import models
+from django.template.defaultfilters import mark_safe
+from django.utils.translation import ugettext_lazy as _
+from vcboard.markup import render_markup
+from vcboard.models import Forum, Post, Thread
+
+class ArchivedPost(models.Model):
+    """
+    A post that was moved out of the post table because its thread had been
+    inactive for a long time.  Archived posts keep the ID they had, so old
+    links still find them, and they are never changed again.  The live 
+    tables never hand those IDs out again, because the thread with the 
+    newest post is never archived or purged.
+    """
+    parent = models.ForeignKey('ArchivedThread', blank=True, null=True, related_name='posts')
+    author = models.ForeignKey(User, blank=True, null=True, related_name='archived_posts')
+    subject = models.CharField(_('Subject'), max_length=100)
+    content = models.TextField(_('Content'))
+    content_html = models.TextField(blank=True)
+    rating = models.FloatField(_('Rating'), default=0.0)
+    ip_address = models.IPAddressField(_('IP Address'), blank=True)
+    date_created = models.DateTimeField()
+    date_updated = models.DateTimeField()
+
+    def __unicode__(self):
+        return self.subject
+
+    def _get_html(self):
+        # archived posts are read-only, so missing HTML is not stored
+        return mark_safe(self.content_html or render_markup(self.content))
+    html = property(_get_html)
+
+    post_date_info = Post.post_date_info
+    author_link = Post.author_link
+
+    class Meta:
+        ordering = ('date_created',)
+
+class ArchivedThread(ArchivedPost):
+    forum = models.ForeignKey(Forum, related_name='archived_threads')
+    reply_count = models.PositiveIntegerField(_('Replies'), default=0)
+    view_count = models.PositiveIntegerField(_('Views'), default=0)
+    is_sticky = models.BooleanField(_('Is Sticky'), blank=True, default=False)
+    is_closed = models.BooleanField(_('Is Closed'), blank=True, default=True)
+    _last_post = models.ForeignKey(ArchivedPost, null=True, related_name='last_thread_post')
+
+    def _get_last_post(self):
+        return self._last_post or self
+    last_post = property(_get_last_post)
+
+    last_post_info = Thread.last_post_info
+
+    def get_absolute_url(self):
+        # the thread's old URL finds it in the archive
+        return ('vcboard-show-thread', [Forum.objects.path(self.forum_id), self.id])
+    get_absolute_url = models.permalink(get_absolute_url)
+
+    class Meta:
+        ordering = ('-date_created',)
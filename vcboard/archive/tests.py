@@ -0,0 +1,112 @@
+from django.contrib.auth.models import User, Permission
+from django.core.management import call_command
+from django.core.urlresolvers import resolve
+from django.test import TestCase
+from datetime import datetime
+from vcboard.archive.archiving import archive_inactive
+from vcboard.archive.models import ArchivedThread, ArchivedPost
+from vcboard.counters import rebuild_counters, is_stale
+from vcboard.models import Forum, Thread, Post, ForumPermission, ForumProfile, \
+                           Rating, ThreadWatch
+from vcboard.tests import create_thread, create_reply
+from vcboard.tree import forum_tree
+from vcboard.utils import PP, invalidate_permissions
+
+class ArchiveTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        forum_tree.invalidate()
+        invalidate_permissions()
+        self.ann = Forum.objects.get(pk=2)
+        for codename in ('view_forum', 'view_other_threads'):
+            perm = Permission.objects.get(codename=PP(codename))
+            ForumPermission.objects.create(forum=self.ann, permission=perm,
+                                           has_permission=True)
+
+        self.user = User.objects.create_user('poster', 'poster@example.com', 'password')
+        self.old = create_thread(self.ann, 'Old', author=self.user)
+        self.replies = [create_reply(self.old, 'Old reply %i' % i, author=self.user)
+                        for i in range(2)]
+        self.deleted = create_reply(self.old, 'Deleted reply', author=self.user,
+                                    is_deleted=True)
+        self.active = create_thread(self.ann, 'Active', author=self.user)
+        Rating.objects.create(post=self.replies[0], user=self.user, rating=5)
+        ThreadWatch.objects.create(thread=self.old, user=self.user)
+        list(rebuild_counters())
+
+        # only the old thread has gone quiet
+        Post.objects.filter(pk__in=[self.old.id, self.deleted.id] + 
+                                   [r.id for r in self.replies]) \
+                    .update(date_created=datetime(2000, 1, 1))
+        self.forum_url = '/main-forum-category/announcements/'
+        self.archive_url = '/forum/main-forum-category/announcements/+archive/'
+        self.url = '/forum/main-forum-category/announcements/thread/%i/' % self.old.id
+
+    def testArchive(self):
+        # inactive threads move to the archive tables with the same IDs
+        posts = Post.objects.count()
+        # the deleted reply isn't archived, so the archive can't point at it
+        Thread.objects.filter(pk=self.old.id).update(_last_post=self.deleted)
+        call_command('vcboard_archive', verbosity=0)
+
+        self.assertEquals([self.active.id], list(Thread.objects.filter(forum=self.ann) \
+                                                       .values_list('pk', flat=True)))
+        self.assertEquals(posts - 4, Post.objects.count())
+        thread = ArchivedThread.objects.get(pk=self.old.id)
+        self.assertEquals((self.ann.id, 2, self.replies[1].id),
+                          (thread.forum_id, thread.reply_count, thread.last_post.id))
+        self.assertEquals([r.id for r in self.replies],
+                          list(thread.posts.values_list('pk', flat=True)))
+        self.assertEquals(3, ArchivedPost.objects.count())
+        self.assertEquals(0, Rating.objects.count())
+        self.assertEquals(0, ThreadWatch.objects.count())
+
+        # the forums no longer count the threads, but their authors do
+        self.assertFalse(is_stale('f1') or is_stale('f%i' % self.ann.id))
+        self.assertEquals([], list(rebuild_counters(dry_run=True)))
+        forum = Forum.objects.get(pk=self.ann.id)
+        self.assertEquals(self.active.id, forum.last_post_id)
+        profile = ForumProfile.objects.get(user=self.user)
+        self.assertEquals((2, 4), (profile.thread_count, profile.post_count))
+
+    def testDryRun(self):
+        # nothing moves on a dry run, or when every thread is recent enough
+        self.assertEquals([1], list(archive_inactive(dry_run=True)))
+        self.assertEquals([], list(archive_inactive(datetime(1999, 1, 1))))
+        self.assertEquals(0, ArchivedThread.objects.count())
+
+    def testNewestKept(self):
+        # the thread with the newest post stays, so new posts never get the
+        # ID of an archived one
+        Post.objects.filter(pk=self.active.id).update(date_created=datetime(2000, 1, 1))
+        self.assertEquals([1], list(archive_inactive()))
+        self.assertEquals([self.active.id], list(Thread.objects.filter(forum=self.ann) \
+                                                       .values_list('pk', flat=True)))
+        thread = create_thread(self.ann, 'New')
+        self.assertFalse(ArchivedPost.objects.filter(pk__gte=thread.id).count())
+
+    def testArchiveSlug(self):
+        # a forum may be called "archive" without losing its pages
+        forum = Forum.objects.create(name='Archive', parent=self.ann)
+        func, args, kwargs = resolve('/forum/%s/page/2/' % forum.path, 'vcboard.urls')
+        self.assertEquals((forum.path, '2', False), 
+                          (kwargs['path'], kwargs['page'], kwargs.get('archived', False)))
+        func, args, kwargs = resolve('/forum/%s/+archive/' % forum.path, 'vcboard.urls')
+        self.assertEquals((forum.path, True), (kwargs['path'], kwargs['archived']))
+
+    def testViews(self):
+        # archived threads are still shown at their old URLs, read-only
+        self.assertNotContains(self.client.get(self.forum_url), self.archive_url)
+        list(archive_inactive())
+
+        response = self.client.get(self.url)
+        self.assertContains(response, 'Old reply 1')
+        self.assertNotContains(response, 'Deleted reply')
+        self.assertNotContains(response, '/reply/')
+        self.assertContains(self.client.get(self.forum_url), self.archive_url)
+
+        response = self.client.get(self.archive_url)
+        self.assertContains(response, self.url)
+        self.assertNotContains(response, 'Active')
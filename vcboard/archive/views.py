@@ -0,0 +1,72 @@
+from django.core.paginator import InvalidPage
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from vcboard import config, decorators as vcb
+from vcboard.archive.models import ArchivedThread
+from vcboard.pagination import CountedPaginator, THREAD_ORDERING, POST_ORDERING
+from vcboard.utils import render
+
+def has_archived_threads(forum):
+    """
+    Determines whether a forum has any threads in the archive
+    """
+    return bool(ArchivedThread.objects.filter(forum=forum).values('pk')[:1])
+
+def _page(paginator, page):
+    try:
+        return paginator.page(page)
+    except InvalidPage:
+        raise Http404
+
+@vcb.permission_required('view_forum')
+def show_forum(request, forum, page=1, template='vcboard/archive/forum_detail.html'):
+    """
+    Displays the archived threads of a forum.  The archive doesn't change
+    much, so it is paginated the plain way.
+    """
+    threads_per_page = forum.threads_per_page
+    if threads_per_page == 0:
+        threads_per_page = config('forum', 'threads_per_page', int, 20)
+    threads = ArchivedThread.objects.filter(forum=forum) \
+                  .select_related('author', '_last_post', '_last_post__author') \
+                  .order_by(*THREAD_ORDERING)
+    paginator = CountedPaginator(threads, threads_per_page)
+
+    data = {
+        'forum': forum,
+        'paginator': paginator,
+        'page': _page(paginator, page)
+    }
+    return render(request, template, data)
+
+def base_show_thread(request, forum, thread, page, template):
+    """
+    Displays an archived thread, without any way to change it
+    """
+    paginator = CountedPaginator(thread.posts.select_related('author') \
+                                       .order_by(*POST_ORDERING),
+                                 config('thread', 'posts_per_page', int, 20),
+                                 thread.reply_count)
+    data = {
+        'forum': forum,
+        'thread': thread,
+        'paginator': paginator,
+        'page': _page(paginator, page)
+    }
+    return render(request, template, data)
+
+@vcb.permission_required('view_other_threads')
+def show_other_thread(*args, **kwargs):
+    # wraps base_show_thread with a decorator that checks for permission
+    return base_show_thread(*args, **kwargs)
+
+def show_thread(request, forum, thread_id, page=1,
+        template='vcboard/archive/thread_detail.html'):
+    """
+    Allows users to view archived threads
+    """
+    thread = get_object_or_404(ArchivedThread, pk=thread_id, forum=forum)
+    func = base_show_thread
+    if thread.author != request.user:
+        func = show_other_thread
+    return func(request, forum, thread, page, template)
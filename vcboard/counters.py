@@ -0,0 +1,314 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Count
+from vcboard.utils import cache_version, bump_cache_version, VERSION_TIMEOUT
+import atexit
+import threading
+import time
+
+# how often (in seconds) buffered thread views are written to the database
+FLUSH_INTERVAL = getattr(settings, 'VCBOARD_VIEW_FLUSH_INTERVAL', 60)
+
+# how many threads to update with a single query
+BATCH_SIZE = 500
+
+# how many rows to recalculate at a time when rebuilding counters
+CHUNK_SIZE = 1000
+
+# how many threads to remember per session when only counting unique views
+UNIQUE_VIEWS = 100
+
+# bumped whenever all counters have been rebuilt, which clears every stale flag
+STALE_VERSION = 'vcboard_stale_counters_version'
+
+class ViewCounter(object):
+    """
+    Collects thread views in memory and writes them to the database in 
+    batches with UPDATE ... SET view_count = view_count + n, so viewing a 
+    thread never has to save (or lock) the thread itself.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL):
+        self.interval = interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+
+    def add(self, thread_id, count=1):
+        """
+        Records views of a thread, flushing everything that has been 
+        collected once the flush interval has passed
+        """
+        self.lock.acquire()
+        try:
+            self.pending[thread_id] = self.pending.get(thread_id, 0) + count
+            due = time.time() - self.last_flush >= self.interval
+        finally:
+            self.lock.release()
+
+        if due:
+            self.flush()
+
+    def get(self, thread_id):
+        """
+        Returns the number of views of a thread that have not been written to
+        the database yet
+        """
+        return self.pending.get(thread_id, 0)
+
+    def flush(self):
+        """
+        Writes all collected views to the database
+        """
+        self.lock.acquire()
+        try:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+        finally:
+            self.lock.release()
+
+        # threads with the same number of new views share an UPDATE
+        batches = {}
+        for thread_id, count in pending.items():
+            batches.setdefault(count, []).append(thread_id)
+
+        from vcboard.models import Thread
+        for count, ids in batches.items():
+            for i in range(0, len(ids), BATCH_SIZE):
+                Thread.objects.filter(pk__in=ids[i:i + BATCH_SIZE]) \
+                              .update(view_count=F('view_count') + count)
+
+view_counter = ViewCounter()
+atexit.register(view_counter.flush)
+
+def first_view(request, thread_id):
+    """
+    Determines whether this is the first time the thread has been viewed in 
+    the current session.  Only the most recently viewed threads are 
+    remembered.
+    """
+    viewed = request.session.get('vcboard_viewed', [])
+    if thread_id in viewed:
+        return False
+
+    request.session['vcboard_viewed'] = (viewed + [thread_id])[-UNIQUE_VIEWS:]
+    return True
+
+def mark_stale(*names):
+    """
+    Flags the listing counters of some forums or threads, such as 'f2' for
+    the thread count of forum 2 or 't10' for the reply count of thread 10, as
+    no longer trustworthy.  The flags last until the counters are rebuilt.
+    """
+    version = cache_version(STALE_VERSION)
+    for name in names:
+        cache.set('vcboard_stale_%s_%s' % (name, version), True, VERSION_TIMEOUT)
+
+def clear_stale(*names):
+    """
+    Takes the stale flags off the listing counters of some forums or threads
+    whose counters are known to be right again
+    """
+    version = cache_version(STALE_VERSION)
+    for name in names:
+        cache.delete('vcboard_stale_%s_%s' % (name, version))
+
+def is_stale(name):
+    """
+    Determines whether the listing counter of a forum or thread has been 
+    flagged as stale
+    """
+    version = cache_version(STALE_VERSION)
+    return cache.get('vcboard_stale_%s_%s' % (name, version), False)
+
+def _chunks(queryset, size=CHUNK_SIZE):
+    """
+    Yields the primary keys of a queryset in ascending chunks, without ever
+    loading more than one chunk
+    """
+    last = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        chunk = list(chunk.values_list('pk', flat=True)[:size])
+        if not chunk:
+            break
+        yield chunk
+        last = chunk[-1]
+
+def _slices(ids, size=CHUNK_SIZE):
+    """
+    Yields a list of IDs in chunks
+    """
+    ids = sorted(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+def _apply(model, pk, stored, counted, dry_run=False):
+    """
+    Compares the stored counters of an object with the counted ones and 
+    updates the ones that differ.  Returns a list of (model name, pk, field,
+    stored value, counted value) tuples describing the differences.
+    """
+    changed = dict((f, v) for f, v in counted.items() if stored[f] != v)
+    if changed and not dry_run:
+        model.objects.filter(pk=pk).update(**changed)
+    return [(model._meta.object_name, pk, f, stored[f], v) 
+            for f, v in sorted(changed.items())]
+
+def rebuild_thread_counters(thread_ids=None, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    Recalculates the reply count and last post of threads, all of them unless
+    specific thread IDs are given.  Yields the differences that were found.
+    """
+    from vcboard.models import Thread, Post
+
+    if thread_ids is None:
+        chunks = _chunks(Thread.objects.all(), chunk_size)
+    else:
+        chunks = _slices(thread_ids, chunk_size)
+
+    for ids in chunks:
+        replies = Post.objects.valid().filter(parent__in=ids)
+        counts = dict(replies.order_by().values_list('parent').annotate(Count('id')))
+        last_posts = Post.objects.last_posts(replies, 'parent')
+
+        stored = Thread.objects.filter(pk__in=ids) \
+                       .values_list('pk', 'reply_count', '_last_post')
+        for pk, reply_count, last_post in stored:
+            last = last_posts.get(pk, None)
+            for change in _apply(Thread, pk, 
+                        {'reply_count': reply_count, '_last_post': last_post},
+                        {'reply_count': counts.get(pk, 0),
+                         '_last_post': last and last[1]},
+                        dry_run):
+                yield change
+
+def rebuild_forum_counters(dry_run=False):
+    """
+    Recalculates the thread count, post count and last post of every forum,
+    along with its place in the forum tree.  Each forum's own threads and 
+    replies are counted with one aggregate query each and then rolled up the
+    forum tree.  Yields the differences that were found.
+    """
+    from vcboard.models import Forum, Thread, Post
+
+    paths = Forum.objects.tree_paths()
+
+    # [threads, posts, last post] directly within each forum, where the last
+    # post is a (date_created, id) tuple
+    direct = {}
+    threads = Thread.objects.filter(is_draft=False, is_deleted=False)
+    last_posts = Post.objects.last_posts(threads, 'forum')
+    for forum_id, count in threads.order_by().values_list('forum') \
+                                  .annotate(Count('pk')):
+        direct[forum_id] = [count, count, last_posts[forum_id]]
+
+    replies = Post.objects.valid().filter(parent__is_draft=False, 
+                                          parent__is_deleted=False)
+    last_posts = Post.objects.last_posts(replies, 'parent__forum')
+    for forum_id, count in replies.order_by().values_list('parent__forum') \
+                                  .annotate(Count('id')):
+        counts = direct.setdefault(forum_id, [0, 0, None])
+        counts[1] += count
+        counts[2] = max(counts[2], last_posts[forum_id])
+
+    # every forum counts everything beneath it
+    stored = list(Forum.objects.values_list('pk', 'tree_path', 'depth', 
+                                            'thread_count', 'post_count', 
+                                            'last_post'))
+    totals = dict((row[0], [0, 0, None]) for row in stored)
+    for row in stored:
+        threads, posts, last = direct.get(row[0], (0, 0, None))
+        for fid in [int(f) for f in paths[row[0]].split('/') if f]:
+            if totals.has_key(fid):
+                totals[fid][0] += threads
+                totals[fid][1] += posts
+                totals[fid][2] = max(totals[fid][2], last)
+
+    for pk, tree_path, depth, thread_count, post_count, last_post in stored:
+        threads, posts, last = totals[pk]
+        for change in _apply(Forum, pk,
+                    {'tree_path': tree_path, 'depth': depth,
+                     'thread_count': thread_count, 'post_count': post_count,
+                     'last_post': last_post},
+                    {'tree_path': paths[pk], 'depth': paths[pk].count('/') - 1,
+                     'thread_count': threads, 'post_count': posts, 
+                     'last_post': last and last[1]},
+                    dry_run):
+            yield change
+
+def rebuild_profile_counters(user_ids=None, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    Recalculates the thread and post counts of forum profiles, all of them 
+    unless specific user IDs are given.  Yields the differences that were
+    found.
+    """
+    from vcboard.models import ForumProfile, Thread, Post
+
+    if user_ids is None:
+        batches = (ForumProfile.objects.filter(pk__in=ids) for ids in
+                   _chunks(ForumProfile.objects.all(), chunk_size))
+    else:
+        batches = (ForumProfile.objects.filter(user__in=ids) for ids in
+                   _slices(user_ids, chunk_size))
+
+    for profiles in batches:
+        stored = list(profiles.values_list('pk', 'user', 'thread_count', 'post_count'))
+        users = [row[1] for row in stored]
+        threads = dict(Thread.objects.filter(author__in=users, is_draft=False,
+                                             is_deleted=False) \
+                             .order_by().values_list('author').annotate(Count('pk')))
+        posts = dict(Post.objects.valid().filter(author__in=users) \
+                         .order_by().values_list('author').annotate(Count('id')))
+
+        if 'vcboard.archive' in settings.INSTALLED_APPS:
+            # archived posts still count for their authors
+            from vcboard.archive.models import ArchivedThread, ArchivedPost
+            archived = ArchivedThread.objects.filter(author__in=users) \
+                           .order_by().values_list('author').annotate(Count('pk'))
+            for user_id, count in archived:
+                threads[user_id] = threads.get(user_id, 0) + count
+            archived = ArchivedPost.objects.filter(author__in=users) \
+                           .order_by().values_list('author').annotate(Count('id'))
+            for user_id, count in archived:
+                posts[user_id] = posts.get(user_id, 0) + count
+
+        for pk, user_id, thread_count, post_count in stored:
+            for change in _apply(ForumProfile, pk,
+                        {'thread_count': thread_count, 'post_count': post_count},
+                        {'thread_count': threads.get(user_id, 0),
+                         'post_count': posts.get(user_id, 0)},
+                        dry_run):
+                yield change
+
+def rebuild_counters(since=None, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    Recalculates every denormalized counter.  When a timestamp is given, only
+    threads and profiles with posts that changed since then are 
+    recalculated.  Forums are always recalculated in full, which only takes 
+    two aggregate queries.  Yields the differences that were found.
+    """
+    from vcboard.models import Thread, Post
+
+    thread_ids = user_ids = None
+    if since:
+        touched = Post.objects.filter(date_updated__gte=since)
+        thread_ids = set(Thread.objects.filter(date_updated__gte=since) \
+                                       .values_list('pk', flat=True))
+        thread_ids.update(touched.filter(parent__isnull=False) \
+                                 .values_list('parent', flat=True))
+        user_ids = set(touched.filter(author__isnull=False) \
+                              .values_list('author', flat=True))
+
+    for change in rebuild_thread_counters(thread_ids, chunk_size, dry_run):
+        yield change
+    for change in rebuild_forum_counters(dry_run):
+        yield change
+    for change in rebuild_profile_counters(user_ids, chunk_size, dry_run):
+        yield change
+
+    # everything has been counted again, so nothing is stale anymore
+    if not since and not dry_run:
+        bump_cache_version(STALE_VERSION)
@@ -24,7 +24,7 @@ class PermissionMatrixForm(forms.Form):
         self.all_permissions = Permission.objects.filter(codename__startswith='vcb_')
         self.permissions = list(self.all_permissions)
 
-        self.values = dict(('f_%i_p_%i' % (p.forum.id, p.permission.id), p.has_permission) for p in permissions)
+        self.values = dict(('f_%i_p_%i' % (p.forum_id, p.permission_id), p.has_permission) for p in permissions)
 
         if forum:
             self.add_forum(forum)
@@ -1,7 +1,14 @@
-from django.db.models import signals
+from django.contrib.auth.models import User
+from django.db.models import signals, F
 from vcboard import config, signals as vcb
-from models import Setting, Forum, Thread, Post, UserGroup
-from datetime import datetime
+from models import Setting, Forum, Thread, Post, UserGroup, ForumPermission, \
+                   GroupPermission, UserPermission, ForumProfile, ReadMarker, \
+                   get_profile
+from counters import mark_stale
+from pagecache import invalidate_thread, invalidate_threads, invalidate_all
+from pagination import invalidate_pages, extend_pages, SEEK_PAGINATION
+from tree import forum_tree
+from utils import invalidate_permissions
 
 def only_one_default_group(sender, instance, created, **kwargs):
     """
@@ -9,50 +16,222 @@ def only_one_default_group(sender, instance, created, **kwargs):
     """
     UserGroup.objects.exclude(pk=instance.pk).update(is_default=False)
 
-def update_config(sender, instance, created, **kwargs):
+def user_created(sender, instance, created, raw=False, **kwargs):
     """
-    Updates the configuration cache with new settings
+    Gives new users a profile, so it never has to be created while reading
     """
-    config.set(instance)
+    if created and not raw:
+        instance._profile = ForumProfile.objects.create_for(instance)
+
+def update_config(sender, instance, **kwargs):
+    """
+    Makes every process reload the settings when one of them changes
+    """
+    config.invalidate()
+
+def permissions_changed(sender, instance, **kwargs):
+    """
+    Throws away cached permissions for the forum whose permissions changed
+    """
+    invalidate_permissions(instance.forum_id)
+
+def group_deleted(sender, instance, **kwargs):
+    """
+    Throws away all cached permissions when a group goes away
+    """
+    invalidate_permissions()
+
+def forum_changed(sender, instance, **kwargs):
+    """
+    Rebuilds the forum tree whenever a forum is saved or deleted
+    """
+    forum_tree.invalidate()
+
+def is_counted(post):
+    # drafts and deleted posts are left out of every counter
+    return not (post.is_draft or post.is_deleted)
+
+def count_post(sender, post, sign=1, replies=0):
+    """
+    Adds a post to the counters of its thread, forums and author, or takes it
+    out of them when the sign is -1.  A thread brings the number of replies
+    it has along to its forums.  Everything is done with atomic UPDATE 
+    statements so concurrent posts never lose increments.  Last posts only 
+    ever move forward when a post is added, and are worked out again when 
+    the last post is taken out.
+    """
+    counts = {'post_count': F('post_count') + sign}
+    if sender == Post:
+        threads = Thread.objects.filter(pk=post.parent_id)
+        threads.update(reply_count=F('reply_count') + sign)
+        thread = post.parent
+        forum_id = thread.forum_id
+
+        # replies only count for the forums while their thread does
+        forum_counts = is_counted(thread) and counts or {}
+        newest = post
+    else:
+        forum_id = post.forum_id
+        counts['thread_count'] = F('thread_count') + sign
+        forum_counts = {'thread_count': F('thread_count') + sign,
+                        'post_count': F('post_count') + sign * (1 + replies)}
+        newest = post.last_post
+
+    ancestor_ids = Forum.objects.ancestor_ids(forum_id)
+    forums = Forum.objects.filter(pk__in=ancestor_ids)
+    if forum_counts:
+        forums.update(**forum_counts)
+
+    if sign > 0:
+        if sender == Post:
+            threads.filter(Post.objects.before('_last_post', post)) \
+                   .update(_last_post=post)
+        if forum_counts:
+            forums.filter(Post.objects.before('last_post', newest)) \
+                  .update(last_post=newest)
+    elif sender == Post:
+        last = Post.objects.last_post(Post.objects.valid().filter(parent=post.parent_id))
+        threads.filter(_last_post=post).update(_last_post=last and last[1])
+        Forum.objects.recalculate_last_posts(forums.filter(last_post=post) \
+                                                   .values_list('pk', flat=True))
+    else:
+        Forum.objects.refresh_last_posts(ancestor_ids, [post.id])
+
+    if post.author_id:
+        profiles = ForumProfile.objects.filter(user=post.author_id)
+        if not profiles.update(**counts):
+            # make sure the author has a profile to count against
+            get_profile(post.author)
+            profiles.update(**counts)
 
 def post_created(sender, instance, created, **kwargs):
     """
     Increments post and thread counts
     """
-    if created:
-        if sender == Post:
-            instance.parent.reply_count += 1
-            instance.parent.last_post = instance
-            instance.parent.save()
-            collection = instance.parent.forum.hierarchy
-        else:
-            collection = instance.forum.hierarchy
+    if created and is_counted(instance):
+        count_post(sender, instance)
 
-        for forum in collection:
-            if sender == Thread:
-                forum.thread_count += 1
+def listing_changed(sender, instance, signal, created=False, **kwargs):
+    """
+    Keeps the page index of the forum or thread a post is listed in up to
+    date.  New replies go at the end of their thread's index.  Deletes and
+    posts that start or stop being listed, like published drafts, throw the
+    index away.  Edits don't change where a reply is listed.
+    """
+    if sender == Thread:
+        invalidate_pages('f%i' % instance.forum_id)
+    elif instance.parent_id:
+        name = 't%i' % instance.parent_id
+        counted = signal == signals.post_save and is_counted(instance)
+        if created:
+            if counted and SEEK_PAGINATION:
+                count = Thread.objects.filter(pk=instance.parent_id) \
+                              .values_list('reply_count', flat=True)[0]
+                extend_pages(name, config('thread', 'posts_per_page', int, 20),
+                             (instance.date_created, instance.id), count)
+        elif signal == signals.post_delete or \
+                counted != getattr(instance, '_was_counted', counted):
+            invalidate_pages(name)
 
-            forum.post_count += 1
-            forum.last_post = instance
-            forum.save()
+def remember_counted(sender, instance, **kwargs):
+    """
+    Remembers whether a post was counted when it was loaded or last saved
+    """
+    instance._was_counted = bool(instance.id) and is_counted(instance)
 
-def update_last_in(sender, instance, request, **kwargs):
+def counted_changed(sender, instance, signal, created=False, **kwargs):
     """
-    Updates the timestamp that a user was in a particular place
+    Keeps the counters right when a post starts or stops counting without 
+    going through post_created, like a draft that gets published.  Posts 
+    that are removed from the database flag the listing counters as stale
+    instead.
     """
-    now = datetime.now()
-    if sender == Forum:
-        key = 'last_in_f%i' % instance.id
+    counted = signal == signals.post_save and is_counted(instance)
+    was_counted = getattr(instance, '_was_counted', counted)
+    if created or counted == was_counted:
+        return
+
+    if signal == signals.post_save:
+        replies = 0
+        if sender == Thread:
+            replies = Post.objects.valid().filter(parent=instance.id).count()
+        count_post(sender, instance, counted and 1 or -1, replies)
     elif sender == Thread:
-        key = 'last_in_t%i' % instance.id
+        mark_stale(*['f%i' % fid for fid in Forum.objects.ancestor_ids(instance.forum_id)])
+    elif instance.parent_id:
+        mark_stale('t%i' % instance.parent_id)
+
+def page_changed(sender, instance, **kwargs):
+    """
+    Throws away the cached pages and fragments that show a post, thread or 
+    forum that was saved or deleted
+    """
+    if sender == Thread:
+        invalidate_thread(instance.id, instance.forum_id)
+    elif sender == Post:
+        if instance.parent_id:
+            invalidate_thread(instance.parent_id)
+    else:
+        # forums and permissions show up on every page
+        invalidate_all()
+
+def threads_moderated(sender, action, thread_ids, forum_ids, values, **kwargs):
+    """
+    Throws away the pages and page indexes that show threads that were
+    changed in bulk
+    """
+    forum_ids = list(forum_ids)
+    if action == 'move':
+        forum_ids.append(values['forum'].id)
+    invalidate_threads(thread_ids, forum_ids)
+    for forum_id in forum_ids:
+        invalidate_pages('f%i' % forum_id)
+
+def posts_deleted(sender, post_ids, thread_ids, forum_ids, **kwargs):
+    """
+    Throws away the pages and page indexes that showed replies that were
+    deleted in bulk
+    """
+    invalidate_threads(thread_ids, forum_ids)
+    for thread_id in thread_ids:
+        invalidate_pages('t%i' % thread_id)
+    for forum_id in forum_ids:
+        invalidate_pages('f%i' % forum_id)
 
-    request.session[key] = now
-    print 'Setting', key, 'to', now
+def mark_read(sender, instance, request, **kwargs):
+    """
+    Records that a user has read a thread
+    """
+    ReadMarker.objects.mark_thread_read(request.user, instance)
 
+signals.post_save.connect(user_created, sender=User)
 signals.post_save.connect(post_created, sender=Thread)
 signals.post_save.connect(post_created, sender=Post)
 signals.post_save.connect(update_config, sender=Setting)
-vcb.object_shown.connect(update_last_in, sender=Forum)
-vcb.object_shown.connect(update_last_in, sender=Thread)
+signals.post_delete.connect(update_config, sender=Setting)
+for model in (Thread, Post, Forum, ForumPermission, GroupPermission, 
+              UserPermission):
+    signals.post_save.connect(page_changed, sender=model)
+    signals.post_delete.connect(page_changed, sender=model)
+
+for model in (Thread, Post):
+    signals.post_init.connect(remember_counted, sender=model)
+    signals.post_save.connect(counted_changed, sender=model)
+    signals.post_delete.connect(counted_changed, sender=model)
+    signals.post_save.connect(listing_changed, sender=model)
+    signals.post_delete.connect(listing_changed, sender=model)
+
+    # after everything else has compared it to what was there before
+    signals.post_save.connect(remember_counted, sender=model)
+vcb.threads_moderated.connect(threads_moderated, sender=Thread)
+vcb.posts_deleted.connect(posts_deleted, sender=Post)
+vcb.object_shown.connect(mark_read, sender=Thread)
+signals.post_save.connect(forum_changed, sender=Forum)
+signals.post_delete.connect(forum_changed, sender=Forum)
 signals.post_save.connect(only_one_default_group, sender=UserGroup)
+signals.post_delete.connect(group_deleted, sender=UserGroup)
+
+for matrix in (ForumPermission, GroupPermission, UserPermission):
+    signals.post_save.connect(permissions_changed, sender=matrix)
+    signals.post_delete.connect(permissions_changed, sender=matrix)
 
@@ -0,0 +1,19 @@
+from django.contrib.sites.models import Site
+from django.db.models import signals
+from vcboard import models as vcboard_app
+
+def save_setting_defaults(sender, verbosity=1, **kwargs):
+    """
+    Saves the defaults of the settings that have been asked for but never
+    saved, so they can be changed in the admin
+    """
+    try:
+        site = Site.objects.get_current()
+    except Site.DoesNotExist:
+        return
+
+    created = vcboard_app.Setting.objects.save_defaults(site)
+    if created and verbosity > 0:
+        print 'Saved the defaults of %i settings.' % len(created)
+
+signals.post_syncdb.connect(save_setting_defaults, sender=vcboard_app)
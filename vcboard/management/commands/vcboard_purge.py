@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from vcboard.counters import CHUNK_SIZE
+from vcboard.purge import purge_deleted, RETENTION_DAYS
+from datetime import datetime, timedelta
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=RETENTION_DAYS,
+            help='Only purge posts that were deleted at least this many days ago.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=CHUNK_SIZE,
+            help='How many posts to delete at a time.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only show how many posts would be purged, without deleting them.'),
+    )
+    help = 'Permanently deletes posts and threads that were deleted a while ago.'
+
+    def handle(self, *args, **options):
+        before = datetime.now() - timedelta(days=options.get('days'))
+        dry_run = options.get('dry_run')
+        verbosity = int(options.get('verbosity', 1))
+
+        totals = {'reply': 0, 'thread': 0}
+        for kind, count in purge_deleted(before, options.get('chunk_size'), dry_run):
+            totals[kind] += count
+            if verbosity > 1:
+                print 'Purged %i %s posts...' % (totals[kind], kind)
+
+        if verbosity > 0:
+            if dry_run:
+                print '%(reply)i replies and %(thread)i threads would be purged.' % totals
+            else:
+                print '%(reply)i replies and %(thread)i threads were purged.' % totals
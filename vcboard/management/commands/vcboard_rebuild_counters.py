@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from vcboard.counters import rebuild_counters, CHUNK_SIZE
+from datetime import datetime
+import time
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--incremental', dest='since', default=None,
+            help='Only recalculate threads and profiles with posts that changed since this time (YYYY-MM-DD or "YYYY-MM-DD HH:MM:SS").'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=CHUNK_SIZE,
+            help='How many threads or profiles to recalculate at a time.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only show the counters that are wrong, without fixing them.'),
+    )
+    help = 'Recalculates the thread, post and last post counters of threads, forums and forum profiles.'
+
+    def handle(self, *args, **options):
+        since = options.get('since')
+        if since:
+            for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+                try:
+                    since = datetime(*time.strptime(since, format)[:6])
+                    break
+                except ValueError:
+                    pass
+            else:
+                raise CommandError('Invalid timestamp: %s' % since)
+
+        dry_run = options.get('dry_run')
+        verbosity = int(options.get('verbosity', 1))
+        changes = 0
+        for model, pk, field, old, new in rebuild_counters(since, 
+                                              options.get('chunk_size'), dry_run):
+            changes += 1
+            if dry_run or verbosity > 1:
+                print '%s %s: %s %s -> %s' % (model, pk, field, old, new)
+
+        if verbosity > 0:
+            if dry_run:
+                print '%i counters are out of date.' % changes
+            else:
+                print '%i counters were fixed.' % changes
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from vcboard.counters import CHUNK_SIZE
+from vcboard.markup import render_markup
+from vcboard.models import Post
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=CHUNK_SIZE,
+            help='How many posts to render at a time.'),
+        make_option('--missing', action='store_true', dest='missing', default=False,
+            help='Only render posts that have no stored HTML yet.'),
+    )
+    help = 'Renders the markup of every post into the HTML that is stored with it.'
+
+    def handle(self, *args, **options):
+        chunk_size = options.get('chunk_size')
+        verbosity = int(options.get('verbosity', 1))
+
+        posts = Post.objects.all()
+        if options.get('missing'):
+            posts = posts.filter(content_html='')
+
+        last, rendered, changed = 0, 0, 0
+        while True:
+            chunk = list(posts.filter(pk__gt=last).order_by('pk') \
+                              .values_list('pk', 'content', 'content_html')[:chunk_size])
+            if not chunk:
+                break
+
+            for pk, content, content_html in chunk:
+                html = render_markup(content)
+                if html != content_html:
+                    # update() leaves date_updated alone
+                    Post.objects.filter(pk=pk).update(content_html=html)
+                    changed += 1
+            rendered += len(chunk)
+            last = chunk[-1][0]
+            if verbosity > 1:
+                print 'Rendered %i posts...' % rendered
+
+        if verbosity > 0:
+            print '%i posts were rendered, %i of them changed.' % (rendered, changed)
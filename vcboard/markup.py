@@ -0,0 +1,73 @@
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+import re
+
+TAG_RE = re.compile(r'\[(/?)(b|i|u|code|quote|url)(?:=([^\]]*)|\s+id="(\d+)")?\]',
+                    re.IGNORECASE)
+
+# links may only point at these schemes, so markup can't sneak in javascript:
+URL_RE = re.compile(r'^(https?|ftp)://[^\s"<>]+$', re.IGNORECASE)
+
+SIMPLE_TAGS = {
+    'b': ('<strong>', '</strong>'),
+    'i': ('<em>', '</em>'),
+    'u': ('<span class="underline">', '</span>'),
+    'code': ('<pre class="code">', '</pre>'),
+    'url': (None, '</a>'),
+    'quote': (None, '</blockquote>'),
+}
+
+def _open_tag(name, value, post_id):
+    """
+    Returns the HTML that starts a tag, or None if the tag isn't valid
+    """
+    if name == 'quote':
+        if post_id:
+            return '<blockquote class="quote" cite="#post-%s">' % post_id
+        return '<blockquote class="quote">'
+    elif name == 'url':
+        if value and URL_RE.match(value.strip()):
+            return '<a href="%s" rel="nofollow">' % escape(value.strip())
+        return None
+    elif value or post_id:
+        return None
+    return SIMPLE_TAGS[name][0]
+
+def render_markup(text):
+    """
+    Turns post content with BBCode-style markup, like the
+    [quote id="..."]...[/quote] that replies are started with, into safe HTML.
+    Everything else is escaped.  Tags that are left open are closed at the
+    end, and closing tags that don't match anything are left as they are.
+    """
+    output, stack, pos = [], [], 0
+    for match in TAG_RE.finditer(text):
+        output.append(escape(text[pos:match.start()]))
+        pos = match.end()
+
+        closing, name, value, post_id = match.groups()
+        name = name.lower()
+        if closing:
+            if name in stack:
+                while stack:
+                    tag = stack.pop()
+                    output.append(SIMPLE_TAGS[tag][1])
+                    if tag == name:
+                        break
+                continue
+        else:
+            html = _open_tag(name, value, post_id)
+            if html:
+                output.append(html)
+                stack.append(name)
+                continue
+
+        # not a tag we can do anything with
+        output.append(escape(match.group(0)))
+
+    output.append(escape(text[pos:]))
+    while stack:
+        output.append(SIMPLE_TAGS[stack.pop()][1])
+
+    html = ''.join(output).replace('\r\n', '\n').replace('\n', '<br />\n')
+    return mark_safe(html)
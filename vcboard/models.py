@@ -1,37 +1,102 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Count, F, Max, Q
 from django.contrib.auth.models import User, AnonymousUser, Group, Permission
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import mark_safe, timesince
 from django.utils.translation import ugettext_lazy as _
-from utils import unique_slug, PP
+from datetime import datetime
+from markup import render_markup
+from tree import forum_tree
+from utils import unique_slug, PP, SharedSnapshot, VERSION_TIMEOUT
+import time
+
+# how many recently read threads each read marker remembers
+MAX_READ_THREADS = getattr(settings, 'VCBOARD_READ_THREADS', 100)
+
+# the defaults of settings without a row, shared between processes
+DEFAULTS_KEY = 'vcboard_setting_defaults'
+
+class SettingSnapshot(SharedSnapshot):
+    """
+    Every setting for a site, loaded with one query and keyed on 
+    SECTION.KEY.  It is rebuilt whenever a setting is saved or deleted (see 
+    vcboard.listeners).
+    """
+
+    def build(self, site_id):
+        return dict(('%s.%s' % (s.section.upper(), s.key.upper()), s)
+                    for s in Setting.objects.filter(site__id=site_id))
+
+setting_snapshot = SettingSnapshot('settings')
 
 class SettingManager(models.Manager):
-    _cache = {}
+    def __init__(self):
+        super(SettingManager, self).__init__()
+        # the defaults this process has asked for, as (section, key, 
+        # primitive type, value) tuples
+        self._defaults = {}
 
-    def set(self, setting):
-        cache_key = '%s.%s' % (setting.section.upper(), setting.key.upper())
-        self._cache[cache_key] = setting
+    def invalidate(self):
+        setting_snapshot.invalidate()
 
     def __call__(self, section, key, primitive=str, default=''):
         section = section.upper()
         key = key.upper()
         cache_key = '%s.%s' % (section, key)
-        if not self._cache.has_key(cache_key):
-            if not isinstance(primitive, str):
-                primitive = primitive.__name__
-
-            value, created = Setting.objects.get_or_create(
-                                site=Site.objects.get_current(),
-                                section=section,
-                                key=key,
-                                primitive_type=primitive)
-            if created:
-                value.value = default
-                value.save()
-            self._cache[cache_key] = value
-
-        return self._cache[cache_key].evaluate()
+        if not isinstance(primitive, str):
+            primitive = primitive.__name__
+
+        found = setting_snapshot.get(Site.objects.get_current().id)
+        if found.has_key(cache_key):
+            return found[cache_key].evaluate()
+
+        # settings that have not been saved yet use their default, which is 
+        # only written to the database by save_defaults()
+        setting = Setting(section=section, key=key, primitive_type=primitive)
+        setting.set_value(default)
+        if not self._defaults.has_key(cache_key):
+            self._defaults[cache_key] = (section, key, primitive, setting.value)
+            self._share_defaults()
+        return setting.evaluate()
+
+    def _share_defaults(self):
+        """
+        Adds the defaults this process has asked for to the ones in the 
+        cache.  Everything is added each time, so a default that was lost to
+        another process updating the cache at the same time comes back.
+        """
+        shared = cache.get(DEFAULTS_KEY) or {}
+        shared.update(self._defaults)
+        cache.set(DEFAULTS_KEY, shared, VERSION_TIMEOUT)
+
+    def defaults(self):
+        """
+        Returns the defaults that any process has asked for, keyed on 
+        SECTION.KEY
+        """
+        defaults = cache.get(DEFAULTS_KEY) or {}
+        defaults.update(self._defaults)
+        return defaults
+
+    def save_defaults(self, site=None):
+        """
+        Saves the defaults of settings that have been asked for but have no 
+        row for the site yet, so they show up in the admin.  Returns the 
+        settings that were created.
+        """
+        site = site or Site.objects.get_current()
+        existing = set(Setting.objects.filter(site=site) \
+                              .values_list('section', 'key'))
+        created = []
+        for section, key, primitive, value in self.defaults().values():
+            if (section, key) in existing:
+                continue
+            created.append(Setting.objects.create(site=site, section=section,
+                                key=key, primitive_type=primitive, value=value))
+        return created
 
 class Setting(models.Model):
     PRIMITIVES = (
@@ -53,6 +118,14 @@ class Setting(models.Model):
     def __unicode__(self):
         return u'%s.%s' % (self.section, self.key)
 
+    def set_value(self, value):
+        """
+        Stores a Python value the way evaluate() reads it back
+        """
+        if self.primitive_type == 'bool':
+            value = value and '1' or '0'
+        self.value = unicode(value)
+
     def evaluate(self):
         cast = {
             'bool': bool,
@@ -105,10 +178,11 @@ class UserGroupManager(models.Manager):
         return self.get_query_set().filter(is_active=True, site=site)
 
     def default(self):
-        group, created = self.active().get_or_create(is_default=True)
-        if created:
-            group.name = 'Member'
-            group.save()
+        # the filters of active() aren't used when the group is created
+        site = Site.objects.get_current()
+        group, created = self.active().get_or_create(is_default=True, 
+                            is_active=True, site=site, 
+                            defaults={'name': 'Member'})
         return group
 
 class UserGroup(Group):
@@ -119,8 +193,6 @@ class UserGroup(Group):
     objects = UserGroupManager()
 
 class ForumManager(models.Manager):
-    _path_cache = {}
-
     def active(self):
         # retrieves all active forums for the current site
         site = Site.objects.get_current()
@@ -128,33 +200,152 @@ class ForumManager(models.Manager):
     
     def top_level(self):
         # retrieves all active, top-level forums
-        return self.active().filter(parent__isnull=True)
+        return self.get_query_set().filter(pk__in=forum_tree.child_ids())
 
     def with_path(self, path):
         """
         Finds a forum with the specified path, if any
         """
 
-        forum = None
-        if isinstance(path, str) or isinstance(path, unicode):
-            path_str = path
-            path = path.split('/')
-        else:
-            path_str = '/'.join(path)
+        if not isinstance(path, basestring):
+            path = '/'.join(path)
 
-        if not self._path_cache.has_key(path_str):
+        forum_id = forum_tree.find(path)
+        if forum_id:
             try:
-                for slug in path:
-                    if not forum:
-                        forum = self.top_level().get(slug=slug)
-                    else:
-                        forum = forum.children.active().get(slug=slug)
-            except Exception, ex:
-                print ex# pass
+                return self.get_query_set().get(pk=forum_id)
+            except self.model.DoesNotExist:
+                pass
 
-            self._path_cache[path_str] = forum
+        return None
+
+    def path(self, forum_id):
+        """
+        Returns the slug path of a forum, usually without a query
+        """
+        return forum_tree.path(forum_id) or self.get_query_set().get(pk=forum_id).path
+
+    def add_subforums(self, forums):
+        """
+        Loads the active subforums of several forums with one query, along 
+        with the last post in each subforum and its author.  The subforums are
+        available as forum.subforums.
+        """
+        forums = list(forums)
+        child_ids = dict((f.id, forum_tree.child_ids(f.id)) for f in forums)
+        ids = [cid for f in forums for cid in child_ids[f.id]]
+
+        found = self.get_query_set().filter(pk__in=ids) \
+                    .select_related('last_post', 'last_post__author').in_bulk(ids)
+        for forum in forums:
+            forum._subforums = [found[cid] for cid in child_ids[forum.id]
+                                if found.has_key(cid)]
+
+        Post.objects.add_forum_paths([f.last_post for f in found.values() 
+                                      if f.last_post_id])
+        return forums
+
+    def ancestor_ids(self, forum_id):
+        """
+        Returns the IDs of a forum and all of its parents, top of the tree 
+        first.  The forum tree usually knows them without a query.
+        """
+        ids = [f.id for f in forum_tree.hierarchy(forum_id)]
+        if not ids:
+            ids = self.get_query_set().get(pk=forum_id).ancestor_ids
+        return ids
+
+    def adjust_counters(self, deltas):
+        """
+        Applies changes in thread and post counts to forums and everything 
+        above them.  The deltas are (threads, posts) tuples keyed on forum ID.
+        Changes cancel out in the forums that are above more than one of the
+        forums, like the shared parents of the forums a thread is moved 
+        between, and forums that end up with the same change share an UPDATE.
+        """
+        totals = {}
+        for forum_id, (threads, posts) in deltas.items():
+            for fid in self.ancestor_ids(forum_id):
+                total = totals.setdefault(fid, [0, 0])
+                total[0] += threads
+                total[1] += posts
+
+        batches = {}
+        for fid, (threads, posts) in totals.items():
+            if threads or posts:
+                batches.setdefault((threads, posts), []).append(fid)
+
+        for (threads, posts), ids in batches.items():
+            self.get_query_set().filter(pk__in=ids) \
+                .update(thread_count=F('thread_count') + threads,
+                        post_count=F('post_count') + posts)
+        return batches
+
+    def refresh_last_posts(self, forum_ids, thread_ids):
+        """
+        Finds a new last post for each of the forums whose last post was in
+        one of the threads, which have been removed from the forums
+        """
+        stale = self.get_query_set().filter(pk__in=forum_ids) \
+                    .filter(Q(last_post__in=thread_ids) | 
+                            Q(last_post__parent__in=thread_ids)) \
+                    .values_list('pk', flat=True)
+        self.recalculate_last_posts(stale)
 
-        return self._path_cache[path_str]
+    def recalculate_last_posts(self, forum_ids):
+        """
+        Works out the last post of some forums again, with two queries per 
+        forum.  Only the posts themselves are trusted, not the last posts 
+        stored on the threads.
+        """
+        forums = self.get_query_set().filter(pk__in=list(forum_ids)) \
+                     .values_list('pk', 'tree_path')
+        for forum_id, tree_path in forums:
+            thread = Post.objects.last_post(Thread.objects.valid() \
+                            .filter(forum__tree_path__startswith=tree_path))
+            reply = Post.objects.last_post(Post.objects.valid() \
+                            .filter(parent__is_draft=False, parent__is_deleted=False,
+                                    parent__forum__tree_path__startswith=tree_path))
+            last = max(thread, reply)
+            self.get_query_set().filter(pk=forum_id).update(last_post=last and last[1])
+
+    def tree_paths(self):
+        """
+        Works out the materialized path of every forum from the parent 
+        pointers, without changing anything.  Returns the paths keyed on
+        forum ID.
+        """
+        forums = dict((f[0], f) for f in self.get_query_set().order_by() \
+                                .values_list('id', 'parent'))
+        paths = {}
+
+        def path_for(fid, seen=()):
+            if not paths.has_key(fid):
+                parent_id = forums[fid][1]
+                prefix = ''
+                if forums.has_key(parent_id) and parent_id not in seen:
+                    prefix = path_for(parent_id, seen + (fid,))
+                paths[fid] = '%s%i/' % (prefix, fid)
+            return paths[fid]
+
+        for fid in forums:
+            path_for(fid)
+        return paths
+
+    def rebuild_tree(self):
+        """
+        Recalculates the materialized path and depth of every forum from the
+        parent pointers.  This needs to happen whenever a forum is moved
+        beneath a different parent.  Only forums whose path changed are 
+        updated.
+        """
+        paths = self.tree_paths()
+        for fid, tree_path, depth in self.get_query_set().order_by() \
+                                         .values_list('id', 'tree_path', 'depth'):
+            path = paths[fid]
+            if path != tree_path or depth != path.count('/') - 1:
+                self.get_query_set().filter(pk=fid).update(tree_path=path,
+                                                depth=path.count('/') - 1)
 
 class Forum(models.Model):
     site = models.ManyToManyField(Site)
@@ -170,6 +361,8 @@ class Forum(models.Model):
     post_count = models.PositiveIntegerField(_('Posts'), default=0)
     last_post = models.ForeignKey('Post', null=True, related_name='last_forum_post')
     ordering = models.IntegerField(_('Ordering'), default=0)
+    tree_path = models.CharField(max_length=255, blank=True, editable=False, db_index=True, help_text=_('The IDs of this forum and its parents, such as "1/4/9/".'))
+    depth = models.PositiveIntegerField(default=0, editable=False)
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
@@ -192,12 +385,57 @@ class Forum(models.Model):
 
     def _get_hierarchy(self):
         if not self._hierarchy:
-            self._hierarchy = (self,)
-            if self.parent:
-                self._hierarchy = self.parent.hierarchy + self._hierarchy
+            # the parents come from the forum tree, which saves a query for
+            # each level.  They are snapshots, so don't save them.
+            ancestors = forum_tree.hierarchy(self.id)
+            if ancestors:
+                self._hierarchy = ancestors[:-1] + (self,)
+            elif self.tree_path:
+                self._hierarchy = tuple(self.ancestors()) + (self,)
+            else:
+                self._hierarchy = (self,)
+                if self.parent:
+                    self._hierarchy = self.parent.hierarchy + self._hierarchy
         return self._hierarchy
     hierarchy = property(_get_hierarchy)
 
+    def _get_subforums(self):
+        if not hasattr(self, '_subforums'):
+            Forum.objects.add_subforums([self])
+        return self._subforums
+    subforums = property(_get_subforums)
+
+    def _get_ancestor_ids(self):
+        """
+        The IDs of this forum and all of its parents, top of the tree first
+        """
+        if self.tree_path:
+            return [int(fid) for fid in self.tree_path.split('/') if fid]
+        return [f.id for f in self.hierarchy]
+    ancestor_ids = property(_get_ancestor_ids)
+
+    def ancestors(self, include_self=False):
+        """
+        Retrieves the parents of this forum with one query
+        """
+        ids = self.ancestor_ids
+        if not include_self:
+            ids = ids[:-1]
+        return Forum.objects.filter(pk__in=ids).order_by('depth')
+
+    def descendants(self, include_self=False):
+        """
+        Retrieves all forums beneath this one with one query
+        """
+        if not self.tree_path:
+            Forum.objects.rebuild_tree()
+            self.tree_path = Forum.objects.get(pk=self.id).tree_path
+
+        forums = Forum.objects.filter(tree_path__startswith=self.tree_path)
+        if not include_self:
+            forums = forums.exclude(pk=self.id)
+        return forums
+
     def _get_last_post_info(self):
         if self.last_post:
             params = (
@@ -220,6 +458,22 @@ class Forum(models.Model):
 
         super(Forum, self).save(*args, **kwargs)
 
+        # keep the materialized path up to date
+        old_path = self.tree_path
+        if self.parent and not self.parent.tree_path:
+            # the paths have never been calculated
+            Forum.objects.rebuild_tree()
+            self.parent = Forum.objects.get(pk=self.parent_id)
+
+        self.tree_path = '%s%i/' % (self.parent and self.parent.tree_path or '', self.id)
+        self.depth = self.tree_path.count('/') - 1
+        if self.tree_path != old_path:
+            Forum.objects.filter(pk=self.id).update(tree_path=self.tree_path,
+                                                    depth=self.depth)
+            if old_path:
+                # the forum was moved, so everything beneath it moves too
+                Forum.objects.rebuild_tree()
+
     class Meta:
         ordering = ('parent__id', 'ordering', 'name')
         unique_together = ('parent', 'slug')
@@ -229,11 +483,140 @@ class PostManager(models.Manager):
         # retrieves posts that are not drafts or deleted
         return self.get_query_set().filter(is_draft=False, is_deleted=False)
 
+    def add_forum_paths(self, posts):
+        """
+        Works out the forum paths of many posts at once, so their URLs can be
+        built without a query for each post
+        """
+        posts = [p for p in posts if not hasattr(p, '_forum_path')]
+        threads = [p for p in posts if isinstance(p, Thread)]
+        replies = [p for p in posts if not isinstance(p, Thread)]
+
+        forum_ids = dict((t.id, t.forum_id) for t in threads)
+        if replies:
+            thread_ids = [p.parent_id or p.id for p in replies]
+            forum_ids.update(Thread.objects.filter(pk__in=thread_ids) \
+                                           .values_list('pk', 'forum'))
+
+        for post in posts:
+            forum_id = forum_ids.get(post.id, None) or \
+                       forum_ids.get(post.parent_id, None)
+            post._forum_path = forum_id and Forum.objects.path(forum_id)
+
+    def last_post(self, posts):
+        """
+        Finds the last of some posts.  Posts are ordered by date and then by
+        ID, like the listings, everywhere a last post is worked out.  Returns
+        the (date_created, id) of the post, or None when there are no posts.
+        """
+        rows = list(posts.order_by('-date_created', '-id') \
+                         .values_list('date_created', 'id')[:1])
+        return rows and rows[0] or None
+
+    def last_posts(self, posts, field):
+        """
+        Finds the last post for each value of a field among some posts, such
+        as 'parent' for the last reply of each thread, with two queries.  
+        Returns the (date_created, id) of each post keyed on the values.
+        """
+        dates = posts.order_by().values_list(field).annotate(Max('date_created'))
+        newer = None
+        for value, date in dates:
+            q = Q(**{field: value, 'date_created__gte': date})
+            newer = newer is None and q or newer | q
+        if newer is None:
+            return {}
+
+        found = {}
+        for value, date, pk in posts.filter(newer).order_by() \
+                                    .values_list(field, 'date_created', 'id'):
+            found[value] = max(found.get(value, None), (date, pk))
+        return found
+
+    def before(self, field, post):
+        """
+        Builds a filter that matches the rows whose last post, in the field,
+        comes before a post or is missing
+        """
+        return Q(**{'%s__isnull' % field: True}) | \
+               Q(**{'%s__date_created__lt' % field: post.date_created}) | \
+               Q(**{'%s__date_created' % field: post.date_created,
+                    '%s__lt' % field: post.id})
+
+    def newest(self):
+        """
+        Returns the ID of the newest post and of the thread it belongs to, or
+        (None, None) when there are no posts.  The archive and the purge 
+        leave that thread alone, because SQLite and some versions of MySQL 
+        hand out IDs from the highest one that is left in the table, and 
+        archived or purged posts must never see their IDs used again.
+        """
+        rows = self.get_query_set().order_by('-id').values_list('id', 'parent')[:1]
+        if not rows:
+            return None, None
+        pk, parent_id = rows[0]
+        return pk, parent_id or pk
+
+    def soft_delete(self, post_ids):
+        """
+        Marks many replies as deleted at once and takes them out of the 
+        counters of their threads, forums and authors, in one transaction.  
+        Threads and forums whose last post was deleted get a new one.  
+        Returns the number of replies deleted.
+        """
+        from vcboard.counters import rebuild_thread_counters
+        from vcboard.signals import posts_deleted
+
+        replies = self.get_query_set().filter(pk__in=list(post_ids), 
+                                              parent__isnull=False, 
+                                              is_deleted=False)
+        rows = list(replies.values_list('pk', 'parent', 'parent__forum', 'author', 
+                        'is_draft', 'parent__is_draft', 'parent__is_deleted'))
+        if not rows:
+            return 0
+        ids = [r[0] for r in rows]
+
+        # update() leaves date_updated alone, but the purge goes by it
+        self.get_query_set().filter(pk__in=ids) \
+            .update(is_deleted=True, date_updated=datetime.now())
+
+        deltas, authors = {}, {}
+        for pk, thread_id, forum_id, author_id, is_draft, thread_draft, \
+                thread_deleted in rows:
+            if is_draft:
+                continue
+            if not (thread_draft or thread_deleted):
+                delta = deltas.setdefault(forum_id, [0, 0])
+                delta[1] -= 1
+            if author_id:
+                authors[author_id] = authors.get(author_id, 0) + 1
+        Forum.objects.adjust_counters(deltas)
+
+        batches = {}
+        for author_id, count in authors.items():
+            batches.setdefault(count, []).append(author_id)
+        for count, users in batches.items():
+            ForumProfile.objects.filter(user__in=users) \
+                .update(post_count=F('post_count') - count)
+
+        # the reply counts and last posts are counted again from the replies
+        # that are left
+        thread_ids = list(set(r[1] for r in rows))
+        list(rebuild_thread_counters(thread_ids))
+        Forum.objects.recalculate_last_posts(
+                Forum.objects.filter(last_post__in=ids).values_list('pk', flat=True))
+
+        posts_deleted.send(sender=Post, post_ids=ids, thread_ids=thread_ids,
+                           forum_ids=list(set(r[2] for r in rows)))
+        return len(ids)
+    soft_delete = transaction.commit_on_success(soft_delete)
+
 class Post(models.Model):
     parent = models.ForeignKey('Thread', blank=True, null=True, related_name='posts')
     author = models.ForeignKey(User, blank=True, null=True, related_name='posts')
     subject = models.CharField(_('Subject'), max_length=100)
     content = models.TextField(_('Content'))
+    content_html = models.TextField(blank=True, editable=False)
     rating = models.FloatField(_('Rating'), default=0.0)
     is_draft = models.BooleanField(_('Is Incomplete'), blank=True, default=False, help_text=_('The post will not appear online when this is checked.'))
     is_deleted = models.BooleanField(_('Is Deleted'), editable=False)
@@ -246,10 +629,32 @@ class Post(models.Model):
     def __unicode__(self):
         return self.subject
 
+    def save(self, *args, **kwargs):
+        # the markup is only turned into HTML when the post is written
+        self.content_html = render_markup(self.content)
+        super(Post, self).save(*args, **kwargs)
+
     def get_absolute_url(self):
-        return ('vcboard-show-post', [self.forum.path, self.id])
+        return ('vcboard-show-post', [self.forum_path, self.id])
     get_absolute_url = models.permalink(get_absolute_url)
 
+    def _get_forum_path(self):
+        if not hasattr(self, '_forum_path'):
+            Post.objects.add_forum_paths([self])
+        return self._forum_path
+    forum_path = property(_get_forum_path)
+
+    def _get_html(self):
+        """
+        The content of the post as HTML.  Posts that were written before the
+        HTML was stored are rendered once and saved.
+        """
+        if self.content and not self.content_html:
+            self.content_html = render_markup(self.content)
+            Post.objects.filter(pk=self.id).update(content_html=self.content_html)
+        return mark_safe(self.content_html)
+    html = property(_get_html)
+
     def _get_post_date_info(self):
         params = (
             self.date_created.strftime('%d %b %y at %H:%M:%S'),
@@ -301,6 +706,163 @@ class Post(models.Model):
     class Meta:
         ordering = ('date_created',)
 
+class ThreadManager(models.Manager):
+    def valid(self):
+        # retrieves threads that are not drafts or deleted
+        return self.get_query_set().filter(is_draft=False, is_deleted=False)
+
+    def listing(self, forum):
+        """
+        Retrieves the threads in a forum along with their authors and last 
+        posts, so a page of threads can be displayed with a single query
+        """
+        return self.valid().filter(forum=forum) \
+                   .select_related('author', '_last_post', '_last_post__author')
+
+    def _moderate(self, action, thread_ids, **values):
+        """
+        Updates some threads with one UPDATE for the thread table and one for
+        the post table, and lets everything else know through the 
+        threads_moderated signal.  Returns the (id, forum ID, author ID, 
+        counted) tuple of each thread, from before the update.
+        """
+        from vcboard.signals import threads_moderated
+
+        threads = self.get_query_set().filter(pk__in=list(thread_ids))
+        rows = [(pk, forum_id, author_id, not (is_draft or is_deleted))
+                for pk, forum_id, author_id, is_draft, is_deleted in 
+                threads.values_list('pk', 'forum', 'author', 'is_draft', 'is_deleted')]
+        if rows:
+            # update() leaves date_updated alone, but pages use it to tell 
+            # whether the thread changed
+            self.get_query_set().filter(pk__in=[r[0] for r in rows]) \
+                .update(date_updated=datetime.now(), **values)
+            threads_moderated.send(sender=Thread, action=action,
+                                   thread_ids=[r[0] for r in rows],
+                                   forum_ids=list(set(r[1] for r in rows)),
+                                   values=values)
+        return rows
+
+    def close(self, thread_ids):
+        """
+        Closes many threads at once.  Returns the number of threads closed.
+        """
+        return len(self._moderate('close', thread_ids, is_closed=True))
+
+    def reopen(self, thread_ids):
+        """
+        Opens many threads at once.  Returns the number of threads opened.
+        """
+        return len(self._moderate('open', thread_ids, is_closed=False))
+
+    def stick(self, thread_ids, is_sticky=True):
+        """
+        Makes many threads sticky at once, or takes away their stickiness.
+        Returns the number of threads changed.
+        """
+        return len(self._moderate('sticky', thread_ids, is_sticky=is_sticky))
+
+    def soft_delete(self, thread_ids):
+        """
+        Marks many threads as deleted at once and takes them and their 
+        replies out of the counters of their forums and authors, in one 
+        transaction.  Returns the number of threads deleted.
+        """
+        ids = list(self.get_query_set().filter(pk__in=list(thread_ids), 
+                                               is_deleted=False) \
+                                       .values_list('pk', flat=True))
+        rows = self._moderate('delete', ids, is_deleted=True)
+        counted = [r for r in rows if r[3]]
+        if counted:
+            counted_ids = [r[0] for r in counted]
+            replies = dict(Post.objects.valid().filter(parent__in=counted_ids) \
+                               .order_by().values_list('parent') \
+                               .annotate(Count('id')))
+
+            deltas, authors = {}, {}
+            for pk, forum_id, author_id, is_counted in counted:
+                delta = deltas.setdefault(forum_id, [0, 0])
+                delta[0] -= 1
+                delta[1] -= 1 + replies.get(pk, 0)
+                if author_id:
+                    authors[author_id] = authors.get(author_id, 0) + 1
+
+            Forum.objects.adjust_counters(deltas)
+            Forum.objects.refresh_last_posts(
+                    set(fid for f in deltas for fid in Forum.objects.ancestor_ids(f)), 
+                    counted_ids)
+
+            # the replies of deleted threads still count for their authors,
+            # just like when the counters are rebuilt
+            batches = {}
+            for author_id, count in authors.items():
+                batches.setdefault(count, []).append(author_id)
+            for count, users in batches.items():
+                ForumProfile.objects.filter(user__in=users) \
+                    .update(thread_count=F('thread_count') - count,
+                            post_count=F('post_count') - count)
+        return len(rows)
+    soft_delete = transaction.commit_on_success(soft_delete)
+
+    def move(self, thread_ids, forum):
+        """
+        Moves many threads into another forum at once.  The counters are only
+        changed for the forums that aren't above both the old forum and the
+        new one, and everything happens in one transaction.  Returns the 
+        number of threads moved.
+        """
+        ids = list(self.get_query_set().filter(pk__in=list(thread_ids)) \
+                                       .exclude(forum=forum) \
+                                       .values_list('pk', flat=True))
+        rows = self._moderate('move', ids, forum=forum)
+        counted = [r for r in rows if r[3]]
+        if counted:
+            counted_ids = [r[0] for r in counted]
+            replies = dict(Post.objects.valid().filter(parent__in=counted_ids) \
+                               .order_by().values_list('parent') \
+                               .annotate(Count('id')))
+
+            deltas = {forum.id: [0, 0]}
+            for pk, forum_id, author_id, is_counted in counted:
+                posts = 1 + replies.get(pk, 0)
+                for fid, sign in ((forum_id, -1), (forum.id, 1)):
+                    delta = deltas.setdefault(fid, [0, 0])
+                    delta[0] += sign
+                    delta[1] += sign * posts
+
+            Forum.objects.adjust_counters(deltas)
+
+            # forums that no longer have the threads need a new last post...
+            keep = set(Forum.objects.ancestor_ids(forum.id))
+            left = set(fid for f in deltas for fid in Forum.objects.ancestor_ids(f))
+            Forum.objects.refresh_last_posts(left - keep, counted_ids)
+
+            # ... and the new forum may have one
+            last = max(Post.objects.last_post(self.get_query_set() \
+                                                  .filter(pk__in=counted_ids)),
+                       Post.objects.last_post(Post.objects.valid() \
+                                                  .filter(parent__in=counted_ids)))
+            newest = Post.objects.get(pk=last[1])
+            Forum.objects.filter(pk__in=keep) \
+                 .filter(Post.objects.before('last_post', newest)) \
+                 .update(last_post=newest)
+        return len(rows)
+    move = transaction.commit_on_success(move)
+
+    def attach_forum(self, threads, forum):
+        """
+        Hands the forum that was used to list some threads down to each 
+        thread, so the threads don't have to look it up again
+        """
+        threads = list(threads)
+        path = forum.path
+        for thread in threads:
+            thread._forum_cache = forum
+            thread._forum_path = path
+            if thread._last_post_id:
+                thread._last_post._forum_path = path
+        return threads
+
 class Thread(Post):
     forum = models.ForeignKey(Forum, related_name='threads')
     reply_count = models.PositiveIntegerField(_('Replies'), default=0)
@@ -309,6 +871,8 @@ class Thread(Post):
     is_closed = models.BooleanField(_('Is Closed'), blank=True, default=False, help_text=_('Threads cannot be replied to once closed.'))
     _last_post = models.ForeignKey(Post, null=True, related_name='last_thread_post')
 
+    objects = ThreadManager()
+
     def __unicode__(self):
         return self.subject
 
@@ -327,7 +891,7 @@ class Thread(Post):
     last_post_info = property(_get_last_post_info)
 
     def get_absolute_url(self):
-        return ('vcboard-show-thread', [self.forum.path, self.id])
+        return ('vcboard-show-thread', [self.forum_path, self.id])
     get_absolute_url = models.permalink(get_absolute_url)
 
     class Meta:
@@ -357,6 +921,129 @@ class ForumWatch(Watch):
 class ThreadWatch(Watch):
     thread = models.ForeignKey(Thread, related_name='watching_users')
 
+class ReadMarkerManager(models.Manager):
+    def for_user(self, user):
+        """
+        Loads all of a user's read markers with one query, keyed on forum ID.
+        They are remembered on the user object for the rest of the request.
+        """
+        if not hasattr(user, '_read_markers'):
+            if user.is_authenticated():
+                markers = self.get_query_set().filter(user=user)
+                user._read_markers = dict((m.forum_id, m) for m in markers)
+            else:
+                user._read_markers = {}
+        return user._read_markers
+
+    def get_marker(self, user, forum_id):
+        """
+        Returns a user's read marker for a forum.  Users who have never read
+        anything in a forum have read everything posted before they joined.
+        """
+        markers = self.for_user(user)
+        if not markers.has_key(forum_id):
+            markers[forum_id] = ReadMarker(user=user, forum_id=forum_id,
+                                           read_until=user.date_joined)
+        return markers[forum_id]
+
+    def has_unread(self, user, obj):
+        """
+        Determines whether a forum or thread has posts the user hasn't read
+        """
+        if not user.is_authenticated() or not obj.last_post:
+            return False
+
+        if isinstance(obj, Thread):
+            marker = self.get_marker(user, obj.forum_id)
+            return marker.read_at(obj.id) < obj.last_post.date_created
+        else:
+            # a forum is unread until its newest post has been read
+            last_post = obj.last_post
+            marker = self.get_marker(user, obj.id)
+            thread_id = last_post.parent_id or last_post.id
+            return marker.read_until < last_post.date_created and \
+                   marker.read_at(thread_id, False) < last_post.date_created
+
+    def mark_thread_read(self, user, thread, when=None):
+        """
+        Records that a user has read a thread.  Nothing is written unless 
+        there is something new in the thread.
+        """
+        if not user.is_authenticated():
+            return
+        marker = self.get_marker(user, thread.forum_id)
+        if marker.read_at(thread.id) < thread.last_post.date_created:
+            marker.mark_thread(thread.id, when or datetime.now())
+            marker.save()
+
+    def mark_forum_read(self, user, forum, when=None):
+        """
+        Records that a user has read everything in a forum
+        """
+        if not user.is_authenticated():
+            return
+        marker = self.get_marker(user, forum.id)
+        marker.read_until = when or datetime.now()
+        marker.set_threads({})
+        marker.save()
+
+class ReadMarker(models.Model):
+    """
+    Keeps track of what a user has read in a forum.  Everything posted 
+    before read_until has been read.  Threads read since then are kept in a 
+    compact list of "thread:timestamp" pairs, which only holds the 
+    MAX_READ_THREADS most recently read threads.
+    """
+    user = models.ForeignKey(User, related_name='read_markers')
+    forum = models.ForeignKey(Forum, related_name='read_markers')
+    read_until = models.DateTimeField()
+    threads = models.TextField(blank=True)
+
+    objects = ReadMarkerManager()
+
+    class Meta:
+        unique_together = ('user', 'forum')
+
+    def get_threads(self):
+        """
+        Returns the threads read since read_until, as a dictionary of 
+        timestamps keyed on thread ID
+        """
+        if not hasattr(self, '_threads'):
+            self._threads = {}
+            for pair in self.threads.split(','):
+                if pair:
+                    thread_id, stamp = pair.split(':')
+                    self._threads[int(thread_id)] = int(stamp)
+        return self._threads
+
+    def set_threads(self, threads):
+        watermark = _timestamp(self.read_until)
+        newest = sorted([(s, t) for t, s in threads.items() if s > watermark])
+        newest = newest[-MAX_READ_THREADS:]
+        self._threads = dict((t, s) for s, t in newest)
+        self.threads = ','.join(['%i:%i' % (t, s) for s, t in newest])
+
+    def read_at(self, thread_id, default=True):
+        """
+        Returns the time a user last read a thread.  Unless default is False,
+        threads that haven't been read since read_until count as read then.
+        """
+        stamp = self.get_threads().get(thread_id, None)
+        if stamp is not None:
+            seconds, micro = divmod(stamp, 1000000)
+            return datetime.fromtimestamp(seconds).replace(microsecond=micro)
+        return default and self.read_until or datetime.min
+
+    def mark_thread(self, thread_id, when):
+        threads = self.get_threads().copy()
+        threads[thread_id] = _timestamp(when)
+        self.set_threads(threads)
+
+def _timestamp(value):
+    # microseconds since the epoch
+    return int(time.mktime(value.timetuple())) * 1000000 + value.microsecond
+
 class PermissionMatrix(models.Model):
     site = models.ForeignKey(Site, default=Site.objects.get_current)
     forum = models.ForeignKey(Forum)
@@ -384,6 +1071,46 @@ class UserPermission(PermissionMatrix):
     class Meta:
         unique_together = (('site','forum','user','permission',),)
 
+class ForumProfileManager(models.Manager):
+    def create_for(self, user):
+        """
+        Creates the profile of a new user, in the default group
+        """
+        return self.create(user=user, group=UserGroup.objects.default())
+
+    def for_users(self, users):
+        """
+        Loads the profiles of many users at once, along with their groups, and
+        remembers each profile on its user for the rest of the request.  Other
+        apps can load more for the same profiles through the profiles_loaded 
+        signal, which is how the ranks extension adds ranks.  Returns a 
+        dictionary of profiles keyed on user id.
+        """
+        by_id = {}
+        for user in users:
+            if user and user.id and not hasattr(user, '_profile'):
+                by_id.setdefault(user.id, []).append(user)
+
+        loaded = []
+        if by_id:
+            for profile in self.select_related('group').filter(user__in=by_id.keys()):
+                for user in by_id.pop(profile.user_id):
+                    user._profile = profile
+                profile._user_cache = user
+                loaded.append(profile)
+
+            # users from before profiles were created with the user
+            for same in by_id.values():
+                profile = get_profile(same[0])
+                for user in same[1:]:
+                    user._profile = profile
+
+        if loaded:
+            from vcboard.signals import profiles_loaded
+            profiles_loaded.send(sender=ForumProfile, profiles=loaded)
+
+        return dict((u.id, u._profile) for u in users if u and u.id)
+
 class ForumProfile(models.Model):
     user = models.OneToOneField(User)
     group = models.ForeignKey(UserGroup, null=True, related_name='members')
@@ -392,12 +1119,25 @@ class ForumProfile(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
+    objects = ForumProfileManager()
+
 def get_profile(user):
+    """
+    Retrieves a user's profile, which is created along with the user (see
+    vcboard.listeners).  Users from before that get theirs the first time 
+    it is needed.
+    """
     if not hasattr(user, '_profile'):
-        user._profile = ForumProfile.objects.get_or_create(user=user)[0]
-        if not user._profile.group:
-            user._profile.group = UserGroup.objects.default()
-            user._profile.save()
+        try:
+            profile = ForumProfile.objects.select_related('group').get(user=user)
+        except ForumProfile.DoesNotExist:
+            profile = ForumProfile.objects.create_for(user)
+        else:
+            if not profile.group_id:
+                profile.group = UserGroup.objects.default()
+                profile.save()
+        profile._user_cache = user
+        user._profile = profile
     return user._profile
 User.forumprofile = property(get_profile)
 AnonymousUser.forumprofile = ForumProfile()
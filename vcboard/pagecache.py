@@ -0,0 +1,162 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+from vcboard.pagination import PAGES_VERSION
+from vcboard.tree import forum_tree
+from vcboard.utils import cache_versions, bump_cache_version, \
+                          get_user_permissions, http_validators, TIMEOUT
+
+# caching pages for anonymous users is opt-in
+ENABLED = getattr(settings, 'VCBOARD_ANONYMOUS_CACHE', False)
+CACHE_TIMEOUT = getattr(settings, 'VCBOARD_ANONYMOUS_CACHE_TIMEOUT', TIMEOUT)
+
+# bumped for anything that appears on every page, like the forum tree
+ALL_VERSION = 'vcboard_pc_version'
+FORUM_VERSION = 'vcboard_pc_version_f%i'
+THREAD_VERSION = 'vcboard_pc_version_t%i'
+
+def is_cacheable(request):
+    """
+    Determines whether pages for this request may come from the cache
+    """
+    return ENABLED and request.method == 'GET' and \
+           not request.user.is_authenticated()
+
+def permission_hash(user, forum):
+    """
+    Sums up the permissions a user has in a forum, so users that may do
+    different things never share a cached page
+    """
+    perms = get_user_permissions(user, forum)
+    granted = ','.join(sorted([p for p, v in perms.items() if v]))
+    return md5_constructor(granted).hexdigest()[:12]
+
+def page_key(request, forum, thread=None, page=1):
+    """
+    Returns the cache key for a page of a forum or thread, or None if the page
+    should not be cached.  The key changes whenever anything shown on the page
+    is saved (see vcboard.listeners).
+    """
+    if not is_cacheable(request):
+        return None
+
+    names = [ALL_VERSION, FORUM_VERSION % forum.id]
+    if thread:
+        names.append(THREAD_VERSION % thread.id)
+    versions = cache_versions(names)
+
+    parts = [forum.id, thread and thread.id or 0, page,
+             permission_hash(request.user, forum)]
+    parts.extend([versions[n] for n in names])
+    return 'vcboard_page_%s' % '_'.join([str(p) for p in parts])
+
+def _last_post_date(post_id):
+    from vcboard.models import Post
+    dates = list(Post.objects.filter(pk=post_id).values_list('date_created', flat=True))
+    return dates and dates[0] or None
+
+def forum_validators(request, forum, page=1):
+    """
+    Returns the ETag and Last-Modified values for a page of a forum.  They
+    only use counters and cache versions that change whenever the page does,
+    so they can be worked out without building the page.
+    """
+    versions = cache_versions([forum_tree.version_key, 
+                               PAGES_VERSION % ('f%i' % forum.id)])
+    parts = ['forum', forum.id, page, request.user.id or 0,
+             permission_hash(request.user, forum), forum.date_updated,
+             forum.last_post_id, forum.thread_count, forum.post_count]
+    parts.extend(sorted(versions.values()))
+
+    # the unread markers of the forum and its subforums change as the user
+    # reads
+    from vcboard.models import ReadMarker
+    markers = ReadMarker.objects.for_user(request.user)
+    for forum_id in sorted(markers.keys()):
+        parts.extend([forum_id, markers[forum_id].read_until, 
+                      markers[forum_id].threads])
+
+    last_modified = forum.date_updated
+    if forum.last_post_id:
+        last_modified = max(last_modified, _last_post_date(forum.last_post_id))
+    return http_validators(parts, last_modified)
+
+def thread_validators(request, forum, thread, page=1):
+    """
+    Returns the ETag and Last-Modified values for a page of a thread
+    """
+    versions = cache_versions([forum_tree.version_key,
+                               PAGES_VERSION % ('t%i' % thread.id)])
+    parts = ['thread', thread.id, page, request.user.id or 0,
+             permission_hash(request.user, forum), thread.date_updated,
+             thread._last_post_id, thread.reply_count]
+    parts.extend(sorted(versions.values()))
+
+    last_modified = thread.date_updated
+    if thread._last_post_id and thread._last_post_id != thread.id:
+        last_modified = max(last_modified, _last_post_date(thread._last_post_id))
+    return http_validators(parts, last_modified)
+
+def get_page(key):
+    """
+    Returns the cached response for a page key, if there is one
+    """
+    if key:
+        return cache.get(key)
+    return None
+
+def set_page(key, response):
+    """
+    Caches the response for a page key
+    """
+    if key and response.status_code == 200:
+        cache.set(key, response, CACHE_TIMEOUT)
+
+def fragment_key(name, forum, user, values):
+    """
+    Returns the cache key for a piece of a page.  The values should change
+    whenever the piece does, like a post's date_updated.
+    """
+    parts = [str(v) for v in values]
+    parts.append(permission_hash(user, forum))
+    parts.append(str(cache_versions([ALL_VERSION])[ALL_VERSION]))
+    return 'vcboard_fragment_%s_%s' % (name, md5_constructor(':'.join(parts)).hexdigest())
+
+def invalidate_thread(thread_id, forum_id=None):
+    """
+    Throws away the cached pages of a thread and of the forums that show it,
+    which includes the parents of its forum because they show the last post
+    """
+    if not ENABLED:
+        return
+
+    from vcboard.models import Thread
+    if forum_id is None:
+        forum_ids = list(Thread.objects.filter(pk=thread_id) \
+                                       .values_list('forum', flat=True))
+        forum_id = forum_ids and forum_ids[0] or None
+    invalidate_threads([thread_id], forum_id and [forum_id] or [])
+
+def invalidate_threads(thread_ids, forum_ids):
+    """
+    Throws away the cached pages of many threads and of the forums that show
+    them.  Each forum is only invalidated once.
+    """
+    if not ENABLED:
+        return
+
+    from vcboard.models import Forum
+    for thread_id in thread_ids:
+        bump_cache_version(THREAD_VERSION % thread_id)
+    forums = set()
+    for forum_id in forum_ids:
+        forums.update(Forum.objects.ancestor_ids(forum_id))
+    for fid in forums:
+        bump_cache_version(FORUM_VERSION % fid)
+
+def invalidate_all():
+    """
+    Throws away every cached page and fragment
+    """
+    if ENABLED:
+        bump_cache_version(ALL_VERSION)
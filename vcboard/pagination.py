@@ -0,0 +1,206 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator, Page
+from django.db.models import Q
+from vcboard.counters import is_stale
+from vcboard.utils import cache_version, bump_cache_version, TIMEOUT
+from bisect import bisect_right
+
+# whether forum and thread pages are found by seeking from a cursor instead
+# of with OFFSET
+SEEK_PAGINATION = getattr(settings, 'VCBOARD_SEEK_PAGINATION', True)
+
+# the orderings that listings are paginated by; the last field must be unique
+THREAD_ORDERING = ('-is_sticky', '-date_created', '-id')
+POST_ORDERING = ('date_created', 'id')
+
+PAGES_VERSION = 'vcboard_pages_version_%s'
+
+def invalidate_pages(name):
+    """
+    Throws away the page index of a listing, such as 'f2' for the threads in
+    forum 2 or 't10' for the replies in thread 10
+    """
+    bump_cache_version(PAGES_VERSION % name)
+
+def index_key(name, per_page):
+    """
+    Returns the cache key for the page index of a listing
+    """
+    version = cache_version(PAGES_VERSION % name)
+    return 'vcboard_pages_%s_%i_%s' % (name, per_page, version)
+
+def extend_pages(name, per_page, row, count):
+    """
+    Adds a row to the end of the cached page index of a listing that only 
+    grows at the end, like the replies in a thread, so the index doesn't 
+    have to be built again.  The count is the number of rows in the listing
+    with the new one.  An index that doesn't agree with it has missed a 
+    change and is thrown away instead.
+    """
+    key = index_key(name, per_page)
+    index = cache.get(key)
+    if index is None:
+        return
+
+    if index['count'] + 1 != count:
+        invalidate_pages(name)
+        return
+
+    if index['count'] % per_page == 0:
+        index['cursors'].append(row)
+    index['count'] = count
+    cache.set(key, index, TIMEOUT)
+
+class CountedPaginator(Paginator):
+    """
+    A paginator that can be told how many objects there are, so it doesn't
+    have to COUNT them.  When the count is None it counts them as usual.
+    """
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        self._count = count
+
+class SeekPaginator(CountedPaginator):
+    """
+    Paginates a queryset by seeking from the first row of each page rather
+    than with OFFSET, which gets slower the further into a listing you go.
+    The cursor for each page comes from a page index, which is built with a
+    single pass over the ordering columns and cached until the listing
+    changes (see invalidate_pages).  The pages it returns are the same Page
+    objects that django.core.paginator uses, so templates don't know the
+    difference.
+
+    The first page starts at the top of the listing, so it never needs the
+    index when the number of rows is already known.
+    """
+
+    def __init__(self, object_list, per_page, ordering, name, count=None,
+                 allow_empty_first_page=True):
+        super(SeekPaginator, self).__init__(object_list, per_page, count,
+                        allow_empty_first_page=allow_empty_first_page)
+        self.ordering = ordering
+        self.name = name
+        self._index = None
+
+    def _get_index(self):
+        """
+        Returns a dictionary with the number of rows in the listing and the
+        ordering values of the first row on each page
+        """
+        if self._index is None:
+            key = index_key(self.name, self.per_page)
+            self._index = cache.get(key)
+
+            if self._index is None:
+                fields = [f.lstrip('-') for f in self.ordering]
+                rows = self.object_list.order_by(*self.ordering) \
+                                       .values_list(*fields)
+
+                cursors, count = [], 0
+                for row in rows.iterator():
+                    if count % self.per_page == 0:
+                        cursors.append(row)
+                    count += 1
+
+                self._index = {'count': count, 'cursors': cursors}
+                cache.set(key, self._index, TIMEOUT)
+
+        return self._index
+    index = property(_get_index)
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = self.index['count']
+        return self._count
+    count = property(_get_count)
+
+    def seek(self, cursor):
+        """
+        Builds a filter that matches the row at the cursor and every row that
+        comes after it.  The row is identified by the last (unique) value of
+        the cursor, and the other values are read back from it by the 
+        database.  Values like timestamps don't always survive the trip 
+        through Python unchanged (SQLite timestamps can lose a microsecond),
+        and a cursor that is off by a little skips rows.
+        """
+        row = self.object_list.model._default_manager.filter(
+                    **{self.ordering[-1].lstrip('-'): cursor[-1]})
+        seek, equal = Q(), Q()
+        for i, (field, value) in enumerate(zip(self.ordering, cursor)):
+            name = field.lstrip('-')
+            if i < len(cursor) - 1:
+                value = row.values(name)
+            lookup = field.startswith('-') and 'lt' or 'gt'
+            seek |= equal & Q(**{'%s__%s' % (name, lookup): value})
+            equal &= Q(**{name: value})
+        return seek | equal
+
+    def page(self, number):
+        number = self.validate_number(number)
+        object_list = self.object_list.order_by(*self.ordering)
+        if number > 1:
+            cursors = self.index['cursors']
+            if number > len(cursors):
+                # the counters promised more pages than there are
+                return Page([], number, self)
+            object_list = object_list.filter(self.seek(cursors[number - 1]))
+
+        return Page(object_list[:self.per_page], number, self)
+
+def thread_count(forum):
+    """
+    Works out how many threads are directly within a forum from the 
+    denormalized counters, which include the threads in subforums.  Returns
+    None if the counters have been flagged as stale.
+    """
+    if is_stale('f%i' % forum.id):
+        return None
+
+    from vcboard.models import Forum
+    children = Forum.objects.filter(parent=forum).values_list('thread_count', flat=True)
+    return max(0, forum.thread_count - sum(children))
+
+def reply_count(thread):
+    """
+    Returns the number of replies in a thread, or None if the reply count has
+    been flagged as stale
+    """
+    if is_stale('t%i' % thread.id):
+        return None
+    return thread.reply_count
+
+def thread_paginator(forum, threads, per_page):
+    """
+    Paginates the threads in a forum, stickies first and newest first
+    """
+    count = thread_count(forum)
+    if SEEK_PAGINATION:
+        return SeekPaginator(threads, per_page, THREAD_ORDERING, 
+                             'f%i' % forum.id, count)
+    return CountedPaginator(threads.order_by(*THREAD_ORDERING), per_page, count)
+
+def post_paginator(thread, posts, per_page):
+    """
+    Paginates the replies in a thread, oldest first
+    """
+    count = reply_count(thread)
+    if SEEK_PAGINATION:
+        return SeekPaginator(posts, per_page, POST_ORDERING, 
+                             't%i' % thread.id, count)
+    return CountedPaginator(posts.order_by(*POST_ORDERING), per_page, count)
+
+def post_page(thread, post, per_page):
+    """
+    Works out which page of a thread a reply is on.  With seek pagination the
+    thread's page index already knows where every page starts.
+    """
+    posts = thread.posts.valid()
+    if SEEK_PAGINATION:
+        cursors = post_paginator(thread, posts, per_page).index['cursors']
+        return max(1, bisect_right(cursors, (post.date_created, post.id)))
+
+    before = posts.filter(Q(date_created__lt=post.date_created) |
+                          Q(date_created=post.date_created, id__lt=post.id))
+    return before.count() // per_page + 1
@@ -0,0 +1,110 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q
+from vcboard.counters import rebuild_thread_counters, CHUNK_SIZE
+from datetime import datetime, timedelta
+
+# how many days soft-deleted posts are kept before they can be purged
+RETENTION_DAYS = getattr(settings, 'VCBOARD_PURGE_AFTER_DAYS', 30)
+
+def purgeable_replies(before):
+    """
+    Retrieves the replies that were deleted before a point in time, along
+    with every reply in threads that were deleted before then.  The newest
+    post always stays, so its ID is never handed out again.
+    """
+    from vcboard.models import Post
+    newest, thread_id = Post.objects.newest()
+    return Post.objects.filter(parent__isnull=False) \
+               .filter(Q(is_deleted=True, date_updated__lt=before) |
+                       Q(parent__is_deleted=True, parent__date_updated__lt=before)) \
+               .exclude(pk=newest)
+
+def purgeable_threads(before):
+    """
+    Retrieves the threads that were deleted before a point in time, except
+    the one with the newest post
+    """
+    from vcboard.models import Post
+    newest, thread_id = Post.objects.newest()
+    return Post.objects.filter(parent__isnull=True, is_deleted=True,
+                               date_updated__lt=before).exclude(pk=thread_id)
+
+def purge_posts(ids):
+    """
+    Hard-deletes a batch of posts, along with their ratings, watches and
+    attachments, in one transaction.  Returns the names of the attachment
+    files that belonged to the posts, which should be deleted once the
+    transaction is committed.
+    """
+    from vcboard.models import Forum, Thread, Post, Rating, ThreadWatch, ForumProfile
+
+    ids = list(ids)
+    posts = Post.objects.filter(pk__in=ids)
+    thread_ids = list(Thread.objects.filter(pk__in=ids).values_list('pk', flat=True))
+    parent_ids = set(posts.filter(parent__isnull=False) \
+                          .values_list('parent', flat=True)) - set(thread_ids)
+
+    # replies in deleted threads still count for their authors
+    authors = posts.filter(is_draft=False, is_deleted=False, author__isnull=False) \
+                   .order_by().values_list('author').annotate(Count('id'))
+    batches = {}
+    for author_id, count in authors:
+        batches.setdefault(count, []).append(author_id)
+    for count, users in batches.items():
+        ForumProfile.objects.filter(user__in=users) \
+                    .update(post_count=F('post_count') - count)
+
+    # Django deletes everything that points at a deleted row, even through
+    # nullable foreign keys, so no thread or forum may point at the posts
+    # anymore
+    Thread.objects.filter(_last_post__in=ids).update(_last_post=None)
+    forum_ids = list(Forum.objects.filter(last_post__in=ids) \
+                                  .values_list('pk', flat=True))
+    Forum.objects.filter(pk__in=forum_ids).update(last_post=None)
+
+    Rating.objects.filter(post__in=ids).delete()
+    ThreadWatch.objects.filter(thread__in=thread_ids).delete()
+    files = []
+    if 'vcboard.attachments' in settings.INSTALLED_APPS:
+        from vcboard.attachments.models import Attachment
+        attachments = Attachment.objects.filter(post__in=ids)
+        files = [name for name in attachments.values_list('file', flat=True) if name]
+        attachments.delete()
+
+    posts.delete()
+
+    # the threads and forums that are left get their last posts back
+    list(rebuild_thread_counters(parent_ids))
+    Forum.objects.recalculate_last_posts(forum_ids)
+    return files
+purge_posts = transaction.commit_on_success(purge_posts)
+
+def purge_deleted(before=None, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    Hard-deletes the posts and threads that were soft-deleted before a
+    point in time, RETENTION_DAYS ago unless another time is given.  Replies
+    go first, so deleting a thread never takes more than a batch of replies
+    with it.  Each batch is deleted in its own transaction, which keeps the
+    locks short.  Yields the kind ('reply' or 'thread') and size of each
+    batch.
+    """
+    from django.core.files.storage import default_storage
+
+    if before is None:
+        before = datetime.now() - timedelta(days=RETENTION_DAYS)
+
+    for kind, queryset in (('reply', purgeable_replies(before)),
+                           ('thread', purgeable_threads(before))):
+        last = 0
+        while True:
+            ids = list(queryset.filter(pk__gt=last).order_by('pk') \
+                               .values_list('pk', flat=True)[:chunk_size])
+            if not ids:
+                break
+            last = ids[-1]
+
+            if not dry_run:
+                for name in purge_posts(ids):
+                    default_storage.delete(name)
+            yield kind, len(ids)
@@ -1,5 +1,9 @@
 from django.contrib import admin
-from models import Rank, RankPermission
+from models import Rank, RankMember, RankPermission
+
+class RankMemberInline(admin.TabularInline):
+    model = RankMember
+    raw_id_fields = ('user',)
 
 class RankPermissionInline(admin.StackedInline):
     model = RankPermission
@@ -9,5 +13,6 @@ class RankAdmin(admin.ModelAdmin):
     search_fields = ('title',)
     list_filter = ('is_active', 'is_special')
     inlines = (
+        RankMemberInline,
         RankPermissionInline,
     )
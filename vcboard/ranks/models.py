@@ -1,7 +1,12 @@
 from django.db import models
+from django.db.models import signals
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
+from vcboard.listeners import permissions_changed, page_changed
 from vcboard.models import Forum, ForumProfile, PermissionMatrix
+from vcboard.signals import profiles_loaded
+from vcboard.utils import SharedSnapshot, invalidate_permissions
+from bisect import bisect_right
 
 class RankManager(models.Manager):
     def active(self):
@@ -10,7 +15,7 @@ class RankManager(models.Manager):
 class Rank(models.Model):
     title = models.CharField(max_length=50, default='Unknown')
     posts_required = models.PositiveIntegerField(default=0)
-    members = models.ManyToManyField(User, related_name='ranks')
+    members = models.ManyToManyField(User, through='RankMember', related_name='ranks')
     is_active = models.BooleanField(blank=True, default=True)
     is_special = models.BooleanField(blank=True, default=False)
     ordering = models.IntegerField(default=0)
@@ -22,24 +27,95 @@ class Rank(models.Model):
     class Meta:
         ordering = ('ordering', 'title')
 
+class RankMember(models.Model):
+    """
+    A user who was given a special rank.  This is the table the members of
+    a rank have always been kept in, so it can be queried like any other.
+    """
+    rank = models.ForeignKey(Rank)
+    user = models.ForeignKey(User)
+
+    class Meta:
+        db_table = 'ranks_rank_members'
+        unique_together = ('rank', 'user')
+
 class RankPermission(PermissionMatrix):
     rank = models.ForeignKey(Rank)
 
+class RankLadder(SharedSnapshot):
+    """
+    The active ranks that are earned by posting, sorted by the number of 
+    posts they require.  It is rebuilt whenever a rank is saved or deleted.
+    """
+
+    def build(self, key):
+        ranks = list(Rank.objects.active().filter(is_special=False) \
+                                 .order_by('posts_required', 'id'))
+        return {
+            'posts_required': [r.posts_required for r in ranks],
+            'ranks': ranks,
+        }
+
+    def find(self, post_count):
+        """
+        Returns the highest rank that a number of posts earns, if any
+        """
+        ladder = self.get()
+        i = bisect_right(ladder['posts_required'], post_count)
+        return i and ladder['ranks'][i - 1] or None
+
+rank_ladder = RankLadder('ranks')
+
+def rank_changed(sender, instance, **kwargs):
+    """
+    Rebuilds the ladder when a rank changes, which can change the ranks of 
+    any number of users and, with them, their permissions
+    """
+    rank_ladder.invalidate()
+    invalidate_permissions()
+
+signals.post_save.connect(rank_changed, sender=Rank)
+signals.post_delete.connect(rank_changed, sender=Rank)
+signals.post_save.connect(page_changed, sender=Rank)
+signals.post_delete.connect(page_changed, sender=Rank)
+signals.post_save.connect(permissions_changed, sender=RankPermission)
+signals.post_delete.connect(permissions_changed, sender=RankPermission)
+signals.post_save.connect(page_changed, sender=RankPermission)
+signals.post_delete.connect(page_changed, sender=RankPermission)
+signals.post_save.connect(page_changed, sender=RankMember)
+signals.post_delete.connect(page_changed, sender=RankMember)
+
+def add_ranks(sender, profiles, **kwargs):
+    """
+    Works out the ranks of many profiles at once.  The special ranks their
+    users were given come from one query, and the ranks earned by posting 
+    come from the ladder.
+    """
+    profiles = [p for p in profiles if not hasattr(p, '_rank')]
+    if not profiles:
+        return
+
+    # a user's special ranks, in the usual rank order
+    special = {}
+    members = RankMember.objects.filter(user__in=[p.user_id for p in profiles]) \
+                        .select_related('rank') \
+                        .order_by(*['rank__%s' % f for f in Rank._meta.ordering])
+    for member in members:
+        special.setdefault(member.user_id, member.rank)
+
+    for profile in profiles:
+        rank = special.get(profile.user_id, None)
+        if rank is None:
+            rank = rank_ladder.find(profile.post_count) or Rank()
+        profile._rank = rank
+
 def get_rank(forumprofile):
     """
     Determines a user's rank
     """
     if not hasattr(forumprofile, '_rank'):
-        if forumprofile.user.ranks.count():
-            rank = forumprofile.user.ranks.all()[0]
-        else:
-            try:
-                qs = Rank.objects.active().filter(is_special=False)
-                qs = qs.filter(posts_required__lte=forumprofile.post_count)
-                rank = qs.order_by('-posts_required')[0]
-            except IndexError:
-                rank = Rank()
-        forumprofile._rank = rank
+        add_ranks(ForumProfile, [forumprofile])
     return forumprofile._rank
 ForumProfile.rank = property(get_rank)
 
+profiles_loaded.connect(add_ranks, sender=ForumProfile)
@@ -0,0 +1,2 @@
+-- permissions are looked up by forum, permission and rank
+CREATE INDEX vcboard_rankpermission_lookup ON ranks_rankpermission (forum_id, permission_id, rank_id);
@@ -0,0 +1,108 @@
+from django.conf import settings
+from django.contrib.auth.models import User, Permission
+from django.test import TestCase
+from vcboard.models import Forum, ForumProfile
+from vcboard.ranks.models import Rank, RankMember, RankPermission, rank_ladder
+from vcboard.tests import count_queries, query_plan, uses_index
+from vcboard.utils import PP, get_user_permissions, invalidate_permissions, \
+                          permissions_query
+
+class RankTester(TestCase):
+
+    def setUp(self):
+        rank_ladder.invalidate()
+        self.newbie = Rank.objects.create(title='Newbie', posts_required=0)
+        self.regular = Rank.objects.create(title='Regular', posts_required=10)
+        self.special = Rank.objects.create(title='Moderator', is_special=True)
+        self.users = [User.objects.create_user('user%i' % i, 'user%i@example.com' % i,
+                                               'password') for i in range(4)]
+        ForumProfile.objects.filter(user=self.users[1]).update(post_count=15)
+        RankMember.objects.create(rank=self.special, user=self.users[2])
+
+    def testBulkRanks(self):
+        # ranks come along with the profiles, without a query per user
+        users = [User.objects.get(pk=u.id) for u in self.users]
+        queries, profiles = count_queries(ForumProfile.objects.for_users, users)
+        self.assertTrue(queries <= 3)
+
+        queries, titles = count_queries(lambda: [u.forumprofile.rank.title for u in users])
+        self.assertEquals(0, queries)
+        self.assertEquals(['Newbie', 'Regular', 'Moderator', 'Newbie'], titles)
+
+    def testSingleRank(self):
+        # ranks still work for profiles that were loaded on their own
+        user = User.objects.get(pk=self.users[2].id)
+        self.assertEquals('Moderator', user.forumprofile.rank.title)
+        user = User.objects.get(pk=self.users[1].id)
+        self.assertEquals('Regular', user.forumprofile.rank.title)
+
+    def testLadder(self):
+        # ranks are found by the posts they require, from memory
+        Rank.objects.create(title='Veteran', posts_required=100)
+        Rank.objects.create(title='Retired', posts_required=50, is_active=False)
+        rank_ladder.get()
+
+        def titles():
+            return [(rank_ladder.find(c) or Rank()).title for c in (0, 9, 10, 99, 100, 5000)]
+        queries, found = count_queries(titles)
+        self.assertEquals(0, queries)
+        self.assertEquals(['Newbie', 'Newbie', 'Regular', 'Regular', 'Veteran', 
+                           'Veteran'], found)
+
+    def testLadderInvalidated(self):
+        # saving a rank changes the ladder right away
+        self.assertEquals('Regular', rank_ladder.find(20).title)
+        self.regular.posts_required = 25
+        self.regular.save()
+        self.assertEquals('Newbie', rank_ladder.find(20).title)
+        self.regular.delete()
+        self.assertEquals('Newbie', rank_ladder.find(30).title)
+
+    def testRankQueries(self):
+        # once the ladder is built, ranks only cost the special rank lookup
+        rank_ladder.get()
+        users = [User.objects.get(pk=u.id) for u in self.users]
+        queries, profiles = count_queries(ForumProfile.objects.for_users, users)
+        self.assertEquals(2, queries)
+
+        # permissions go through the same path for the current user
+        user = User.objects.get(pk=self.users[1].id)
+        user.forumprofile
+        queries, rank = count_queries(lambda: user.forumprofile.rank)
+        self.assertEquals(1, queries)
+        self.assertEquals('Regular', rank.title)
+
+class RankIndexTester(TestCase):
+    # EXPLAIN makes SQLite commit, so this test doesn't write anything
+
+    def testPermissionQuery(self):
+        # rank permissions are joined (as m1) through an index
+        if settings.DATABASE_ENGINE != 'sqlite3':
+            return
+
+        user = User(id=1)
+        user._profile = ForumProfile(user=user, group_id=1)
+        user._profile._rank = Rank(id=1)
+        plan = query_plan(*permissions_query(user, [1]))
+        self.assertTrue(uses_index(plan, 'm1', 'vcboard_rankpermission_lookup'), plan)
+
+class RankPermissionTester(TestCase):
+    fixtures = ('vcboard',)
+
+    def setUp(self):
+        rank_ladder.invalidate()
+        invalidate_permissions()
+        self.ann = Forum.objects.get(pk=2)
+        self.regular = Rank.objects.create(title='Regular', posts_required=10)
+        self.user = User.objects.create_user('poster', 'poster@example.com', 'password')
+
+    def testEarnedRank(self):
+        # users who earn a rank get its permissions right away
+        perm = Permission.objects.get(codename=PP('start_threads'))
+        RankPermission.objects.create(forum=self.ann, rank=self.regular, 
+                                      permission=perm, has_permission=True)
+        self.assertFalse(get_user_permissions(self.user, self.ann)['start_threads'])
+
+        ForumProfile.objects.filter(user=self.user).update(post_count=10)
+        user = User.objects.get(pk=self.user.id)
+        self.assertTrue(get_user_permissions(user, self.ann)['start_threads'])
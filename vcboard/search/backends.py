@@ -0,0 +1,163 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.utils.importlib import import_module
+from vcboard.models import Thread
+from vcboard.search.models import SearchToken
+import re
+
+# the class that does the indexing and searching
+BACKEND = getattr(settings, 'VCBOARD_SEARCH_BACKEND',
+                  'vcboard.search.backends.DatabaseBackend')
+
+# the most results a single search will return
+MAX_RESULTS = getattr(settings, 'VCBOARD_SEARCH_MAX_RESULTS', 500)
+
+# words in a subject count this many times as much as words in the content
+SUBJECT_WEIGHT = 5
+
+MIN_LENGTH = 2
+MAX_LENGTH = 30
+
+# how many posts to delete from the index with each statement
+BATCH_SIZE = 500
+
+MARKUP_RE = re.compile(r'\[/?\w+[^\]]*\]')
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    """
+    Splits text into lowercase words, ignoring markup like [quote id="1"]
+    """
+    words = WORD_RE.findall(MARKUP_RE.sub(' ', text.lower()))
+    return [w[:MAX_LENGTH] for w in words if len(w) >= MIN_LENGTH]
+
+class SearchBackend(object):
+    """
+    The interface that search backends implement.  Backends are handed posts
+    as they are saved and deleted, and return the IDs of matching posts when
+    searched.  Set VCBOARD_SEARCH_BACKEND to the path of a subclass to use
+    something other than the database.
+    """
+
+    def update(self, posts):
+        """
+        Adds posts to the index, replacing anything already indexed for them.
+        Drafts and deleted posts are taken out of the index.
+        """
+        raise NotImplementedError
+
+    def remove(self, post_ids):
+        """
+        Takes posts out of the index
+        """
+        raise NotImplementedError
+
+    def move_thread(self, thread_id, forum_id):
+        """
+        Records that a thread and its replies are now in another forum
+        """
+        raise NotImplementedError
+
+    def move_threads(self, thread_ids, forum_id):
+        """
+        Records that several threads and their replies are now in another 
+        forum
+        """
+        for thread_id in thread_ids:
+            self.move_thread(thread_id, forum_id)
+
+    def search(self, query, forum_ids, limit=MAX_RESULTS):
+        """
+        Returns the IDs of the posts in the specified forums that contain
+        every word in the query, best matches first
+        """
+        raise NotImplementedError
+
+class DatabaseBackend(SearchBackend):
+    """
+    Keeps an inverted index of post words in the database (the SearchToken
+    model), so searching doesn't need anything else running
+    """
+
+    def update(self, posts):
+        posts = list(posts)
+        if not posts:
+            return
+
+        thread_ids = [p.parent_id or p.id for p in posts]
+        forums = dict(Thread.objects.filter(pk__in=thread_ids) \
+                                    .values_list('pk', 'forum'))
+
+        rows = []
+        for post in posts:
+            thread_id = post.parent_id or post.id
+            if post.is_draft or post.is_deleted or not forums.has_key(thread_id):
+                continue
+
+            weights = {}
+            for word in tokenize(post.subject):
+                weights[word] = weights.get(word, 0) + SUBJECT_WEIGHT
+            for word in tokenize(post.content):
+                weights[word] = weights.get(word, 0) + 1
+
+            rows.extend([(post.id, thread_id, forums[thread_id], word, weight)
+                         for word, weight in weights.items()])
+
+        self.remove([p.id for p in posts])
+        if rows:
+            qn = connection.ops.quote_name
+            columns = ('post_id', 'thread_id', 'forum_id', 'token', 'weight')
+            sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                        qn(SearchToken._meta.db_table),
+                        ', '.join([qn(c) for c in columns]),
+                        ', '.join(['%s'] * len(columns)))
+            connection.cursor().executemany(sql, rows)
+            transaction.commit_unless_managed()
+
+    def remove(self, post_ids):
+        post_ids = list(post_ids)
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        for i in range(0, len(post_ids), BATCH_SIZE):
+            batch = post_ids[i:i + BATCH_SIZE]
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                                qn(SearchToken._meta.db_table), qn('post_id'),
+                                ', '.join(['%s'] * len(batch))), batch)
+        transaction.commit_unless_managed()
+
+    def move_thread(self, thread_id, forum_id):
+        SearchToken.objects.filter(thread=thread_id).exclude(forum=forum_id) \
+                           .update(forum=forum_id)
+
+    def move_threads(self, thread_ids, forum_id):
+        SearchToken.objects.filter(thread__in=list(thread_ids)) \
+                           .exclude(forum=forum_id).update(forum=forum_id)
+
+    def search(self, query, forum_ids, limit=MAX_RESULTS):
+        terms = list(set(tokenize(query)))
+        forum_ids = list(forum_ids)
+        if not terms or not forum_ids:
+            return []
+
+        matches = SearchToken.objects.filter(token__in=terms,
+                                             forum__in=forum_ids,
+                                             thread__is_draft=False,
+                                             thread__is_deleted=False) \
+                             .order_by().values('post') \
+                             .annotate(hits=Count('id'), score=Sum('weight')) \
+                             .filter(hits=len(terms)) \
+                             .order_by('-score', '-post')
+        return [m['post'] for m in matches[:limit]]
+
+_backend = None
+
+def get_backend():
+    """
+    Returns the configured search backend
+    """
+    global _backend
+    if _backend is None:
+        module, name = BACKEND.rsplit('.', 1)
+        _backend = getattr(import_module(module), name)()
+    return _backend
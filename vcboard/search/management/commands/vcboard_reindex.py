@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from vcboard.models import Post
+from vcboard.search.backends import get_backend
+
+CHUNK_SIZE = 500
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=CHUNK_SIZE,
+            help='How many posts to index at a time.'),
+    )
+    help = 'Rebuilds the search index for every post, a chunk of posts at a time.'
+
+    def handle(self, *args, **options):
+        chunk_size = options.get('chunk_size')
+        verbosity = int(options.get('verbosity', 1))
+        backend = get_backend()
+
+        last, count = 0, 0
+        while True:
+            posts = list(Post.objects.filter(pk__gt=last).order_by('pk')[:chunk_size])
+            if not posts:
+                break
+
+            backend.update(posts)
+            last = posts[-1].id
+            count += len(posts)
+            if verbosity > 1:
+                print 'Indexed %i posts...' % count
+
+        if verbosity > 0:
+            print '%i posts were indexed.' % count
@@ -0,0 +1,58 @@
+from django.db import models
+from django.db.models import signals
+from vcboard.models import Forum, Thread, Post
+from vcboard.signals import threads_moderated, posts_deleted
+
+class SearchToken(models.Model):
+    """
+    One word of a post in the search index.  The thread and forum are copied
+    onto every token so results can be limited to the forums a user may see
+    without joining back to the posts.
+    """
+    post = models.ForeignKey(Post, related_name='search_tokens')
+    thread = models.ForeignKey(Thread, related_name='thread_search_tokens')
+    forum = models.ForeignKey(Forum, related_name='search_tokens')
+    token = models.CharField(max_length=30, db_index=True)
+    weight = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        unique_together = ('token', 'post')
+
+def post_changed(sender, instance, created, **kwargs):
+    """
+    Keeps the search index up to date as posts are written
+    """
+    from vcboard.search.backends import get_backend
+
+    backend = get_backend()
+    backend.update([instance])
+    if sender == Thread and not created:
+        backend.move_thread(instance.id, instance.forum_id)
+
+def post_removed(sender, instance, **kwargs):
+    """
+    Takes posts out of the search index when they are deleted
+    """
+    from vcboard.search.backends import get_backend
+    get_backend().remove([instance.id])
+
+def threads_moved(sender, action, thread_ids, values, **kwargs):
+    """
+    Keeps the search index up to date when threads are moved in bulk
+    """
+    if action == 'move':
+        from vcboard.search.backends import get_backend
+        get_backend().move_threads(thread_ids, values['forum'].id)
+
+def posts_hidden(sender, post_ids, **kwargs):
+    """
+    Takes replies that were deleted in bulk out of the search index
+    """
+    from vcboard.search.backends import get_backend
+    get_backend().remove(post_ids)
+
+threads_moderated.connect(threads_moved, sender=Thread)
+posts_deleted.connect(posts_hidden, sender=Post)
+for model in (Thread, Post):
+    signals.post_save.connect(post_changed, sender=model)
+    signals.post_delete.connect(post_removed, sender=model)
@@ -0,0 +1,97 @@
+from django.contrib.auth.models import Permission
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from django.test import TestCase
+from vcboard import config
+from vcboard.models import Forum, Thread, ForumPermission, Setting
+from vcboard.search.models import SearchToken
+from vcboard.tests import create_thread, create_reply
+from vcboard.tree import forum_tree
+from vcboard.utils import PP, invalidate_permissions
+
+class SearchTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        forum_tree.invalidate()
+        invalidate_permissions()
+        self.ann = Forum.objects.get(pk=2)
+        self.other = Forum.objects.get(pk=3)
+        for forum, allowed in ((self.ann, True), (self.other, False)):
+            for codename in ('view_forum', 'view_other_threads'):
+                perm = Permission.objects.get(codename=PP(codename))
+                ForumPermission.objects.create(forum=forum, permission=perm,
+                                               has_permission=allowed)
+
+        self.thread = create_thread(self.ann, 'Growing tomatoes',
+                                    content='Water the tomatoes daily')
+        self.reply = create_reply(self.thread, 'Re: Gardening tips',
+                                  content='[quote id="1"]Water[/quote] Tomatoes need sun')
+        self.hidden = create_thread(self.other, 'Secret tomatoes')
+
+    def search(self, query):
+        response = self.client.get('/search/', {'q': query})
+        self.assertEquals(200, response.status_code)
+        return [p.id for p in response.context[0]['page'].object_list]
+
+    def testSearch(self):
+        # every word has to match, and subjects count for more
+        self.assertEquals([self.thread.id, self.reply.id], self.search('tomatoes'))
+        self.assertEquals([self.reply.id], self.search('tomatoes sun'))
+        self.assertEquals([], self.search('quote'))
+        self.assertEquals([], self.search('potatoes'))
+
+    def testResultLinks(self):
+        # each result links to the page of its thread that shows it
+        Setting.objects.create(site=Site.objects.get_current(), section='THREAD',
+                               key='POSTS_PER_PAGE', primitive_type='int', value='2')
+        for i in range(3):
+            create_reply(self.thread, 'Filler %i' % i)
+        last = create_reply(self.thread, 'Cucumbers', content='Cucumbers climb')
+        try:
+            response = self.client.get('/search/', {'q': 'cucumbers'})
+            url = response.context[0]['page'].object_list[0].result_url
+            self.assertEquals('%spage/3/' % self.thread.get_absolute_url(), url)
+            self.assertContains(self.client.get(url), 'Cucumbers climb')
+
+            url = self.client.get('/search/', {'q': 'daily'}) \
+                             .context[0]['page'].object_list[0].result_url
+            self.assertEquals(self.thread.get_absolute_url(), url)
+        finally:
+            config.invalidate()
+
+    def testIncrementalUpdates(self):
+        # edits, drafts and deletions are picked up as they happen
+        self.reply.content = 'Potatoes need sun'
+        self.reply.save()
+        self.assertEquals([self.reply.id], self.search('potatoes'))
+
+        create_reply(self.thread, 'Draft', content='Potatoes', is_draft=True)
+        self.assertEquals([self.reply.id], self.search('potatoes'))
+
+        self.reply.delete()
+        self.assertEquals([], self.search('potatoes'))
+
+    def testPermissions(self):
+        # posts in forums the user can't see are left out, until they move
+        self.assertEquals([], self.search('secret'))
+        self.hidden.forum = self.ann
+        self.hidden.save()
+        self.assertEquals([self.hidden.id], self.search('secret'))
+
+    def testBulkModeration(self):
+        # threads moved or deleted in bulk follow along in the results
+        Thread.objects.move([self.thread.id], self.other)
+        self.assertEquals([], self.search('tomatoes'))
+        Thread.objects.move([self.thread.id, self.hidden.id], self.ann)
+        self.assertEquals([self.hidden.id], self.search('secret'))
+        Thread.objects.soft_delete([self.hidden.id])
+        self.assertEquals([], self.search('secret'))
+
+    def testReindex(self):
+        # the reindex command rebuilds the index from scratch
+        SearchToken.objects.all().delete()
+        self.assertEquals([], self.search('tomatoes'))
+        call_command('vcboard_reindex', chunk_size=1, verbosity=0)
+        self.assertEquals([self.thread.id, self.reply.id], self.search('tomatoes'))
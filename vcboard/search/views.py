@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.contrib.auth.decorators import permission_required
+from django.core.paginator import Paginator, InvalidPage
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from vcboard import config
+from vcboard.models import Forum, Thread, Post
+from vcboard.pagination import post_page
+from vcboard.search.backends import get_backend
+from vcboard.utils import render, get_user_permissions_bulk
+
+def searchable_forums(user):
+    """
+    Returns the IDs of the active forums in which a user may view the
+    threads of others
+    """
+    forums = list(Forum.objects.active())
+    perms = get_user_permissions_bulk(user, forums)
+    return [f.id for f in forums if perms[f.id].get('view_forum', False) and
+                                    perms[f.id].get('view_other_threads', False)]
+
+def search(request, template='vcboard/search_results.html'):
+    """
+    Searches the posts in every forum the user is allowed to see
+    """
+    query = request.GET.get('q', '').strip()
+    ids = []
+    if query:
+        ids = get_backend().search(query, searchable_forums(request.user))
+
+    paginator = Paginator(ids, config('thread', 'posts_per_page', int, 20))
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except InvalidPage:
+        raise Http404
+
+    found = Post.objects.in_bulk(page.object_list)
+    page.object_list = [found[pk] for pk in page.object_list if found.has_key(pk)]
+    Post.objects.add_forum_paths(page.object_list)
+
+    # results link to the page of the thread that shows them
+    threads = Thread.objects.in_bulk([p.parent_id for p in page.object_list 
+                                                  if p.parent_id])
+    per_page = config('thread', 'posts_per_page', int, 20)
+    for post in page.object_list:
+        args = [post.forum_path, post.parent_id or post.id]
+        number = 1
+        if threads.has_key(post.parent_id):
+            number = post_page(threads[post.parent_id], post, per_page)
+        if number > 1:
+            post.result_url = reverse('vcboard-show-thread-page', args=args + [number])
+        else:
+            post.result_url = reverse('vcboard-show-thread', args=args)
+
+    data = {
+        'query': query,
+        'paginator': paginator,
+        'page': page,
+    }
+    return render(request, template, data)
+
+if getattr(settings, 'VCBOARD_LOGIN_REQUIRED', False):
+    search = permission_required('vcboard.search_posts')(search)
@@ -2,3 +2,6 @@ import django.dispatch
 
 thread_created = django.dispatch.Signal(providing_args=('instance', 'request'))
 object_shown = django.dispatch.Signal(providing_args=('instance', 'request'))
+profiles_loaded = django.dispatch.Signal(providing_args=('profiles',))
+threads_moderated = django.dispatch.Signal(providing_args=('action', 'thread_ids', 'forum_ids', 'values'))
+posts_deleted = django.dispatch.Signal(providing_args=('post_ids', 'thread_ids', 'forum_ids'))
@@ -0,0 +1,2 @@
+-- replies are listed by thread, without drafts or deleted posts, oldest first
+CREATE INDEX vcboard_post_listing ON vcboard_post (parent_id, is_draft, is_deleted, date_created);
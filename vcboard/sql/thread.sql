@@ -0,0 +1,2 @@
+-- threads are listed by forum, stickies first
+CREATE INDEX vcboard_thread_listing ON vcboard_thread (forum_id, is_sticky);
@@ -1,8 +1,9 @@
 from django import template
 from django.contrib.auth.models import Permission
-from vcboard.models import Forum, Thread
+from django.core.cache import cache
+from vcboard import pagecache
+from vcboard.models import ReadMarker
 from vcboard.utils import get_user_permissions
-from datetime import datetime
 try:
     set
 except NameError:
@@ -28,16 +29,11 @@ class HasUnreadInNode(template.Node):
 
     def render(self, context):
         obj = self.obj.resolve(context)
-        sess = context.get('session', None)
-        now = datetime.now()
-
-        if sess and obj.last_post:
-            if isinstance(obj, Thread):
-                key = 'last_in_t%i' % obj.id
-            elif isinstance(obj, Forum):
-                key = 'last_in_f%i' % obj.id
+        user = context.get('user', None)
 
-            context[self.variable] = sess.get(key, now) < obj.last_post.date_created
+        # all of the user's read markers are loaded with the first lookup
+        context[self.variable] = bool(user) and \
+                                 ReadMarker.objects.has_unread(user, obj)
         return ''
 
 @register.tag
@@ -75,3 +71,41 @@ def get_forum_perms(parser, token):
         raise template.TemplateSyntaxError('get_forum_perms syntax: {% get_forum_perms forum as perms %}')
     tag, forum, a, variable = bits
     return GetPermsNode(forum, variable)
+
+class CacheFragmentNode(template.Node):
+    def __init__(self, nodelist, name, values):
+        self.nodelist = nodelist
+        self.name = name
+        self.values = values
+
+    def render(self, context):
+        user = context.get('user', None)
+        forum = context.get('forum', None)
+        if not pagecache.ENABLED or not forum or not user or \
+                user.is_authenticated():
+            return self.nodelist.render(context)
+
+        # values that can't be looked up, like those of a guest's post, are None
+        values = [v.resolve(context, True) for v in self.values]
+        key = pagecache.fragment_key(self.name, forum, user, values)
+        html = cache.get(key)
+        if html is None:
+            html = self.nodelist.render(context)
+            cache.set(key, html, pagecache.CACHE_TIMEOUT)
+        return html
+
+@register.tag
+def cache_fragment(parser, token):
+    """
+    Caches a piece of a page for anonymous users when page caching is 
+    enabled.  The values after the name should change whenever the piece 
+    does.
+    """
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError('cache_fragment syntax: {% cache_fragment name value [value ...] %}')
+
+    nodelist = parser.parse(('endcache_fragment',))
+    parser.delete_first_token()
+    values = [parser.compile_filter(v) for v in bits[2:]]
+    return CacheFragmentNode(nodelist, bits[1], values)
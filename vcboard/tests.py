@@ -1,13 +1,80 @@
+from django.conf import settings
+from django.contrib.auth.models import User, Permission
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
-from vcboard.models import Forum, Thread, Post
+from datetime import datetime
+from django.core.paginator import Paginator
+from vcboard import config
+from vcboard.counters import view_counter, rebuild_counters, is_stale
+from vcboard.markup import render_markup
+from vcboard import pagecache
+from vcboard.pagination import SeekPaginator, THREAD_ORDERING, POST_ORDERING, \
+                               thread_paginator, post_paginator
+from vcboard.tree import forum_tree
+from vcboard.models import Forum, Thread, Post, UserGroup, ForumPermission, \
+                           GroupPermission, UserPermission, ForumProfile, \
+                           ReadMarker, Setting, SettingSnapshot, Rating, \
+                           ThreadWatch, SettingManager, get_profile
+from vcboard.utils import PP, get_user_permissions, get_user_permissions_bulk, \
+                          invalidate_permissions, permissions_query
+import re
 
 def authorize(case, username):
     case.client.login(username, 'password')
 
+def count_queries(func, *args, **kwargs):
+    """
+    Calls a function and returns the number of queries it ran, along with its
+    return value
+    """
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    connection.queries = []
+    try:
+        value = func(*args, **kwargs)
+        return len(connection.queries), value
+    finally:
+        settings.DEBUG = debug
+
+def query_plan(sql, params):
+    """
+    Returns the steps SQLite plans to take to run a query
+    """
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+def uses_index(plan, table, index=None):
+    """
+    Determines whether every step of a query plan that reads a table (or 
+    table alias) uses an index, and the specified index if one is given
+    """
+    steps = [step for step in plan if re.search(r'\b%s\b' % table, step)]
+    if not steps:
+        return False
+    for step in steps:
+        if 'INDEX' not in step and 'PRIMARY KEY' not in step:
+            return False
+    return not index or bool([step for step in steps if index in step])
+
+def create_thread(forum, subject='Test Thread', **kwargs):
+    kwargs.setdefault('content', subject)
+    kwargs.setdefault('ip_address', '127.0.0.1')
+    kwargs.setdefault('is_sticky', False)
+    return Thread.objects.create(forum=forum, subject=subject, **kwargs)
+
+def create_reply(thread, subject='Test Reply', **kwargs):
+    kwargs.setdefault('content', subject)
+    kwargs.setdefault('ip_address', '127.0.0.1')
+    return Post.objects.create(parent=thread, subject=subject, **kwargs)
+
 class ForumTester(TestCase):
     fixtures = ('vcboard',)
 
     def setUp(self):
+        forum_tree.invalidate()
         self.ann = Forum.objects.get(pk=2)
 
     def testForumPaths(self):
@@ -34,6 +101,31 @@ class ForumTester(TestCase):
         match = Forum.objects.with_path('main-forum-category/helpful-hints')
         self.assertEquals(helpful.id, match.id)
 
+        self.assertEquals(None, Forum.objects.with_path('main-forum-category/nothing'))
+
+    def testForumTree(self):
+        # makes sure paths resolve from memory and follow changes to forums
+        Forum.objects.with_path('main-forum-category/announcements')
+        count, match = count_queries(Forum.objects.with_path, 
+                                     'main-forum-category/announcements')
+        self.assertEquals(1, count)
+
+        count, hierarchy = count_queries(lambda: match.hierarchy)
+        self.assertEquals(0, count)
+        self.assertEquals([1, 2], [f.id for f in hierarchy])
+
+        self.ann.slug = 'news'
+        self.ann.save()
+        self.assertEquals(None, Forum.objects.with_path('main-forum-category/announcements'))
+        match = Forum.objects.with_path('main-forum-category/news')
+        self.assertEquals(self.ann.id, match.id)
+        self.assertEquals('main-forum-category/news', match.path)
+
+        self.ann.is_active = False
+        self.ann.save()
+        self.assertEquals(None, Forum.objects.with_path('main-forum-category/news'))
+        self.assertEquals([3], [f.id for f in Forum.objects.get(pk=1).children.active()])
+
 class ThreadTester(TestCase):
     fixtures = ('vcboard',)
     urls = 'vcboard.urls'
@@ -59,7 +151,1063 @@ class ThreadTester(TestCase):
 
     def testMoveThread(self):
         # makes sure that post counts are updated when a thread is moved
-        self.fail()
+        forum_tree.invalidate()
+        invalidate_permissions()
+        hints = Forum.objects.get(pk=3)
+        perm = Permission.objects.get(codename=PP('start_threads'))
+        ForumPermission.objects.create(forum=hints, permission=perm, 
+                                       has_permission=True)
+        user = User.objects.create_user('mover', 'mover@example.com', 'password')
+        older = create_thread(self.ann, 'Older')
+        thread = create_thread(self.ann, 'Moving', author=user)
+        create_reply(thread)
+        create_reply(thread)
+
+        self.client.login(username='mover', password='password')
+        url = '/forum/main-forum-category/announcements/thread/%i/move/' % thread.id
+        response = self.client.post(url, {'move_to_forum': hints.id})
+        self.assertEquals(302, response.status_code)
+        self.assertTrue(response['Location'].endswith(
+                        '/forum/main-forum-category/helpful-hints/thread/%i/' % thread.id))
+
+        ann, hints, main = [Forum.objects.get(pk=pk) for pk in (2, 3, 1)]
+        self.assertEquals((1, 1, older.id), 
+                          (ann.thread_count, ann.post_count, ann.last_post_id))
+        self.assertEquals((1, 3), (hints.thread_count, hints.post_count))
+        self.assertEquals(Thread.objects.get(pk=thread.id).last_post.id, hints.last_post_id)
+        self.assertEquals((2, 4), (main.thread_count, main.post_count))
+        self.assertEquals([], list(rebuild_counters(dry_run=True)))
+
+class ForumPathTester(TestCase):
+    fixtures = ('vcboard',)
+
+    def setUp(self):
+        forum_tree.invalidate()
+        self.main = Forum.objects.get(pk=1)
+        self.ann = Forum.objects.get(pk=2)
+        self.helpful = Forum.objects.get(pk=3)
+
+    def testMaterializedPath(self):
+        # makes sure new forums know where they are in the tree
+        faq = Forum.objects.create(name='FAQ', parent=self.ann)
+        self.assertEquals('1/2/%i/' % faq.id, faq.tree_path)
+        self.assertEquals(2, faq.depth)
+        self.assertEquals([1, 2, faq.id], faq.ancestor_ids)
+
+        count, ancestors = count_queries(lambda: list(faq.ancestors()))
+        self.assertEquals(1, count)
+        self.assertEquals([1, 2], [f.id for f in ancestors])
+
+        count, descendants = count_queries(lambda: list(self.main.descendants()))
+        self.assertEquals(1, count)
+        self.assertEquals([2, 3, faq.id], sorted(f.id for f in descendants))
+
+    def testReparenting(self):
+        # makes sure the paths follow a forum that has been moved
+        faq = Forum.objects.create(name='FAQ', parent=self.ann)
+        self.ann.parent = self.helpful
+        self.ann.save()
+
+        faq = Forum.objects.get(pk=faq.id)
+        self.assertEquals('1/3/2/%i/' % faq.id, faq.tree_path)
+        self.assertEquals(3, faq.depth)
+        self.assertEquals([2, faq.id], sorted(f.id for f in self.helpful.descendants()))
+
+    def testRebuildTree(self):
+        # makes sure the paths can be rebuilt from scratch
+        Forum.objects.update(tree_path='', depth=0)
+        Forum.objects.rebuild_tree()
+        self.assertEquals('1/2/', Forum.objects.get(pk=2).tree_path)
+        self.assertEquals(1, Forum.objects.get(pk=3).depth)
+
+class PermissionTester(TestCase):
+    fixtures = ('vcboard',)
+
+    def setUp(self):
+        invalidate_permissions()
+        self.ann = Forum.objects.get(pk=2)
+        self.user = User.objects.create_user('tester', 'tester@example.com', 'password')
+        self.group = self.user.forumprofile.group
+
+    def allow(self, model, codename, value, **kwargs):
+        perm = Permission.objects.get(codename=PP(codename))
+        model.objects.create(forum=self.ann, permission=perm, 
+                             has_permission=value, **kwargs)
+
+    def testPrecedence(self):
+        # makes sure the most specific permission always wins
+        self.allow(ForumPermission, 'view_forum', True)
+        self.allow(ForumPermission, 'start_threads', True)
+        self.allow(ForumPermission, 'attach_files', True)
+        self.allow(GroupPermission, 'start_threads', False, group=self.group)
+        self.allow(GroupPermission, 'attach_files', False, group=self.group)
+        self.allow(UserPermission, 'attach_files', True, user=self.user)
+
+        perms = get_user_permissions(self.user, self.ann)
+        self.assertTrue(perms['view_forum'])
+        self.assertFalse(perms['start_threads'])
+        self.assertTrue(perms['attach_files'])
+        self.assertFalse(perms['delete_other_threads'])
+
+    def testSingleQuery(self):
+        # makes sure all permissions are resolved in one round trip
+        getattr(self.user.forumprofile, 'rank', None)
+        count, perms = count_queries(get_user_permissions, self.user, self.ann)
+        self.assertEquals(1, count)
+        self.assertEquals(23, len(perms))
+
+    def testBulkPermissions(self):
+        # makes sure many forums are resolved with a fixed number of queries
+        self.allow(GroupPermission, 'start_threads', True, group=self.group)
+        for i in range(5):
+            Forum.objects.create(name='Forum %i' % i, parent=self.ann)
+        forums = list(Forum.objects.all())
+
+        getattr(self.user.forumprofile, 'rank', None)
+        count, perms = count_queries(get_user_permissions_bulk, self.user, forums)
+        self.assertEquals(1, count)
+        self.assertTrue(perms[self.ann.id]['start_threads'])
+        self.assertFalse(perms[forums[-1].id]['start_threads'])
+
+        # subsequent lookups for the same user come from memory
+        count, perms = count_queries(get_user_permissions, self.user, self.ann)
+        self.assertEquals(0, count)
+
+    def testCachedPermissions(self):
+        # makes sure permissions are cached until they change
+        self.allow(ForumPermission, 'view_forum', True)
+        self.assertTrue(get_user_permissions(self.user, self.ann)['view_forum'])
+
+        user = User.objects.get(pk=self.user.id)
+        getattr(user.forumprofile, 'rank', None)
+        count, perms = count_queries(get_user_permissions, user, self.ann)
+        self.assertEquals(0, count)
+
+        self.allow(UserPermission, 'view_forum', False, user=self.user)
+        user = User.objects.get(pk=self.user.id)
+        self.assertFalse(get_user_permissions(user, self.ann)['view_forum'])
+
+    def testGroupChange(self):
+        # users who change groups don't keep the permissions of the old one
+        other = UserGroup.objects.create(name='Other')
+        self.allow(GroupPermission, 'start_threads', True, group=other)
+        self.assertFalse(get_user_permissions(self.user, self.ann)['start_threads'])
+
+        ForumProfile.objects.filter(user=self.user).update(group=other)
+        user = User.objects.get(pk=self.user.id)
+        self.assertTrue(get_user_permissions(user, self.ann)['start_threads'])
+
+class CounterTester(TestCase):
+    fixtures = ('vcboard',)
+
+    def setUp(self):
+        forum_tree.invalidate()
+        self.main = Forum.objects.get(pk=1)
+        self.ann = Forum.objects.get(pk=2)
+        self.user = User.objects.create_user('poster', 'poster@example.com', 'password')
+
+    def testPostCounts(self):
+        # makes sure new threads and replies are counted all the way up
+        thread = create_thread(self.ann, author=self.user)
+        reply = create_reply(thread, author=self.user)
+        create_reply(thread, is_draft=True)
+
+        for forum in Forum.objects.filter(pk__in=(1, 2)):
+            self.assertEquals(1, forum.thread_count)
+            self.assertEquals(2, forum.post_count)
+            self.assertEquals(reply.id, forum.last_post_id)
+
+        thread = Thread.objects.get(pk=thread.id)
+        self.assertEquals(1, thread.reply_count)
+        self.assertEquals(reply.id, thread.last_post.id)
+
+        profile = ForumProfile.objects.get(user=self.user)
+        self.assertEquals(1, profile.thread_count)
+        self.assertEquals(2, profile.post_count)
+
+    def testLastPostMovesForward(self):
+        # makes sure an older post never replaces a newer last post
+        thread = create_thread(self.ann)
+        reply = create_reply(thread)
+        Post.objects.filter(pk=reply.id).update(date_created=datetime(2100, 1, 1))
+        create_reply(thread)
+
+        self.assertEquals(reply.id, Forum.objects.get(pk=2).last_post_id)
+        self.assertEquals(reply.id, Thread.objects.get(pk=thread.id).last_post.id)
+        self.assertEquals(2, Thread.objects.get(pk=thread.id).reply_count)
+
+        # rebuilding, recalculating and moving agree on which post is last
+        self.assertEquals([], list(rebuild_counters(dry_run=True)))
+        Forum.objects.recalculate_last_posts([1, 2])
+        self.assertEquals(reply.id, Forum.objects.get(pk=2).last_post_id)
+        hints = Forum.objects.get(pk=3)
+        Thread.objects.move([thread.id], hints)
+        self.assertEquals(reply.id, Forum.objects.get(pk=3).last_post_id)
+        self.assertEquals([], list(rebuild_counters(dry_run=True)))
+
+    def testCountedChanges(self):
+        # drafts are counted once they are published, and posts that are 
+        # deleted one at a time stop counting
+        thread = create_thread(self.ann, author=self.user)
+        draft = create_thread(self.ann, author=self.user, is_draft=True)
+        draft_reply = create_reply(draft, author=self.user)
+        draft = Thread.objects.get(pk=draft.id)
+        draft.is_draft = False
+        draft.save()
+        self.assertEquals([], list(rebuild_counters(dry_run=True)))
+        self.assertEquals(draft_reply.id, Forum.objects.get(pk=2).last_post_id)
+
+        reply = create_reply(thread, author=self.user)
+        draft_reply = create_reply(thread, author=self.user, is_draft=True)
+        draft_reply.is_draft = False
+        draft_reply.save()
+        draft_reply = Post.objects.get(pk=draft_reply.id)
+        draft_reply.is_deleted = True
+        draft_reply.save()
+        self.assertEquals([], list(rebuild_counters(dry_run=True)))
+        self.assertEquals(reply.id, Forum.objects.get(pk=2).last_post_id)
+        self.assertEquals(reply.id, Thread.objects.get(pk=thread.id).last_post.id)
+
+        draft = Thread.objects.get(pk=draft.id)
+        draft.is_deleted = True
+        draft.save()
+        self.assertEquals([], list(rebuild_counters(dry_run=True)))
+
+    def testRebuildCounters(self):
+        # makes sure counters that drifted can be recalculated
+        thread = create_thread(self.ann, author=self.user)
+        reply = create_reply(thread, author=self.user)
+        Forum.objects.update(thread_count=7, post_count=0, last_post=None)
+        Thread.objects.update(reply_count=5)
+        ForumProfile.objects.update(post_count=0)
+
+        Forum.objects.filter(pk=2).update(tree_path='', depth=0)
+
+        call_command('vcboard_rebuild_counters', dry_run=True, verbosity=0)
+        self.assertEquals((7, '', 0), Forum.objects.filter(pk=2) \
+                                           .values_list('thread_count', 'tree_path', 
+                                                        'depth')[0])
+        self.assertTrue(('Forum', 2, 'tree_path', '', '1/2/') in 
+                        list(rebuild_counters(dry_run=True)))
+
+        changes = list(rebuild_counters(chunk_size=1))
+        self.assertTrue(('Thread', thread.id, 'reply_count', 5, 1) in changes)
+        for forum in Forum.objects.all():
+            self.assertEquals(forum.id != 3 and 1 or 0, forum.thread_count)
+            self.assertEquals(forum.id != 3 and 2 or 0, forum.post_count)
+        self.assertEquals(reply.id, Forum.objects.get(pk=1).last_post_id)
+        self.assertEquals(('1/2/', 1), Forum.objects.filter(pk=2) \
+                                             .values_list('tree_path', 'depth')[0])
+        self.assertEquals(1, Thread.objects.get(pk=thread.id).reply_count)
+        self.assertEquals(2, ForumProfile.objects.get(user=self.user).post_count)
+        self.assertEquals([], list(rebuild_counters()))
+
+        Thread.objects.update(reply_count=5)
+        call_command('vcboard_rebuild_counters', since='2000-01-01', verbosity=0)
+        self.assertEquals(1, Thread.objects.get(pk=thread.id).reply_count)
+
+class ModerationTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        self.ann = Forum.objects.get(pk=2)
+        self.hints = Forum.objects.get(pk=3)
+        self.other = Forum.objects.create(name='Other Category')
+        self.elsewhere = Forum.objects.create(name='Elsewhere', parent=self.other)
+        site = Site.objects.get_current()
+        for forum in (self.other, self.elsewhere):
+            forum.site.add(site)
+        forum_tree.invalidate()
+        invalidate_permissions()
+
+        self.user = User.objects.create_user('poster', 'poster@example.com', 'password')
+        self.threads = []
+        for i in range(4):
+            thread = create_thread(self.ann, 'Thread %i' % i, author=self.user)
+            for j in range(i):
+                create_reply(thread, 'Reply %i' % j, author=self.user)
+            self.threads.append(thread)
+        create_thread(self.hints, 'Hint')
+
+    def assertCounted(self):
+        # the adjusted counters should match counting everything again
+        self.assertEquals([], list(rebuild_counters(dry_run=True)))
+
+    def counters(self, forum):
+        forum = Forum.objects.get(pk=forum.id)
+        return forum.thread_count, forum.post_count, forum.last_post_id
+
+    def testFlags(self):
+        # closing, opening and sticking take the same few queries for any 
+        # number of threads
+        ids = [t.id for t in self.threads]
+        queries, closed = count_queries(Thread.objects.close, ids)
+        self.assertEquals(4, closed)
+        self.assertTrue(queries <= 4)
+        self.assertEquals(4, Thread.objects.filter(pk__in=ids, is_closed=True).count())
+
+        Thread.objects.reopen(ids[:2])
+        self.assertEquals([False, False, True, True], [Thread.objects.get(pk=pk).is_closed 
+                                                      for pk in ids])
+        Thread.objects.stick(ids[1:3])
+        self.assertEquals([ids[1], ids[2]], sorted(Thread.objects.filter(is_sticky=True) \
+                                                         .values_list('pk', flat=True)))
+        Thread.objects.stick(ids, False)
+        self.assertEquals(0, Thread.objects.filter(is_sticky=True).count())
+        self.assertCounted()
+
+    def testSoftDelete(self):
+        # deleted threads and their replies leave the counters
+        newest = self.threads[3]
+        ids = [self.threads[1].id, newest.id]
+        self.assertEquals(2, Thread.objects.soft_delete(ids))
+        self.assertEquals(0, Thread.objects.soft_delete(ids))
+        self.assertCounted()
+
+        last = Thread.objects.get(pk=self.threads[2].id).last_post.id
+        self.assertEquals((2, 4, last), self.counters(self.ann))
+        self.assertEquals(3, self.counters(Forum.objects.get(pk=1))[0])
+        profile = ForumProfile.objects.get(user=self.user)
+        self.assertEquals((2, 8), (profile.thread_count, profile.post_count))
+
+    def testMove(self):
+        # moved threads only change the counters of forums that aren't above
+        # both forums
+        main = Forum.objects.get(pk=1)
+        before = self.counters(main)
+        ids = [self.threads[0].id, self.threads[3].id]
+        self.assertEquals(2, Thread.objects.move(ids, self.hints))
+        self.assertCounted()
+        self.assertEquals(before, self.counters(main))
+
+        # the hint is still newer than anything that was moved
+        hint = Thread.objects.get(subject='Hint')
+        self.assertEquals((3, 6, hint.id), self.counters(self.hints))
+        self.assertEquals(Thread.objects.get(pk=self.threads[2].id).last_post.id, 
+                          self.counters(self.ann)[2])
+
+        Thread.objects.move(ids, self.elsewhere)
+        self.assertCounted()
+        last = Thread.objects.get(pk=self.threads[3].id).last_post.id
+        self.assertEquals((2, 5, last), self.counters(self.other))
+        self.assertEquals(2, Thread.objects.filter(forum=self.elsewhere).count())
+
+    def testMoveStaleLastPost(self):
+        # a thread's stored last post may already be deleted, so the forum
+        # finds its last post among the posts themselves
+        thread = self.threads[3]
+        replies = list(Post.objects.filter(parent=thread).order_by('id'))
+        Post.objects.filter(pk=replies[-1].id).update(is_deleted=True)
+        self.assertEquals(replies[-1].id, Thread.objects.get(pk=thread.id)._last_post_id)
+
+        Thread.objects.move([thread.id], self.elsewhere)
+        self.assertEquals(replies[-2].id, self.counters(self.elsewhere)[2])
+
+    def testEndpoint(self):
+        # threads in forums the user may not moderate are left alone
+        perm = Permission.objects.get(codename=PP('close_own_threads'))
+        ForumPermission.objects.create(forum=self.ann, permission=perm, 
+                                       has_permission=True)
+        hint = Thread.objects.get(forum=self.hints)
+        self.client.login(username='poster', password='password')
+
+        url = '/moderate/'
+        self.assertEquals(405, self.client.get(url).status_code)
+        response = self.client.post(url, {'action': 'close', 'next': '/',
+                            'thread_ids': [self.threads[0].id, hint.id]})
+        self.assertEquals(302, response.status_code)
+        self.assertTrue(Thread.objects.get(pk=self.threads[0].id).is_closed)
+        self.assertFalse(Thread.objects.get(pk=hint.id).is_closed)
+
+        response = self.client.post(url, {'action': 'delete', 
+                                          'thread_ids': [self.threads[0].id]})
+        self.assertTrue(settings.LOGIN_URL in response['Location'])
+        self.assertFalse(Thread.objects.get(pk=self.threads[0].id).is_deleted)
+
+    def testEndpointRedirect(self):
+        # only paths on this site are redirected to
+        self.client.login(username='poster', password='password')
+        for next in ('http://example.com/', '//example.com/', 'example.com'):
+            response = self.client.post('/moderate/', {'action': 'close', 'next': next})
+            self.assertEquals('http://testserver/', response['Location'])
+        response = self.client.post('/moderate/', {'action': 'close', 'next': '/forum/'})
+        self.assertEquals('http://testserver/forum/', response['Location'])
+
+    def testEndpointOtherSite(self):
+        # threads in forums of other sites are never moderated from this one
+        offsite = Forum.objects.create(name='Offsite')
+        thread = create_thread(offsite, 'Offsite', author=self.user)
+        self.client.login(username='poster', password='password')
+        response = self.client.post('/moderate/', {'action': 'close', 
+                                                   'thread_ids': [thread.id]})
+        self.assertTrue(settings.LOGIN_URL in response['Location'])
+        self.assertFalse(Thread.objects.get(pk=thread.id).is_closed)
+
+class PurgeTester(TestCase):
+    fixtures = ('vcboard',)
+
+    def setUp(self):
+        forum_tree.invalidate()
+        self.ann = Forum.objects.get(pk=2)
+        self.user = User.objects.create_user('poster', 'poster@example.com', 'password')
+        self.kept = create_thread(self.ann, 'Kept', author=self.user)
+        self.old_reply = create_reply(self.kept, 'Old reply', author=self.user)
+        self.new_reply = create_reply(self.kept, 'New reply', author=self.user)
+        self.dead = create_thread(self.ann, 'Dead', author=self.user)
+        self.dead_replies = [create_reply(self.dead, 'Dead reply %i' % i, 
+                                          author=self.user) for i in range(3)]
+        Rating.objects.create(post=self.dead_replies[0], user=self.user, rating=5)
+        ThreadWatch.objects.create(thread=self.dead, user=self.user)
+
+        Thread.objects.soft_delete([self.dead.id])
+        self.recent = create_reply(self.kept, 'Recent', author=self.user)
+        self.assertEquals(2, Post.objects.soft_delete([self.new_reply.id, self.recent.id]))
+        self.assertEquals(0, Post.objects.soft_delete([self.new_reply.id]))
+
+        long_ago = datetime(2000, 1, 1)
+        Post.objects.filter(pk__in=[self.dead.id, self.new_reply.id]) \
+                    .update(date_updated=long_ago)
+
+    def testSoftDelete(self):
+        # deleted replies leave the counters and last posts right away
+        self.assertEquals([], list(rebuild_counters(dry_run=True)))
+        self.assertEquals(self.old_reply.id, Forum.objects.get(pk=2).last_post_id)
+        thread = Thread.objects.get(pk=self.kept.id)
+        self.assertEquals((1, self.old_reply.id), (thread.reply_count, thread._last_post_id))
+
+    def testPurge(self):
+        # old deleted posts go away and everything that pointed at them is
+        # fixed up
+        before = set(Post.objects.values_list('pk', flat=True))
+        call_command('vcboard_purge', chunk_size=2, verbosity=0)
+
+        purged = set([self.new_reply.id, self.dead.id] + 
+                     [r.id for r in self.dead_replies])
+        remaining = set(Post.objects.values_list('pk', flat=True))
+        self.assertEquals(before - purged, remaining)
+        self.assertEquals(0, Rating.objects.count())
+        self.assertEquals(0, ThreadWatch.objects.count())
+        self.assertEquals(3, Forum.objects.count())
+
+        self.assertEquals(self.old_reply.id, Forum.objects.get(pk=2).last_post_id)
+        self.assertEquals(self.old_reply.id, Thread.objects.get(pk=self.kept.id)._last_post_id)
+        self.assertEquals([], list(rebuild_counters(dry_run=True)))
+
+    def testNewestKept(self):
+        # the newest post is never purged, so its ID is never handed out again
+        Post.objects.filter(pk=self.recent.id).update(date_updated=datetime(2000, 1, 1))
+        call_command('vcboard_purge', verbosity=0)
+        self.assertTrue(Post.objects.get(pk=self.recent.id).is_deleted)
+        self.assertTrue(create_reply(self.kept).id > self.recent.id)
+
+    def testDryRun(self):
+        # nothing is deleted on a dry run, or before the retention window
+        count = Post.objects.count()
+        call_command('vcboard_purge', dry_run=True, verbosity=0)
+        call_command('vcboard_purge', days=365 * 50, verbosity=0)
+        self.assertEquals(count, Post.objects.count())
+
+class IndexTester(TestCase):
+    # EXPLAIN makes SQLite commit, so these tests don't write anything
+
+    def testViewQueries(self):
+        # the main view queries find their rows through an index
+        if settings.DATABASE_ENGINE != 'sqlite3':
+            return
+
+        forum = Forum(id=2)
+        plan = query_plan(*Thread.objects.listing(forum) \
+                                         .order_by(*THREAD_ORDERING).query.as_sql())
+        self.assertTrue(uses_index(plan, 'vcboard_thread', 'vcboard_thread_listing'), plan)
+
+        posts = Post.objects.valid().filter(parent=1).order_by(*POST_ORDERING)
+        plan = query_plan(*posts.query.as_sql())
+        self.assertTrue(uses_index(plan, 'vcboard_post', 'vcboard_post_listing'), plan)
+
+        # the permission matrices are joined as m0 (users), m1 (groups) and
+        # m2 (forums)
+        user = User(id=1)
+        user._profile = ForumProfile(user=user, group_id=1)
+        user._profile._rank = None
+        plan = query_plan(*permissions_query(user, [forum.id]))
+        for alias in ('m0', 'm1', 'm2'):
+            self.assertTrue(uses_index(plan, alias), plan)
+
+class ViewCountTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        forum_tree.invalidate()
+        invalidate_permissions()
+        view_counter.flush()
+        self.ann = Forum.objects.get(pk=2)
+        self.thread = create_thread(self.ann, 'Views')
+        perm = Permission.objects.get(codename=PP('view_other_threads'))
+        ForumPermission.objects.create(forum=self.ann, permission=perm, 
+                                       has_permission=True)
+
+    def testBufferedViews(self):
+        # makes sure views are collected and written in batches
+        url = '/forum/main-forum-category/announcements/thread/%i/' % self.thread.id
+        for i in range(3):
+            response = self.client.get(url)
+            self.assertEquals(200, response.status_code)
+
+        self.assertEquals(3, response.context[0]['thread'].view_count)
+        self.assertEquals(0, Thread.objects.get(pk=self.thread.id).view_count)
+
+        view_counter.flush()
+        self.assertEquals(3, Thread.objects.get(pk=self.thread.id).view_count)
+        self.assertEquals(0, view_counter.get(self.thread.id))
+
+class ProfileTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        forum_tree.invalidate()
+        invalidate_permissions()
+        self.ann = Forum.objects.get(pk=2)
+        perm = Permission.objects.get(codename=PP('view_other_threads'))
+        ForumPermission.objects.create(forum=self.ann, permission=perm, 
+                                       has_permission=True)
+
+    def add_user(self, username):
+        return User.objects.create_user(username, '%s@example.com' % username, 
+                                        'password')
+
+    def testCreatedWithUser(self):
+        # new users get a profile in the default group right away
+        user = self.add_user('newbie')
+        profile = ForumProfile.objects.get(user=user)
+        self.assertEquals(UserGroup.objects.default(), profile.group)
+
+        queries, profile = count_queries(get_profile, User.objects.get(pk=user.id))
+        self.assertEquals(1, queries)
+        self.assertEquals('Member', profile.group.name)
+
+    def testLegacyUsers(self):
+        # users from before profiles were created with them still get one
+        user = self.add_user('oldtimer')
+        ForumProfile.objects.filter(user=user).delete()
+        profile = ForumProfile.objects.for_users([User.objects.get(pk=user.id)])[user.id]
+        self.assertEquals(user.id, profile.user_id)
+        self.assertEquals(1, ForumProfile.objects.filter(user=user).count())
+
+    def testBulkProfiles(self):
+        # the profiles of every author on a page come from a few queries, no
+        # matter how many authors there are
+        thread = create_thread(self.ann, 'Authors')
+        for i in range(5):
+            create_reply(thread, 'Reply %i' % i, author=self.add_user('author%i' % i))
+
+        posts = list(Post.objects.filter(parent=thread).select_related('author'))
+        queries, profiles = count_queries(ForumProfile.objects.for_users, 
+                                          [p.author for p in posts])
+        self.assertEquals(5, len(profiles))
+        self.assertTrue(queries <= 3)
+
+        def read_profiles():
+            return [(p.author.forumprofile.post_count, p.author.forumprofile.group.name)
+                    for p in posts]
+        queries, values = count_queries(read_profiles)
+        self.assertEquals(0, queries)
+        self.assertEquals([(1, 'Member')] * 5, values)
+
+        url = '/forum/main-forum-category/announcements/thread/%i/' % thread.id
+        self.assertEquals(200, self.client.get(url).status_code)
+
+class ForumIndexTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        forum_tree.invalidate()
+        invalidate_permissions()
+
+    def add_forum(self, name):
+        forum = Forum.objects.create(parent=Forum.objects.get(pk=1), name=name, 
+                                     slug=name.lower())
+        forum.site.add(Site.objects.get_current())
+        forum_tree.invalidate()
+        thread = create_thread(forum, 'Thread in %s' % name)
+        create_reply(thread, 'Reply in %s' % name)
+        return forum
+
+    def testQueryBudget(self):
+        # the index page should not run more queries as forums are added
+        self.add_forum('First')
+        self.client.get('/')
+        before, response = count_queries(self.client.get, '/')
+        self.assertEquals(200, response.status_code)
+
+        for name in ('Second', 'Third', 'Fourth'):
+            self.add_forum(name)
+        self.client.get('/')
+        after, response = count_queries(self.client.get, '/')
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(before, after)
+        self.assertEquals(6, len(response.context[0]['forums'][0].subforums))
+
+    def testLastPostUrls(self):
+        # the last post links should point at the right forum
+        forum = self.add_forum('Links')
+        response = self.client.get('/')
+        self.assertContains(response, '/forum/main-forum-category/links/post/')
+
+class ThreadListTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        forum_tree.invalidate()
+        invalidate_permissions()
+        self.ann = Forum.objects.get(pk=2)
+        self.url = '/main-forum-category/announcements/'
+        self.author = User.objects.create_user('poster', 'poster@example.com', 'password')
+
+    def add_thread(self, subject):
+        thread = create_thread(self.ann, subject, author=self.author)
+        create_reply(thread, 'Re: %s' % subject, author=self.author)
+        return thread
+
+    def testQueryBudget(self):
+        # a page of threads should not cost a query per thread
+        self.add_thread('First')
+        self.client.get(self.url)
+        before, response = count_queries(self.client.get, self.url)
+        self.assertEquals(200, response.status_code)
+
+        for subject in ('Second', 'Third', 'Fourth', 'Fifth'):
+            self.add_thread(subject)
+        self.client.get(self.url)
+        after, response = count_queries(self.client.get, self.url)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(before, after)
+        self.assertEquals(5, len(response.context[0]['page'].object_list))
+
+    def testHiddenThreads(self):
+        # drafts and deleted threads are left out of the listing
+        self.add_thread('Visible')
+        create_thread(self.ann, 'Draft', is_draft=True)
+        create_thread(self.ann, 'Deleted', is_deleted=True)
+        response = self.client.get(self.url)
+        subjects = [t.subject for t in response.context[0]['page'].object_list]
+        self.assertEquals(['Visible'], subjects)
+        self.assertContains(response, '/forum/main-forum-category/announcements/thread/')
+
+class SeekPaginationTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        forum_tree.invalidate()
+        invalidate_permissions()
+        self.ann = Forum.objects.get(pk=2)
+        when = datetime(2009, 6, 1, 12, 0)
+
+        # some of the threads share a timestamp so the id has to break ties
+        for i in range(8):
+            create_thread(self.ann, 'Thread %i' % i, is_sticky=(i % 3 == 0),
+                          date_created=datetime(2009, 6, 1 + i // 2, 12, 0))
+
+        self.thread = create_thread(self.ann, 'Long thread')
+        for i in range(7):
+            create_reply(self.thread, 'Reply %i' % i, date_created=when)
+
+    def tearDown(self):
+        # settings saved by a test are rolled back without a signal
+        config.invalidate()
+
+    def assertSamePages(self, queryset, ordering, name, per_page):
+        seek = SeekPaginator(queryset, per_page, ordering, name)
+        offset = Paginator(queryset.order_by(*ordering), per_page)
+        self.assertEquals(offset.count, seek.count)
+        self.assertEquals(offset.num_pages, seek.num_pages)
+        for number in offset.page_range:
+            expected = [o.id for o in offset.page(number).object_list]
+            found = [o.id for o in seek.page(number).object_list]
+            self.assertEquals(expected, found)
+
+    def testThreadPages(self):
+        # seeking should find the same threads on each page as OFFSET does
+        threads = Thread.objects.listing(self.ann)
+        for per_page in (1, 3, 4, 20):
+            self.assertSamePages(threads, THREAD_ORDERING, 'f%i' % self.ann.id, per_page)
+
+    def testPostPages(self):
+        # seeking should find the same replies on each page as OFFSET does
+        posts = self.thread.posts.valid()
+        for per_page in (2, 3, 7):
+            self.assertSamePages(posts, POST_ORDERING, 't%i' % self.thread.id, per_page)
+
+    def testIndexInvalidated(self):
+        # new threads should show up once the page index is rebuilt
+        threads = Thread.objects.listing(self.ann)
+        self.assertEquals(9, SeekPaginator(threads, 4, THREAD_ORDERING, 'f2').count)
+        create_thread(self.ann, 'Another')
+        self.assertEquals(10, SeekPaginator(threads, 4, THREAD_ORDERING, 'f2').count)
+
+    def testIndexExtended(self):
+        # new replies are added to the end of the cached page index, and 
+        # edits leave it alone
+        Setting.objects.create(site=Site.objects.get_current(), section='THREAD',
+                               key='POSTS_PER_PAGE', primitive_type='int', value='4')
+        name = 't%i' % self.thread.id
+        posts = self.thread.posts.valid()
+        SeekPaginator(posts, 4, POST_ORDERING, name).index
+        reply = create_reply(self.thread, 'Reply 7')
+        create_reply(self.thread, 'Reply 8')
+        reply.content = 'Edited'
+        reply.save()
+
+        queries, index = count_queries(lambda: SeekPaginator(posts, 4, POST_ORDERING, name).index)
+        self.assertEquals((0, 9, 3), (queries, index['count'], len(index['cursors'])))
+        self.assertSamePages(posts, POST_ORDERING, name, 4)
+
+        # publishing a draft means the index has to be built again
+        draft = create_reply(self.thread, 'Draft', is_draft=True)
+        draft.is_draft = False
+        draft.save()
+        queries, index = count_queries(lambda: SeekPaginator(posts, 4, POST_ORDERING, name).index)
+        self.assertEquals(10, index['count'])
+        self.assertTrue(queries > 0)
+
+    def testPageUrls(self):
+        # the old page URLs keep working
+        Forum.objects.filter(pk=self.ann.id).update(threads_per_page=4)
+        response = self.client.get('/forum/main-forum-category/announcements/page/2/')
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(2, response.context[0]['page'].number)
+        self.assertEquals(4, len(response.context[0]['page'].object_list))
+
+class CountedPaginationTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        forum_tree.invalidate()
+        invalidate_permissions()
+        self.ann = Forum.objects.get(pk=2)
+        self.sub = Forum.objects.create(parent=self.ann, name='Sub', slug='sub')
+        self.thread = create_thread(self.ann, 'Counted')
+        create_thread(self.ann, 'Also counted')
+        create_thread(self.sub, 'Elsewhere')
+        self.replies = [create_reply(self.thread, 'Reply %i' % i) for i in range(3)]
+
+    def testCountersUsed(self):
+        # the counters stand in for COUNT(*)
+        forum = Forum.objects.get(pk=self.ann.id)
+        thread = Thread.objects.get(pk=self.thread.id)
+
+        queries, count = count_queries(lambda: thread_paginator(forum, 
+                            Thread.objects.listing(forum), 20).count)
+        self.assertEquals(2, count)
+        self.failIf([q for q in connection.queries if 'COUNT(' in q['sql']])
+
+        posts = thread.posts.valid()
+        queries, count = count_queries(lambda: post_paginator(thread, posts, 20).count)
+        self.assertEquals(3, count)
+        self.assertEquals(0, queries)
+
+    def testStaleCounters(self):
+        # removing a reply behind the counters' back makes them stale
+        self.replies[0].delete()
+        self.failUnless(is_stale('t%i' % self.thread.id))
+
+        thread = Thread.objects.get(pk=self.thread.id)
+        self.assertEquals(3, thread.reply_count)
+        self.assertEquals(2, post_paginator(thread, thread.posts.valid(), 20).count)
+
+        # rebuilding the counters makes them trustworthy again
+        call_command('vcboard_rebuild_counters', verbosity=0)
+        self.failIf(is_stale('t%i' % self.thread.id))
+        thread = Thread.objects.get(pk=self.thread.id)
+        self.assertEquals(2, post_paginator(thread, thread.posts.valid(), 20).count)
+
+    def testPublishedDraft(self):
+        # publishing a draft thread counts it, so the forum isn't stale
+        draft = create_thread(self.ann, 'Draft', is_draft=True)
+        draft.is_draft = False
+        draft.save()
+        self.failIf(is_stale('f%i' % self.ann.id))
+
+        forum = Forum.objects.get(pk=self.ann.id)
+        self.assertEquals(3, thread_paginator(forum, 
+                                Thread.objects.listing(forum), 20).count)
+
+class MarkupTester(TestCase):
+    fixtures = ('vcboard',)
+
+    def setUp(self):
+        forum_tree.invalidate()
+        self.thread = create_thread(Forum.objects.get(pk=2), 'Markup',
+                                    content='[b]Bold[/b] <script>')
+
+    def testRender(self):
+        # markup becomes HTML and everything else is escaped
+        self.assertEquals('<strong>Bold</strong> &lt;script&gt;',
+                          render_markup('[b]Bold[/b] <script>'))
+        self.assertEquals('<blockquote class="quote" cite="#post-4">'
+                          '<blockquote class="quote" cite="#post-2">Inner'
+                          '</blockquote><br />\nOuter</blockquote>',
+                          render_markup('[quote id="4"][quote id="2"]Inner'
+                                        '[/quote]\nOuter[/quote]'))
+        self.assertEquals('<em>open</em>', render_markup('[i]open'))
+        self.assertEquals('stray[/b]', render_markup('stray[/b]'))
+        self.assertEquals('[url=javascript:alert(1)]x', 
+                          render_markup('[url=javascript:alert(1)]x'))
+
+    def testStored(self):
+        # the HTML is stored when the post is written and redone on edits
+        thread = Thread.objects.get(pk=self.thread.id)
+        self.assertEquals('<strong>Bold</strong> &lt;script&gt;', thread.content_html)
+
+        thread.content = '[i]Edited[/i]'
+        thread.save()
+        self.assertEquals('<em>Edited</em>', Thread.objects.get(pk=thread.id).html)
+
+    def testRenderCommand(self):
+        # posts without stored HTML are rendered in bulk
+        Post.objects.filter(pk=self.thread.id).update(content_html='')
+        call_command('vcboard_render_posts', missing=True, verbosity=0)
+        self.assertEquals('<strong>Bold</strong> &lt;script&gt;',
+                          Post.objects.get(pk=self.thread.id).content_html)
+
+class PageCacheTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        self.enabled = pagecache.ENABLED
+        pagecache.ENABLED = True
+        forum_tree.invalidate()
+        invalidate_permissions()
+        pagecache.invalidate_all()
+        view_counter.flush()
+
+        self.ann = Forum.objects.get(pk=2)
+        perm = Permission.objects.get(codename=PP('view_other_threads'))
+        self.perm = ForumPermission.objects.create(forum=self.ann, 
+                                permission=perm, has_permission=True)
+        self.thread = create_thread(self.ann, 'Cached', content='First post')
+        self.url = '/forum/main-forum-category/announcements/thread/%i/' % self.thread.id
+
+    def tearDown(self):
+        pagecache.ENABLED = self.enabled
+
+    def testCachedPage(self):
+        # the second anonymous request is answered from the cache
+        uncached, first = count_queries(self.client.get, self.url)
+        cached, second = count_queries(self.client.get, self.url)
+        self.assertEquals(first.content, second.content)
+        self.failIf(second.context)
+        self.failUnless(cached < uncached)
+
+        # views still count when the page comes from the cache
+        self.assertEquals(2, view_counter.get(self.thread.id))
+
+    def testInvalidatedByReply(self):
+        # a new reply throws away the thread page and the forum page
+        self.client.get(self.url)
+        self.client.get('/main-forum-category/announcements/')
+        create_reply(self.thread, 'Fresh reply', content='Brand new')
+        self.assertContains(self.client.get(self.url), 'Brand new')
+        response = self.client.get('/main-forum-category/announcements/')
+        self.assertEquals(1, response.context[0]['page'].object_list[0].reply_count)
+
+    def testPermissionsChange(self):
+        # pages are never shared between different permission sets
+        self.client.get(self.url)
+        self.perm.has_permission = False
+        self.perm.save()
+        self.assertEquals(302, self.client.get(self.url).status_code)
+
+    def testLoggedIn(self):
+        # logged in users always get a fresh page
+        User.objects.create_user('reader', 'reader@example.com', 'password')
+        self.client.login(username='reader', password='password')
+        self.client.get(self.url)
+        self.failUnless(self.client.get(self.url).context)
+
+class ConditionalGetTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        forum_tree.invalidate()
+        invalidate_permissions()
+        self.ann = Forum.objects.get(pk=2)
+        perm = Permission.objects.get(codename=PP('view_other_threads'))
+        ForumPermission.objects.create(forum=self.ann, permission=perm, 
+                                       has_permission=True)
+        self.thread = create_thread(self.ann, 'Conditional')
+        self.thread_url = '/forum/main-forum-category/announcements/thread/%i/' % self.thread.id
+        self.forum_url = '/main-forum-category/announcements/'
+
+    def testNotModified(self):
+        # clients with a current copy get a 304 without a page being built
+        for url in (self.thread_url, self.forum_url):
+            response = self.client.get(url)
+            self.assertEquals(200, response.status_code)
+            etag = response['ETag']
+
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(304, response.status_code)
+            self.assertEquals('', response.content)
+            self.assertEquals(etag, response['ETag'])
+
+            response = self.client.get(url, 
+                        HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEquals(304, response.status_code)
+
+    def testModified(self):
+        # new replies change the validators of the thread and the forum
+        thread_etag = self.client.get(self.thread_url)['ETag']
+        forum_etag = self.client.get(self.forum_url)['ETag']
+        create_reply(self.thread, 'Changed')
+
+        response = self.client.get(self.thread_url, HTTP_IF_NONE_MATCH=thread_etag)
+        self.assertEquals(200, response.status_code)
+        response = self.client.get(self.forum_url, HTTP_IF_NONE_MATCH=forum_etag)
+        self.assertEquals(200, response.status_code)
+
+    def testPerUser(self):
+        # users with different permissions never share a validator
+        etag = self.client.get(self.forum_url)['ETag']
+        User.objects.create_user('reader', 'reader@example.com', 'password')
+        self.client.login(username='reader', password='password')
+        response = self.client.get(self.forum_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(200, response.status_code)
+
+class ReadMarkerTester(TestCase):
+    fixtures = ('vcboard',)
+    urls = 'vcboard.urls'
+
+    def setUp(self):
+        forum_tree.invalidate()
+        invalidate_permissions()
+        self.ann = Forum.objects.get(pk=2)
+        perm = Permission.objects.get(codename=PP('view_other_threads'))
+        ForumPermission.objects.create(forum=self.ann, permission=perm, 
+                                       has_permission=True)
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'password')
+        self.user.date_joined = datetime(2009, 1, 1)
+        self.user.save()
+        self.threads = [create_thread(self.ann, 'Thread %i' % i) for i in range(3)]
+
+    def unread(self):
+        user = User.objects.get(pk=self.user.id)
+        threads = Thread.objects.filter(forum=self.ann).order_by('id')
+        return [ReadMarker.objects.has_unread(user, t) for t in threads]
+
+    def read(self, thread):
+        self.client.get('/forum/main-forum-category/announcements/thread/%i/' % thread.id)
+
+    def testReadThreads(self):
+        # threads stay read until someone replies
+        self.client.login(username='reader', password='password')
+        self.assertEquals([True, True, True], self.unread())
+        self.read(self.threads[1])
+        self.assertEquals([True, False, True], self.unread())
+
+        create_reply(self.threads[1], 'New reply')
+        self.assertEquals([True, True, True], self.unread())
+        self.failIf([k for k in self.client.session.keys() if k.startswith('last_in')])
+
+    def testForum(self):
+        # a forum is read once its newest post is, or when it's marked read
+        self.client.login(username='reader', password='password')
+        user = User.objects.get(pk=self.user.id)
+        self.failUnless(ReadMarker.objects.has_unread(user, Forum.objects.get(pk=2)))
+
+        self.read(self.threads[2])
+        user = User.objects.get(pk=self.user.id)
+        self.failIf(ReadMarker.objects.has_unread(user, Forum.objects.get(pk=2)))
+
+        self.client.get('/forum/main-forum-category/announcements/mark-read/')
+        self.assertEquals([False, False, False], self.unread())
+
+    def testBulkLookup(self):
+        # every row of a listing is answered from one query
+        user = User.objects.get(pk=self.user.id)
+        threads = list(Thread.objects.filter(forum=self.ann).select_related('_last_post'))
+        queries, unread = count_queries(lambda: [ReadMarker.objects.has_unread(user, t)
+                                                 for t in threads])
+        self.assertEquals(1, queries)
+
+    def testBounded(self):
+        # only the most recently read threads are remembered
+        import vcboard.models
+        limit = vcboard.models.MAX_READ_THREADS
+        vcboard.models.MAX_READ_THREADS = 2
+        try:
+            user = User.objects.get(pk=self.user.id)
+            for i, thread in enumerate(self.threads):
+                ReadMarker.objects.mark_thread_read(user, thread, datetime.now())
+            marker = ReadMarker.objects.get(user=self.user, forum=self.ann)
+            self.assertEquals(2, len(marker.get_threads()))
+        finally:
+            vcboard.models.MAX_READ_THREADS = limit
+
+class SettingTester(TestCase):
+    fixtures = ('vcboard',)
+
+    def setUp(self):
+        config.invalidate()
+        self.site = Site.objects.get_current()
+
+    def testDefaults(self):
+        # asking for a setting that was never saved doesn't write anything
+        self.assertEquals(True, config('test', 'enabled', bool, True))
+        self.assertEquals(False, config('test', 'disabled', bool, False))
+        self.assertEquals(15, config('test', 'per_page', int, 15))
+        self.assertEquals('Board', config('test', 'name', default='Board'))
+        self.assertEquals(0, Setting.objects.filter(section='TEST').count())
+
+        Setting.objects.save_defaults()
+        self.assertEquals(4, Setting.objects.filter(section='TEST').count())
+        self.assertEquals(True, config('test', 'enabled', bool, True))
+        self.assertEquals(15, config('test', 'per_page', int, 20))
+        self.assertEquals([], Setting.objects.save_defaults())
+
+    def testSharedDefaults(self):
+        # defaults asked for in one process can be saved from another
+        self.assertEquals(3, config('test', 'elsewhere', int, 3))
+        other = SettingManager()
+        self.assertEquals(('TEST', 'ELSEWHERE', 'int', u'3'), 
+                          other.defaults()['TEST.ELSEWHERE'])
+        other.save_defaults()
+        self.assertEquals(1, Setting.objects.filter(section='TEST', 
+                                                    key='ELSEWHERE').count())
+
+    def testSingleQuery(self):
+        # every setting is loaded at once and then served from memory
+        for key in ('one', 'two', 'three'):
+            Setting.objects.create(site=self.site, section='TEST', key=key.upper(),
+                                   primitive_type='int', value='1')
+        queries, value = count_queries(config, 'test', 'one', int)
+        self.assertEquals(1, value)
+        self.assertEquals(1, queries)
+        for key in ('one', 'two', 'three', 'missing'):
+            queries, value = count_queries(config, 'test', key, int, 1)
+            self.assertEquals((0, 1), (queries, value))
+
+    def testSharedChanges(self):
+        # saving a setting in one process is noticed by the others
+        other = SettingSnapshot('settings', check_interval=0)
+        self.assertEquals({}, other.get(self.site.id))
+        setting = Setting.objects.create(site=self.site, section='TEST', 
+                                         key='SHARED', primitive_type='str',
+                                         value='first')
+        self.assertEquals('first', other.get(self.site.id)['TEST.SHARED'].evaluate())
+        setting.value = 'second'
+        setting.save()
+        self.assertEquals('second', other.get(self.site.id)['TEST.SHARED'].evaluate())
+        setting.delete()
+        self.assertEquals({}, other.get(self.site.id))
 
 class WatchTester(TestCase):
     fixtures = ('vcboard',)
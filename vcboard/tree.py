@@ -0,0 +1,83 @@
+from django.contrib.sites.models import Site
+from vcboard.utils import SharedSnapshot
+
+class ForumTree(SharedSnapshot):
+    """
+    An in-memory index of the forum tree for each site.  The whole tree is 
+    loaded with one query and is rebuilt whenever a forum is saved or deleted
+    (see vcboard.listeners).
+
+    The forums in the index are snapshots.  They are fine for names, slugs and
+    structure, but their counters go stale, so never save them.
+    """
+
+    def build(self, site_id):
+        from vcboard.models import Forum
+
+        forums = dict((f.id, f) for f in Forum.objects.filter(site__id=site_id).order_by())
+        children = {}
+        for f in sorted(forums.values(), key=lambda f: (f.ordering, f.name)):
+            children.setdefault(f.parent_id, []).append(f.id)
+
+        hierarchies, paths = {}, {}
+        for f in forums.values():
+            chain, node = [], f
+            while node and node not in chain:
+                chain.insert(0, node)
+                node = forums.get(node.parent_id, None)
+
+            # forums whose parents are not on this site are left out
+            if chain[0].parent_id:
+                continue
+
+            f._path = '/'.join(n.slug for n in chain)
+            hierarchies[f.id] = tuple(n.id for n in chain)
+
+            # only forums whose whole chain is active can be found by path
+            if all(n.is_active for n in chain):
+                paths[f._path] = f.id
+
+        return {
+            'forums': forums,
+            'children': children,
+            'hierarchies': hierarchies,
+            'paths': paths,
+        }
+
+    def current(self):
+        return self.get(Site.objects.get_current().id)
+
+    def find(self, path):
+        """
+        Returns the ID of the active forum with the specified path, if any
+        """
+        return self.current()['paths'].get(path.strip('/'), None)
+
+    def hierarchy(self, forum_id):
+        """
+        Returns the snapshots of a forum and all of its parents, starting at 
+        the top of the tree
+        """
+        tree = self.current()
+        ids = tree['hierarchies'].get(forum_id, ())
+        return tuple(tree['forums'][fid] for fid in ids)
+
+    def path(self, forum_id):
+        """
+        Returns the slug path of a forum, if the forum is in the tree
+        """
+        tree = self.current()
+        if tree['hierarchies'].has_key(forum_id):
+            return tree['forums'][forum_id]._path
+        return None
+
+    def child_ids(self, forum_id=None):
+        """
+        Returns the IDs of the active forums directly beneath the specified 
+        forum, or of the active top-level forums if no forum is specified
+        """
+        tree = self.current()
+        return [fid for fid in tree['children'].get(forum_id, [])
+                if tree['forums'][fid].is_active]
+
+forum_tree = ForumTree('forum_tree')
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.conf.urls.defaults import *
 from vcboard import views, listeners
 
@@ -8,10 +9,27 @@ urlpatterns = patterns('vcboard.admin_views',
     url(r'^permissions/$', 'permission_matrix', name='vcboard-default-permissions'),
 )
 
+if 'vcboard.search' in settings.INSTALLED_APPS:
+    urlpatterns += patterns('vcboard.search.views',
+        url(r'^search/$', 'search', name='vcboard-search'),
+    )
+
 pre = lambda p: r'^forum/(?P<path>.*)/%s' % p
 
+if 'vcboard.archive' in settings.INSTALLED_APPS:
+    # forum slugs never contain a "+", so the archive can't hide a forum
+    urlpatterns += patterns('',
+        url(pre(r'\+archive/page/(?P<page>\d+)/$'),
+            views.show_forum, {'archived': True},
+            name='vcboard-show-archive-page'),
+        url(pre(r'\+archive/$'),
+            views.show_forum, {'archived': True},
+            name='vcboard-show-archive'),
+    )
+
 urlpatterns += patterns('',
     url(r'^$', views.forum_home, name='vcboard-home'),
+    url(r'^moderate/$', views.moderate_threads, name='vcboard-moderate-threads'),
     url(r'^profile/(?P<username>[\w\-]+)/$',
         views.user_profile,
         name='vcboard-user-profile'),
@@ -48,6 +66,9 @@ urlpatterns += patterns('',
     url(pre('post/(?P<post_id>\d+)/$'), 
         views.show_post, 
         name='vcboard-show-post'),
+    url(pre('mark-read/$'), 
+        views.mark_forum_read, 
+        name='vcboard-mark-forum-read'),
     url(pre('new/$'), 
         views.create_thread, 
         name='vcboard-create-thread'),
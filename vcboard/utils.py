@@ -1,13 +1,32 @@
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, Permission
+from django.contrib.sites.models import Site
 from django.core.cache import cache
+from django.http import HttpResponseNotModified
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.template.defaultfilters import slugify
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import parse_etags, quote_etag
+from calendar import timegm
+from email.Utils import formatdate
+import time
+import urlparse
 
 # get the cache timeout from the settings, or default to 1 hour
 TIMEOUT = getattr(settings, 'CACHE_TIMEOUT', 3600)
 
+# version counters should outlive anything that is cached with them
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+# how often (in seconds) each process checks whether its copy of a shared
+# snapshot is still current
+CHECK_INTERVAL = getattr(settings, 'VCBOARD_CHECK_INTERVAL', 5)
+
+PERMS_VERSION = 'vcboard_perms_version'
+PERMS_FORUM_VERSION = 'vcboard_perms_version_f%i'
+
 PREFIX = 'vcb_'
 # prefix permissions so they're easier to differentiate
 PP = lambda s: '%s%s' % (PREFIX, s)
@@ -15,89 +34,229 @@ PP = lambda s: '%s%s' % (PREFIX, s)
 # de-prefix a permission
 DP = lambda s: s.replace(PREFIX, '')
 
+def cache_versions(names):
+    """
+    Retrieves several version counters from the cache at once.  Counters that
+    have never been set (or have been evicted) start at the current time, in
+    microseconds so a counter that is evicted and set again within the same
+    second doesn't go back to a value that has already been used.
+    """
+    versions = cache.get_many(names)
+    for name in names:
+        if not versions.has_key(name):
+            initial = int(time.time() * 1000000)
+            cache.add(name, initial, VERSION_TIMEOUT)
+            versions[name] = cache.get(name, initial)
+    return versions
+
+def cache_version(name):
+    """
+    Retrieves a single version counter from the cache
+    """
+    return cache_versions([name])[name]
+
+def bump_cache_version(name):
+    """
+    Increments a version counter, which invalidates anything that was cached
+    using the old value
+    """
+    try:
+        return cache.incr(name)
+    except ValueError:
+        return cache_version(name)
+
+class SharedSnapshot(object):
+    """
+    Keeps a process-local copy of data that is expensive to build, shared 
+    between processes through the cache.  Copies are tagged with a version 
+    counter, and each process checks the counter at most once every 
+    CHECK_INTERVAL seconds.  Calling invalidate() bumps the counter, which 
+    makes every process rebuild (or refetch) its copy.  Subclasses implement 
+    build(), which receives the key the data was requested for.
+    """
+
+    def __init__(self, name, check_interval=CHECK_INTERVAL):
+        self.name = name
+        self.check_interval = check_interval
+        self.version_key = 'vcboard_%s_version' % name
+        self._local = {}
+
+    def build(self, key):
+        raise NotImplementedError
+
+    def get(self, key=None):
+        now = time.time()
+        version, data, checked = self._local.get(key, (None, None, 0))
+        if data is not None and now - checked < self.check_interval:
+            return data
+
+        current = cache_version(self.version_key)
+        if data is None or version != current:
+            data_key = 'vcboard_%s_%s_%s' % (self.name, key, current)
+            data = cache.get(data_key)
+            if data is None:
+                data = self.build(key)
+                cache.set(data_key, data, TIMEOUT)
+
+        self._local[key] = (current, data, now)
+        return data
+
+    def invalidate(self):
+        self._local = {}
+        bump_cache_version(self.version_key)
+
 def get_user_permissions(user, forum):
     """
     Fetches a user's permissions for a particular forum
     """
+    return get_user_permissions_bulk(user, [forum])[forum.id]
 
-    # try to pull the permissions from the cache
+def get_user_permissions_bulk(user, forums):
+    """
+    Fetches a user's permissions for several forums at once.  Returns a
+    dictionary of permission dictionaries keyed on forum id.  Permissions are
+    remembered on the user object for the rest of the request, so decorators
+    and template tags that ask for the same forums later get them for free.
+    """
+    if not hasattr(user, '_forum_perms'):
+        user._forum_perms = {}
+    found = user._forum_perms
+    missing = [f.id for f in forums if not found.has_key(f.id)]
+    if not missing:
+        return found
+
+    # each (site, user, group, rank, forum) has its own cache entry, so a 
+    # user who changes groups or earns a rank doesn't keep the old entries.
+    # The key includes the global and per-forum permission versions, so 
+    # bumping either version makes the old entries unreachable
+    site = Site.objects.get_current()
     uid = user and user.id or 'anon'
-    cache_key = 'u%s_f%i' % (uid, forum.id)
-    cached_perm_dict = cache.get('vcboard_user_perms', {})
-    if cached_perm_dict.has_key(cache_key):
-        return cached_perm_dict[cache_key]
-    else:
-        cached_perm_dict[cache_key] = {}
-    forum_perms = cache.get('perms_for_forums', {})
+    group_id, rank_id = permission_holders(user)
+    versions = cache_versions([PERMS_VERSION] + 
+                              [PERMS_FORUM_VERSION % fid for fid in missing])
+    keys = dict((fid, 'vcboard_perms_s%i_u%s_g%s_r%s_f%i_%s_%s' % (site.id, 
+                        uid, group_id, rank_id, fid, versions[PERMS_VERSION], 
+                        versions[PERMS_FORUM_VERSION % fid])) 
+                for fid in missing)
+
+    cached = cache.get_many(keys.values())
+    for fid in missing[:]:
+        if cached.has_key(keys[fid]):
+            found[fid] = cached[keys[fid]]
+            missing.remove(fid)
+
+    if missing:
+        resolved = resolve_permissions(user, missing)
+        for fid in missing:
+            found[fid] = resolved[fid]
+            cache.set(keys[fid], resolved[fid], TIMEOUT)
 
-    from vcboard.models import ForumPermission
-    if isinstance(user, AnonymousUser):
-        permissions = ForumPermission.objects.filter(forum__id=forum.id)
-        perm_dict = dict((DP(p.permission.codename), p.has_permission or False) for p in permissions)
+    return found
+
+def permission_holders(user):
+    """
+    Works out the group and rank whose permissions apply to a user, as a
+    (group ID, rank ID) tuple.  The rank is None when the ranks extension 
+    isn't installed, and both are None for anonymous users.
+    """
+    if not user or isinstance(user, AnonymousUser):
+        return None, None
+
+    profile = user.forumprofile
+    rank_id = None
+    # determine whether or not the ranks extension is installed
+    if hasattr(profile, 'rank') and profile.rank:
+        rank_id = profile.rank.id or 0
+    return profile.group_id or 0, rank_id
+
+def invalidate_permissions(forum_id=None):
+    """
+    Throws away any cached permissions for the specified forum, or for all
+    forums if no forum is specified
+    """
+    if forum_id:
+        bump_cache_version(PERMS_FORUM_VERSION % forum_id)
     else:
-        from django.db import connection
-        cur = connection.cursor()
-        qn = connection.ops.quote_name
-        permissions = Permission.objects.filter(codename__startswith='vcb_')
-
-        # determine whether or not the ranks extension is installed
-        rank = rank_join = ''
-        if hasattr(user.forumprofile, 'rank') and user.forumprofile.rank:
-            rank_table = qn('ranks_rankpermission')
-            rank = 'rp.%s,' % qn('has_permission')
-            rank_join = 'LEFT OUTER JOIN %s rp ON rp.%s = f.%s AND rp.%s = %s AND rp.%s = %%(perm_id)s'
-            rank_join %= (rank_table, qn('forum_id'), qn('id'), 
-                          qn('rank_id'), user.forumprofile.rank.id or 0,
-                          qn('permission_id'))
-
-        perm_dict = {}
-        query = '''
-        SELECT DISTINCT
-        COALESCE(up.%(hp)s, %(rank)s
-            gp.%(hp)s,
-            fp.%(hp)s) as %%(perm_name)s
-        FROM %(forums)s f
-        LEFT OUTER JOIN %(forum)s fp ON fp.%(fid)s = f.%(id)s AND fp.%(pid)s = %%(perm_id)s
-        LEFT OUTER JOIN %(group)s gp ON gp.%(fid)s = f.%(id)s AND gp.%(gid)s = %(group_id)s AND gp.%(pid)s = %%(perm_id)s
-        %(rank_join)s
-        LEFT OUTER JOIN %(user)s up ON up.%(fid)s = f.%(id)s AND up.%(uid)s = %(user_id)s AND up.%(pid)s = %%(perm_id)s
-        WHERE f.%(id)s = %(forum_id)s
-        ''' % {
-            'hp': qn('has_permission'),
-            'rank': rank,
-            'forums': qn('vcboard_forum'),
-            'forum': qn('vcboard_forumpermission'),
-            'group': qn('vcboard_grouppermission'),
-            'rank_join': rank_join,
-            'user': qn('vcboard_userpermission'),
-            'fid': qn('forum_id'),
-            'id': qn('id'),
-            'forum_id': forum.id,
-            'gid': qn('group_id'),
-            'pid': qn('permission_id'),
-            'group_id': user.forumprofile.group.id,
-            'uid': qn('user_id'),
-            'user_id': user.id,
-        }
-        for perm in permissions:
-            p = DP(perm.codename)
-            current = query % {'perm_name': qn(p), 'perm_id': perm.id}
-            #print 'hitting db:', current
-            cur.execute(current)
-            row = cur.fetchone()
-            if row:
-                perm_dict[p] = bool(row[0])
-            else:
-                perm_dict[p] = False
-
-    # cache the permissions
-    if not forum_perms.has_key(forum.id):
-        forum_perms[str(forum.id)] = []
-    forum_perms[str(forum.id)].append(cache_key)
-    cache.set('perms_for_forums', forum_perms)
-
-    cached_perm_dict[cache_key] = perm_dict
-    cache.set('vcboard_user_perms', cached_perm_dict, TIMEOUT)
+        bump_cache_version(PERMS_VERSION)
+
+def permissions_query(user, forum_ids):
+    """
+    Builds the query that resolves a user's permissions for some forums, as
+    a (query, params) tuple.  Each row is a forum ID, a permission codename
+    and whether the user has the permission.
+    """
+    from django.db import connection
+    from vcboard.models import Forum, ForumPermission, GroupPermission, UserPermission
+    qn = connection.ops.quote_name
+    site = Site.objects.get_current()
+
+    # the permission matrices that apply to this user, most specific first
+    matrices = []
+    if not isinstance(user, AnonymousUser):
+        group_id, rank_id = permission_holders(user)
+        matrices.append((UserPermission, 'user_id', user.id))
+        if rank_id is not None:
+            from vcboard.ranks.models import RankPermission
+            matrices.append((RankPermission, 'rank_id', rank_id))
+        matrices.append((GroupPermission, 'group_id', group_id))
+    matrices.append((ForumPermission, None, None))
+
+    columns, joins, params = [], [], []
+    for i, (model, column, match) in enumerate(matrices):
+        alias = 'm%i' % i
+        join = 'LEFT OUTER JOIN %s %s ON %s.%s = p.%s AND %s.%s = f.%s AND %s.%s = %%s' % (
+                    qn(model._meta.db_table), alias,
+                    alias, qn('permission_id'), qn('id'),
+                    alias, qn('forum_id'), qn('id'),
+                    alias, qn('site_id'))
+        params.append(site.id)
+        if column:
+            join += ' AND %s.%s = %%s' % (alias, qn(column))
+            params.append(match)
+
+        columns.append('%s.%s' % (alias, qn('has_permission')))
+        joins.append(join)
+
+    # COALESCE needs at least two arguments
+    value = columns[0]
+    if len(columns) > 1:
+        value = 'COALESCE(%s)' % ', '.join(columns)
+
+    query = '''
+    SELECT f.%(id)s, p.%(codename)s, %(value)s
+    FROM %(forums)s f
+    CROSS JOIN %(permissions)s p
+    %(joins)s
+    WHERE f.%(id)s IN (%(forum_ids)s)
+    AND p.%(codename)s %(startswith)s
+    ''' % {
+        'id': qn('id'),
+        'codename': qn('codename'),
+        'value': value,
+        'forums': qn(Forum._meta.db_table),
+        'permissions': qn(Permission._meta.db_table),
+        'joins': '\n    '.join(joins),
+        'forum_ids': ', '.join(['%s'] * len(forum_ids)),
+        'startswith': connection.operators['startswith'] % '%s',
+    }
+    params.extend(forum_ids)
+    params.append(connection.ops.prep_for_like_query(PREFIX) + '%')
+    return query, params
+
+def resolve_permissions(user, forum_ids):
+    """
+    Resolves all of a user's permissions for any number of forums with a 
+    single query.  The most specific setting wins: user, then rank, then 
+    group, then forum.  Returns a dictionary of permission dictionaries keyed 
+    on forum id.
+    """
+    from django.db import connection
+
+    perm_dict = dict((fid, {}) for fid in forum_ids)
+    cur = connection.cursor()
+    cur.execute(*permissions_query(user, forum_ids))
+    for fid, codename, value in cur.fetchall():
+        perm_dict[fid][DP(codename)] = bool(value)
     return perm_dict
 
 def render(request, template, data, args=(), kwargs={}):
@@ -108,6 +267,60 @@ def render(request, template, data, args=(), kwargs={}):
                               context_instance=RequestContext(request),
                               *args, **kwargs)
 
+def http_validators(parts, last_modified=None):
+    """
+    Turns the things a page depends on into an ETag, and formats the time the
+    page last changed for a Last-Modified header
+    """
+    etag = md5_constructor(':'.join([smart_str(p) for p in parts])).hexdigest()
+    if last_modified:
+        last_modified = formatdate(timegm(last_modified.utctimetuple()))[:26] + 'GMT'
+    return etag, last_modified
+
+def not_modified(request, etag, last_modified=None):
+    """
+    Returns a 304 response if the client already has the current version of
+    a page, following the same rules as django.views.decorators.http
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_none_match:
+        try:
+            etags = parse_etags(if_none_match)
+        except ValueError:
+            etags = []
+        if (etag in etags or '*' in etags) and \
+                (not if_modified_since or if_modified_since == last_modified):
+            return HttpResponseNotModified()
+    elif if_modified_since and if_modified_since == last_modified:
+        return HttpResponseNotModified()
+    return None
+
+def add_validators(response, etag, last_modified=None):
+    """
+    Adds ETag and Last-Modified headers to a response
+    """
+    if response.status_code in (200, 304):
+        response['ETag'] = quote_etag(etag)
+        if last_modified:
+            response['Last-Modified'] = last_modified
+    return response
+
+def local_url(url, default):
+    """
+    Returns a URL to redirect to if it is a path on this site, or the default
+    otherwise, so redirects that come from a request can't send anyone to 
+    another site
+    """
+    scheme, netloc = urlparse.urlparse(url)[:2]
+    if scheme or netloc or not url.startswith('/') or url.startswith('//') \
+            or '\\' in url:
+        return default
+    return url
+
 def unique_slug(string, klass, params={}, slug_field='slug'):
     """
     Determines a unique slug for any given object.  You must specify the string
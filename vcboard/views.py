@@ -1,45 +1,89 @@
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.contrib.auth.models import User
-from django.core.paginator import Paginator
-from django.http import Http404, HttpResponseRedirect
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponseRedirect, HttpResponseNotAllowed
 from django.shortcuts import get_object_or_404
-from vcboard import config, decorators as vcb, signals
+from django.utils.translation import ugettext as _
+from vcboard import config, decorators as vcb, pagecache, signals
+from vcboard.counters import view_counter, first_view
 from vcboard.forms import ThreadForm, ReplyForm
-from vcboard.models import Forum, Thread, Post
-from vcboard.utils import render, get_user_permissions
+from vcboard.models import Forum, Thread, Post, ReadMarker
+from vcboard.pagination import thread_paginator, post_paginator
+from vcboard.utils import render, get_user_permissions_bulk, not_modified, \
+                          add_validators, local_url
+
+ARCHIVE = 'vcboard.archive' in settings.INSTALLED_APPS
 
 def forum_home(request, template='vcboard/forum_home.html'):
     """
     Displays all of the top-level forums and other random forum info
     """
-    data = {'forums': Forum.objects.top_level()}
+    data = {'forums': Forum.objects.add_subforums(Forum.objects.top_level())}
     return render(request, template, data)
 
 @vcb.permission_required('view_forum')
-def show_forum(request, path, page=1, template='vcboard/forum_detail.html'):
+def show_forum(request, path, page=1, template='vcboard/forum_detail.html',
+        archived=False):
     """
-    Displays a forum with its subforums and topics, if any
+    Displays a forum with its subforums and topics, if any.  The threads that
+    have been archived are listed separately.
     """
     forum = Forum.objects.with_path(path)
     if not forum:
         raise Http404
 
-    threads_per_page = forum.threads_per_page
-    if threads_per_page == 0:
-        threads_per_page = config('forum', 'threads_per_page', int, 20)
-    paginator = Paginator(forum.threads.all(), threads_per_page)
-    page_obj = paginator.page(page)
-
-    data = {
-        'forum': forum,
-        'paginator': paginator,
-        'page': page_obj
-    }
+    if archived:
+        if not ARCHIVE:
+            raise Http404
+        from vcboard.archive import views as archive
+        return archive.show_forum(request, forum, page)
+
+    # answer clients that already have the page before doing any real work
+    etag, last_modified = pagecache.forum_validators(request, forum, page)
+    response = not_modified(request, etag, last_modified)
+
+    key = pagecache.page_key(request, forum, page=page)
+    if response is None:
+        response = pagecache.get_page(key)
+    if response is None:
+        threads_per_page = forum.threads_per_page
+        if threads_per_page == 0:
+            threads_per_page = config('forum', 'threads_per_page', int, 20)
+        paginator = thread_paginator(forum, Thread.objects.listing(forum), 
+                                     threads_per_page)
+        page_obj = paginator.page(page)
+        page_obj.object_list = Thread.objects.attach_forum(page_obj.object_list, 
+                                                           forum)
+
+        data = {
+            'forum': forum,
+            'paginator': paginator,
+            'page': page_obj
+        }
+
+        # the last page leads on to the archive
+        if ARCHIVE and not page_obj.has_next():
+            from vcboard.archive.views import has_archived_threads
+            data['has_archive'] = has_archived_threads(forum)
+        response = render(request, template, data)
+        pagecache.set_page(key, response)
 
     signals.object_shown.send(sender=Forum, instance=forum, request=request)
 
-    return render(request, template, data)
+    return add_validators(response, etag, last_modified)
+
+def mark_forum_read(request, path):
+    """
+    Marks everything in a forum and its subforums as read
+    """
+    forum = Forum.objects.with_path(path)
+    if not forum:
+        raise Http404
+
+    for f in forum.descendants(include_self=True):
+        ReadMarker.objects.mark_forum_read(request.user, f)
+    return HttpResponseRedirect(forum.get_absolute_url())
 
 @vcb.permission_required('start_threads')
 def base_create_thread(request, forum, template):
@@ -83,24 +127,34 @@ def base_show_thread(request, forum, thread, page, template):
     """
     Does the work that allows users to view a thread
     """
-    paginator = Paginator(thread.posts.valid(), config('thread', 
-                                               'posts_per_page',
-                                               int, 20))
-    page_obj = paginator.page(page)
-    
-    # TODO: make the view count increment intelligently
-    thread.view_count += 1
-    thread.save()
+    # views are written to the database in batches
+    if not config('thread', 'unique_views', bool, False) or \
+            first_view(request, thread.id):
+        view_counter.add(thread.id)
+
+    etag, last_modified = pagecache.thread_validators(request, forum, thread, page)
+    response = not_modified(request, etag, last_modified)
+
+    key = pagecache.page_key(request, forum, thread, page)
+    if response is None:
+        response = pagecache.get_page(key)
+    if response is None:
+        thread.view_count += view_counter.get(thread.id)
+        paginator = post_paginator(thread, 
+                                   thread.posts.valid().select_related('author'), 
+                                   config('thread', 'posts_per_page', int, 20))
+        data = {
+            'forum': forum,
+            'thread': thread,
+            'paginator': paginator,
+            'page': paginator.page(page)
+        }
+        response = render(request, template, data)
+        pagecache.set_page(key, response)
 
-    data = {
-        'forum': forum,
-        'thread': thread,
-        'paginator': paginator,
-        'page': page_obj
-    }
     signals.object_shown.send(sender=Thread, instance=thread, request=request)
 
-    return render(request, template, data)
+    return add_validators(response, etag, last_modified)
 
 @vcb.permission_required('view_other_threads')
 def show_other_thread(*args, **kwargs):
@@ -113,7 +167,15 @@ def show_thread(request, path, thread_id, page=1,
     Allows users to view threads
     """
     forum = Forum.objects.with_path(path)
-    thread = get_object_or_404(Thread, pk=thread_id, forum=forum)
+    try:
+        thread = Thread.objects.get(pk=thread_id, forum=forum)
+    except Thread.DoesNotExist:
+        # threads that have been archived are still shown, read-only
+        if not ARCHIVE or not forum:
+            raise Http404
+        from vcboard.archive import views as archive
+        return archive.show_thread(request, forum, thread_id, page)
+
     func = base_show_thread
     if thread.author != request.user:
         func = show_other_thread
@@ -276,8 +338,7 @@ def base_delete_thread(request, forum, thread):
     """
     Does the work to delete a thread
     """
-    thread.is_deleted = False
-    thread.save()
+    Thread.objects.soft_delete([thread.id])
     return HttpResponseRedirect(forum.get_absolute_url())
 
 @vcb.permission_required('delete_other_threads')
@@ -292,12 +353,76 @@ def delete_thread(request, path, thread_id):
         func = delete_other_threads
     return func(request, forum, thread)
 
+# the permission that each moderation action needs, as in close_own_threads
+# and close_other_threads
+MODERATION_PERMISSIONS = {
+    'close': 'close',
+    'open': 'open',
+    'sticky': 'sticky',
+    'unsticky': 'sticky',
+    'delete': 'delete',
+    'move': 'move',
+}
+
+def moderate_threads(request):
+    """
+    Closes, opens, sticks, unsticks, deletes or moves many threads at once,
+    which may be in any number of forums.  Permissions are checked once per
+    forum, and threads the user may not moderate are left alone.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    action = request.POST.get('action', '')
+    if not MODERATION_PERMISSIONS.has_key(action):
+        raise Http404
+
+    ids = [int(i) for i in request.POST.getlist('thread_ids') if i.isdigit()]
+    threads = Thread.objects.filter(pk__in=ids, forum__in=Forum.objects.active()) \
+                            .values_list('pk', 'forum', 'author')
+    forums = Forum.objects.in_bulk(list(set(t[1] for t in threads)))
+    perms = get_user_permissions_bulk(request.user, forums.values())
+
+    user_id = request.user.is_authenticated() and request.user.id or None
+    allowed = []
+    for pk, forum_id, author_id in threads:
+        whose = (user_id and author_id == user_id) and 'own' or 'other'
+        codename = '%s_%s_threads' % (MODERATION_PERMISSIONS[action], whose)
+        if perms[forum_id].get(codename, False):
+            allowed.append(pk)
+
+    if action == 'move':
+        try:
+            target = Forum.objects.active().get(is_category=False,
+                                pk=int(request.POST.get('move_to_forum', 0)))
+        except (ValueError, Forum.DoesNotExist):
+            raise Http404
+        if not get_user_permissions_bulk(request.user, [target])[target.id] \
+                .get('start_threads', False):
+            allowed = []
+
+    if ids and not allowed:
+        return vcb.redirect_to_login(request)
+
+    if action == 'close':
+        Thread.objects.close(allowed)
+    elif action == 'open':
+        Thread.objects.reopen(allowed)
+    elif action in ('sticky', 'unsticky'):
+        Thread.objects.stick(allowed, action == 'sticky')
+    elif action == 'delete':
+        Thread.objects.soft_delete(allowed)
+    elif action == 'move':
+        Thread.objects.move(allowed, target)
+
+    return HttpResponseRedirect(local_url(request.POST.get('next', ''), 
+                                          reverse('vcboard-home')))
+
 def base_delete_post(request, forum, post):
     """
     Does the work to delete a post
     """
-    post.is_deleted = False
-    post.save()
+    Post.objects.soft_delete([post.id])
     return HttpResponseRedirect(forum.get_absolute_url())
 
 @vcb.permission_required('delete_other_posts')
@@ -320,41 +445,18 @@ def base_move_thread(request, forum, thread, template):
     # find all forums in which this user is allowed to start threads
     postable = Forum.objects.active().exclude(pk=forum.id)
     postable = postable.filter(is_category=False)
-    valid = []
+    postable = list(postable)
     error = None
-    for f in postable:
-        perms = get_user_permissions(request.user, f)
-        if perms['start_threads']:
-            valid.append(f)
+    perms = get_user_permissions_bulk(request.user, postable)
+    valid = [f for f in postable if perms[f.id].get('start_threads', False)]
 
     if request.method == 'POST':
         forum_id = int(request.POST.get('move_to_forum', 0))
-        f = Forum.objects.get(pk=forum_id)
-        if f in postable:
-            # reduce counts
-            for p in thread.forum.hierarchy:
-                p.thread_count -= 1
-                p.post_count -= thread.posts.count() - 1
-                p.save()
-
-                # TODO: look into updating the last post if the moving thread
-                # was the last post in this forum
-
-            # move the thread
-            thread.forum = f
-            thread.save()
-
-            # update counts again
-            for n in thread.forum.hierarchy:
-                n.thread_count += 1
-                n.post_count += thread.posts.count() + 1
-
-                if not n.last_post or n.last_post.date_created < thread.date_created:
-                    n.last_post = thread
-
-                n.save()
-
-            return HttpResponseRedirect(thread.get_absolute_url())
+        targets = [f for f in valid if f.id == forum_id]
+        if targets:
+            Thread.objects.move([thread.id], targets[0])
+            return HttpResponseRedirect(reverse('vcboard-show-thread', 
+                                                args=[targets[0].path, thread.id]))
         else:
             error = _('Invalid forum!')
 